@@ -61,6 +61,7 @@ install -d -p -m 755 %{buildroot}%{_datadir}/%{framework_name}
 %{_bindir}/mtf-env-clean
 %{_bindir}/mtf-init
 %{_bindir}/mtf-pdc-module-info-reader
+%{_bindir}/mtf-cache-clean
 %{python2_sitelib}/moduleframework/
 %{python2_sitelib}/mtf/
 %{python2_sitelib}/meta_test_family-*.egg-info/
@@ -33,6 +33,7 @@ import warnings
 from moduleframework import core, common
 from moduleframework.helpers.container_helper import ContainerHelper
 from moduleframework.helpers.nspawn_helper import NspawnHelper
+from moduleframework.helpers.bwrap_helper import BwrapHelper
 from moduleframework.helpers.rpm_helper import RpmHelper
 from moduleframework.helpers.openshift_helper import OpenShiftHelper
 
@@ -146,6 +147,43 @@ class AvocadoTest(Test):
             self.__print_breaks("COMMAND IN MODULE <->")
         return self.backend.run(*args, **kwargs)
 
+    def rpm_query(self, *args, **kwargs):
+        """
+        Run read-only rpm query in module (rpm arguments without "rpm"), for nspawn it is answered from host
+
+        :param args: rpm arguments
+        :param kwargs: pass thru
+        :return: object avocado.process.run
+        """
+        return self.backend.rpm_query(*args, **kwargs)
+
+    def file_exists(self, path):
+        """
+        Test if file exists in module
+
+        :param path: absolute path inside module
+        :return: bool
+        """
+        return self.backend.file_exists(path)
+
+    def read_file(self, path):
+        """
+        Return content of file in module
+
+        :param path: absolute path inside module
+        :return: str
+        """
+        return self.backend.read_file(path)
+
+    def stat_file(self, path):
+        """
+        Return dict with mode, size, uid, gid, mtime of file in module or None when it does not exist
+
+        :param path: absolute path inside module
+        :return: dict
+        """
+        return self.backend.stat_file(path)
+
     def runCheckState(self, command="ls /", expected_state=0,
                       output_text=None, *args, **kwargs):
         """
@@ -208,6 +246,16 @@ class AvocadoTest(Test):
         """
         return self.backend.getModulemdYamlconfig(*args, **kwargs)
 
+    def getModulemdIndex(self, *args, **kwargs):
+        """
+        Return index of actual moduleMD file (profiles and package sets)
+
+        :param args: pass thru
+        :param kwargs: pass thru
+        :return: modulemd_cache.ModuleMDIndex
+        """
+        return self.backend.getModulemdIndex(*args, **kwargs)
+
     def getActualProfile(self):
         """
         Return actual profile set profile via env variable PROFILE, could be used for filtering tests with skipIf method
@@ -331,6 +379,8 @@ def get_backend():
         return RpmHelper()
     elif parent == 'nspawn':
         return NspawnHelper()
+    elif parent == 'bwrap':
+        return BwrapHelper()
     elif parent == 'openshift':
         return OpenShiftHelper()
 
@@ -28,7 +28,6 @@ Custom configuration and debugging library.
 import netifaces
 import socket
 import os
-import urllib
 import yaml
 import subprocess
 import copy
@@ -41,6 +40,9 @@ import glob
 import avocado.utils
 import mtfexceptions
 import core
+import pkgcache
+import httpclient
+import modulemd_cache
 
 
 class MTFConfParser(dict):
@@ -106,6 +108,15 @@ def get_openshift_local():
     return bool(os.environ.get('OPENSHIFT_LOCAL'))
 
 
+def get_openshift_in_cluster():
+    """
+    Return the **MTF_OPENSHIFT_IN_CLUSTER** envvar, it is set inside runner pod of mtf --in-cluster,
+    application is already deployed there.
+    :return: bool
+    """
+    return bool(os.environ.get('MTF_OPENSHIFT_IN_CLUSTER'))
+
+
 def get_openshift_ip():
     """
     Return the **OPENSHIFT_IP** envvar or None.
@@ -169,6 +180,15 @@ def get_if_reuse():
     return bool(reuse)
 
 
+def get_if_nspawn_ephemeral():
+    """
+    Return the **MTF_NSPAWN_EPHEMERAL** envvar or nspawn.ephemeral value from MTF config.
+
+    :return: bool
+    """
+    return bool(os.environ.get('MTF_NSPAWN_EPHEMERAL') or conf.get("nspawn", {}).get("ephemeral"))
+
+
 def get_if_remoterepos():
     """
     Return the **MTF_REMOTE_REPOS** envvar.
@@ -326,18 +346,61 @@ def get_modulemdurl():
     return mdf
 
 
+# packages known to be installed on host, filled by missing_packages, cleared by every install
+host_installed_packages = set()
+
+
+def missing_packages(packages, rpm_query, installed=None):
+    """
+    Return packages what are not installed, all packages are checked by one rpm query.
+    Package names, files and provides (capabilities) are supported, groups (@group) and version
+    specifications are always returned as missing, same as everything in case rpm is not available.
+
+    Error lines of rpm are matched to queried items by words they contain (messages could be translated),
+    every error line what does not name queried item makes all items missing, same as mismatch between
+    number of matched items and exit status of rpm (number of items not found).
+
+    :param packages: list of packages
+    :param rpm_query: function with rpm arguments as parameter, returns avocado.process.run result
+    :param installed: set of packages known to be installed (cache), it is updated
+    :return: list of missing packages
+    """
+    installed = set() if installed is None else installed
+    queryable = [x for x in packages if x not in installed and not x.startswith("@") and " " not in x]
+    missing = [x for x in packages if x.startswith("@") or " " in x]
+    if queryable:
+        out = rpm_query("-q --whatprovides --qf '%%{{NAME}}\\n' %s" % " ".join(queryable))
+        notinstalled = set()
+        for line in out.stderr.splitlines() + [x for x in out.stdout.splitlines() if " " in x.strip()]:
+            words = set(x.strip(":'\"`,.") for x in line.split())
+            named = [x for x in queryable if x in words]
+            if not named:
+                # unknown error, nothing is known
+                notinstalled = set(queryable)
+                break
+            notinstalled.update(named)
+        if out.exit_status != len(notinstalled) and not (out.exit_status == 255 and len(notinstalled) > 255):
+            # rpm failed (not rpm based system) or output was not understood
+            notinstalled = set(queryable)
+        missing += [x for x in queryable if x in notinstalled]
+        installed.update([x for x in queryable if x not in notinstalled])
+    return [x for x in packages if x in missing]
+
+
 class CommonFunctions(object):
     """
     Basic class to read configuration data and execute commands on a host machine.
     """
     config = None
     modulemdConf = None
+    modulemdIndex = None
     component_name = None
     source = None
     arch = None
     sys_arch = None
     is_it_module = False
     packager = None
+    installed_packages = None
     # general use case is to have forwarded services to host (so thats why it is same)
     _ip_address = trans_dict["HOSTIPADDR"]
     _dependency_list = None
@@ -388,10 +451,10 @@ class CommonFunctions(object):
         if not self.info.get("url"):
             if get_module_type_base() in ["docker", "openshift"]:
                 self.info["url"]=self.info.get("container")
-            elif get_module_type_base() in ["rpm", "nspawn"]:
+            elif get_module_type_base() in ["rpm", "nspawn", "bwrap"]:
                 self.info["url"] = self.info.get("repo") or self.info.get("repos")
         # url has to be dict in case of rpm/nspanw (it is allowed to use ; as separator for more repositories)
-        if get_module_type_base() in ["rpm", "nspawn"] and isinstance(self.info["url"], str):
+        if get_module_type_base() in ["rpm", "nspawn", "bwrap"] and isinstance(self.info["url"], str):
             self.info["url"] = self.info["url"].split(";")
 
     def get_url(self):
@@ -461,17 +524,24 @@ class CommonFunctions(object):
         """
         if not packages:
             packages = self.get_test_dependencies()
-
+        if packages:
+            packages = missing_packages(packages,
+                                        lambda args: self.runHost("rpm %s" % args, ignore_status=True,
+                                                                  verbose=core.is_debug(),
+                                                                  env={"LC_ALL": "C"}),
+                                        host_installed_packages)
         if packages:
             core.print_info("Installs test dependencies: ", packages)
             # you have to have root permission to install packages:
             try:
                 self.runHost(
-                    "{HOSTPACKAGER} install " +
+                    "{HOSTPACKAGER} %s install " % pkgcache.packager_options(hostpackager) +
                     " ".join(packages),
                     ignore_status=False, verbose=core.is_debug())
             except avocado.utils.process.CmdError as e:
                 raise mtfexceptions.CmdExc("Installation failed; Do you have permission to do that?", e)
+            finally:
+                host_installed_packages.clear()
 
     def getPackageList(self, profile=None):
         """
@@ -481,20 +551,19 @@ class CommonFunctions(object):
         :return: list of packages (rpms)
         """
         package_list = []
-        mddata = self.getModulemdYamlconfig()
+        mdindex = self.getModulemdIndex()
         if not profile:
             if 'packages' in self.config:
                 packages_rpm = self.config.get('packages', {}).get('rpms', [])
-                packages_profiles = []
+                packages_profiles = set()
                 for profile_in_conf in self.config.get('packages', {}).get('profiles', []):
-                    packages_profiles += mddata['data']['profiles'][profile_in_conf]['rpms']
-                package_list += packages_rpm + packages_profiles
+                    packages_profiles |= mdindex.profile(profile_in_conf)
+                package_list += packages_rpm + sorted(packages_profiles - set(packages_rpm))
             if get_if_install_default_profile():
-                profile_append = mddata.get('data', {})\
-                    .get('profiles', {}).get(get_profile(), {}).get('rpms', [])
-                package_list += profile_append
+                profile_append = mdindex.profiles.get(get_profile(), frozenset())
+                package_list += sorted(profile_append - set(package_list))
         else:
-            package_list += mddata['data']['profiles'][profile].get('rpms', [])
+            package_list += sorted(mdindex.profile(profile))
         core.print_info("PCKGs to install inside module:", package_list)
         return package_list
 
@@ -522,37 +591,47 @@ class CommonFunctions(object):
     def dependency_list(self, value):
         self._dependency_list = value
 
-    def getModulemdYamlconfig(self, urllink=None):
+    def getModulemdIndex(self, urllink=None):
         """
-        Return moduleMD file yaml object.
-        It can be used also for loading another yaml file via url parameter
+        Return index of moduleMD file (profiles, package sets and dependencies),
+        parsed document is cached on disk and shared by test processes (see modulemd_cache)
 
         :param (str): url link to load. Default url defined in the `config.yaml` file,
                       can be overridden by the **CONFIG** envvar.
-        :return: dict
+        :return: modulemd_cache.ModuleMDIndex
         """
-        link = {"data": {}}
         if urllink:
             modulemd = urllink
         elif self.is_it_module:
-            if self.modulemdConf:
-                return self.modulemdConf
+            if self.modulemdIndex:
+                return self.modulemdIndex
             else:
                 modulemd = get_modulemdurl()
                 if not modulemd:
                     modulemd = self.config.get("modulemd-url")
         else:
-            return link
+            return modulemd_cache.ModuleMDIndex({"data": {}})
         try:
-            ymlfile = urllib.urlopen(modulemd)
-            link = yaml.load(ymlfile)
+            mdindex = modulemd_cache.load(modulemd)
         except IOError as e:
             raise mtfexceptions.ConfigExc("File '%s' cannot be load" % modulemd, e)
-        except yaml.parser.ParserError as e:
+        except yaml.YAMLError as e:
             raise mtfexceptions.ConfigExc("Module MD file contains errors: '%s'" % e, modulemd)
         if not urllink:
-            self.modulemdConf = link
-        return link
+            self.modulemdIndex = mdindex
+            self.modulemdConf = mdindex.modulemd
+        return mdindex
+
+    def getModulemdYamlconfig(self, urllink=None):
+        """
+        Return moduleMD file yaml object.
+        It can be used also for loading another yaml file via url parameter
+
+        :param (str): url link to load. Default url defined in the `config.yaml` file,
+                      can be overridden by the **CONFIG** envvar.
+        :return: dict
+        """
+        return self.getModulemdIndex(urllink).modulemd
 
     def getIPaddr(self):
         """
@@ -615,6 +694,57 @@ class CommonFunctions(object):
             self.packager = self.run(conf["generic"]["packager_cmd"], verbose=False).stdout.strip()
         return self.packager
 
+    def get_packager_cache_options(self):
+        """
+        Return additional packager options to use shared package cache (see pkgcache module).
+        Cache is not reachable from generic module types, so there are no options by default.
+
+        :return: str
+        """
+        return ""
+
+    def rpm_query(self, args, **kwargs):
+        """
+        Run read-only rpm query (rpm -q..., rpm -V...) in module.
+        Module types with root filesystem visible from host can answer it without executing command inside.
+
+        :param args: str rpm arguments, same translation rules as for run method
+        :param kwargs: pass thru to run method
+        :return: avocado.process.run
+        """
+        return self.run("rpm %s" % args, **kwargs)
+
+    def file_exists(self, path):
+        """
+        Test if file exists in module
+
+        :param path: absolute path inside module
+        :return: bool
+        """
+        return self.run("test -e %s" % path, ignore_status=True, verbose=core.is_debug()).exit_status == 0
+
+    def read_file(self, path):
+        """
+        Return content of file in module
+
+        :param path: absolute path inside module
+        :return: str
+        """
+        return self.run("cat %s" % path, verbose=core.is_debug()).stdout
+
+    def stat_file(self, path):
+        """
+        Return basic information about file in module (symlinks are followed)
+
+        :param path: absolute path inside module
+        :return: dict with keys mode, size, uid, gid, mtime or None when file does not exist
+        """
+        out = self.run("stat -L -c '%%f %%s %%u %%g %%Y' %s" % path, ignore_status=True, verbose=core.is_debug())
+        if out.exit_status != 0:
+            return None
+        mode, size, uid, gid, mtime = out.stdout.split()
+        return {"mode": int(mode, 16), "size": int(size), "uid": int(uid), "gid": int(gid), "mtime": int(mtime)}
+
     def status(self, command="/bin/true"):
         """
         Return status of module
@@ -652,9 +782,23 @@ class CommonFunctions(object):
         command = self.info.get('stop') or command
         self.run(command, shell=True, ignore_bg_processes=True, verbose=core.is_not_silent())
 
+    def get_missing_packages(self, packages):
+        """
+        Return packages what are not installed in module, result is cached until next install
+
+        :param packages: list of packages
+        :return: list
+        """
+        if self.installed_packages is None:
+            self.installed_packages = set()
+        return missing_packages(packages,
+                                lambda args: self.rpm_query(args, ignore_status=True, verbose=core.is_debug()),
+                                self.installed_packages)
+
     def install_packages(self, packages=None):
         """
-        Install packages in config (by config or via parameter)
+        Install packages in config (by config or via parameter), just missing packages are installed
+        in one transaction
 
         :param packages:
         :return:
@@ -662,7 +806,13 @@ class CommonFunctions(object):
         if not packages:
             packages = self.getPackageList()
         if packages:
-            a = self.run("%s install %s" % (self.get_packager()," ".join(packages)),
+            packages = self.get_missing_packages(packages)
+            if not packages:
+                core.print_info("All packages already installed")
+                return
+            self.installed_packages = None
+            a = self.run("%s %s install %s" % (self.get_packager(), self.get_packager_cache_options(),
+                                               " ".join(packages)),
                          ignore_status=True,
                          verbose=False)
             if a.exit_status == 0:
@@ -767,6 +917,9 @@ def get_config(fail_without_url=True, reload=False):
             # make it backward compatible
             if xcfg.get("module", {}).get("rpm") and not xcfg.get("module", {}).get("nspawn"):
                 xcfg["module"]["nspawn"] = copy.deepcopy(xcfg.get("module", {}).get("rpm"))
+            # bwrap uses nspawn images, so that it inherits nspawn section (or rpm one)
+            if xcfg.get("module", {}).get("nspawn") and not xcfg.get("module", {}).get("bwrap"):
+                xcfg["module"]["bwrap"] = copy.deepcopy(xcfg.get("module", {}).get("nspawn"))
             __persistent_config = xcfg
             return xcfg
         except IOError:
@@ -794,7 +947,7 @@ def get_backend_list():
 
     :return: list
     """
-    base_module_list = ["rpm", "nspawn", "docker", "openshift"]
+    base_module_list = ["rpm", "nspawn", "bwrap", "docker", "openshift"]
     return base_module_list
 
 
@@ -913,3 +1066,28 @@ def get_base_compose():
             compose_url = tmpcompose.format(
                 RELEASE=release, ARCH=conf["generic"]["arch"])
     return compose_url
+
+
+def test_missing_packages():
+    class Result(object):
+        def __init__(self, stdout, stderr, exit_status):
+            self.stdout, self.stderr, self.exit_status = stdout, stderr, exit_status
+
+    def rpm_query(args):
+        queried.append(args)
+        return answer
+
+    queried = []
+    answer = Result("bash\nno package provides nosuchcap\n",
+                    "error: file /usr/bin/nosuchfile: No such file or directory\n", 2)
+    installed = set()
+    packages = ["bash", "/usr/bin/nosuchfile", "nosuchcap", "@group"]
+    assert missing_packages(packages, rpm_query, installed) == ["/usr/bin/nosuchfile", "nosuchcap", "@group"]
+    assert installed == set(["bash"])
+    assert missing_packages(["bash"], rpm_query, installed) == [] and len(queried) == 1
+    # unknown error line
+    answer = Result("", "rpm: database is locked\n", 1)
+    assert missing_packages(["vim", "git"], rpm_query) == ["vim", "git"]
+    # rpm is not available
+    answer = Result("", "", 127)
+    assert missing_packages(["vim"], rpm_query) == ["vim"]
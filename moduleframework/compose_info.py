@@ -25,16 +25,110 @@
 MODULE for reading data from compose. There are stored:
   repos of module
   module files
+
+Modules metadata are decompressed and parsed as stream, document by document (C YAML loader
+is used when available), so that memory does not grow with size of compose. Documents are stored
+to <compose.index_cache>/<checksum>.yaml together with name/stream index (<checksum>.json),
+checksum of modules metadata from repomd.xml is the key, so that compose is parsed just once
+(documents of compose without checksum are kept in memory of parser).
 """
 
 import xml.etree.ElementTree
-import gzip
+import os
+import json
+import zlib
 import tempfile
-import urllib
 import yaml
-import os
 
+import core
 import common
+import httpclient
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+INDEX_FORMAT = 1
+DEFAULT_INDEX_CACHE = "/var/cache/mtf/compose_index"
+CHUNK = 1024 * 1024
+
+
+def get_index_cache():
+    """
+    Return directory of parsed compose metadata
+
+    :return: str
+    """
+    return common.conf["compose"].get("index_cache") or DEFAULT_INDEX_CACHE
+
+
+def decompressed_lines(response, compressed=True):
+    """
+    Read lines of (gzip compressed) stream, chunk by chunk
+
+    :param response: file like object
+    :param compressed: bool, stream is gzip compressed
+    :return: generator of lines (with newline)
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+    rest = ""
+    while True:
+        chunk = response.read(CHUNK)
+        if not chunk:
+            break
+        data = rest + (decompressor.decompress(chunk) if decompressor else chunk)
+        lines = data.split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if decompressor:
+        rest += decompressor.flush()
+    if rest:
+        yield rest
+
+
+def split_documents(lines):
+    """
+    Split multi document YAML stream to documents
+
+    :param lines: iterable of lines
+    :return: generator of document texts
+    """
+    document = []
+    for line in lines:
+        if line.startswith("---") or line.startswith("..."):
+            if "".join(document).strip():
+                yield "".join(document)
+            document = []
+            # document can start at the same line as separator (--- !!map)
+            line = line[3:].strip()
+            if not line:
+                continue
+            line += "\n"
+        document.append(line)
+    if "".join(document).strip():
+        yield "".join(document)
+
+
+def _modules_of_document(text):
+    """
+    Return modules of document as tuples (data, yaml text), old format stores all modules in one document
+
+    :param text: str
+    :return: list
+    """
+    document = yaml.load(text, Loader=SafeLoader)
+    if not isinstance(document, dict):
+        return []
+    if "modules" in document and "data" not in document:
+        return [(x, yaml.dump(x, Dumper=SafeDumper, default_flow_style=False)) for x in document["modules"] or []]
+    return [(document, text)]
+
+
+def _version_key(version):
+    return (0, int(version), "") if str(version).isdigit() else (1, 0, str(version))
 
 
 class ComposeParser(object):
@@ -42,24 +136,117 @@ class ComposeParser(object):
     Class for parsing compose. It expect string as constructor for parsing data
     """
 
-    def __init__(self, compose):
+    def __init__(self, compose, cachedir=None):
+        """
+
+        :param compose: str URL of compose repository
+        :param cachedir: str directory of parsed metadata, default compose.index_cache from MTF config
+        """
         self.compose = compose
+        self.cachedir = cachedir or get_index_cache()
         xmlrepomd = compose + "/" + common.conf["compose"]["repomd"]
-        e = xml.etree.ElementTree.parse(urllib.urlopen(xmlrepomd)).getroot()
-        modulelocaltion = e.findall(
-            ".//{http://linux.duke.edu/metadata/repo}data[@type='modules']/{http://linux.duke.edu/metadata/repo}location")[0]
-        mdrawlocaltion = modulelocaltion.attrib["href"]
-        response = ''.join(
-            urllib.urlopen(
-                compose +
-                "/" +
-                mdrawlocaltion).readlines())
-        tmpf = tempfile.mkstemp()
-        tmpfo = open(tmpf[1], mode='w+b')
-        tmpfo.write(response)
-        tmpfo.close()
-        self.modules = yaml.load(''.join(gzip.open(tmpf[1]).readlines()))
-        os.remove(tmpf[1])
+        with httpclient.open_url(xmlrepomd) as repomd:
+            e = xml.etree.ElementTree.parse(repomd).getroot()
+        modulesdata = e.findall(".//%sdata[@type='modules']" % REPO_NS)[0]
+        self.location = modulesdata.find("%slocation" % REPO_NS).attrib["href"]
+        checksum = modulesdata.find("%schecksum" % REPO_NS)
+        self.checksum = checksum.text.strip() if checksum is not None else None
+        # modules metadata kept in memory, when there is no checksum to identify cached files
+        self.data = None
+        self.index = self._load_index()
+        if self.index is None:
+            self.index = self._build_index()
+
+    def _paths(self, key=None):
+        key = key or self.checksum
+        return os.path.join(self.cachedir, "%s.json" % key), os.path.join(self.cachedir, "%s.yaml" % key)
+
+    def _load_index(self):
+        """
+        Internal method, return index of already parsed modules metadata
+
+        :return: list or None
+        """
+        if not self.checksum:
+            return None
+        indexfile, datafile = self._paths()
+        try:
+            with open(indexfile) as openfile:
+                data = json.load(openfile)
+        except (IOError, ValueError):
+            return None
+        if data.get("format") != INDEX_FORMAT or not os.path.exists(datafile):
+            return None
+        core.print_debug("Using parsed modules metadata of %s from %s" % (self.compose, indexfile))
+        return data["modules"]
+
+    def _build_index(self):
+        """
+        Internal method, download and parse modules metadata document by document,
+        store documents and index to cache directory
+
+        :return: list of dicts with keys name, stream, version, offset, length
+        """
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        index = []
+        fd, tmpdata = tempfile.mkstemp(dir=self.cachedir, prefix=".modules")
+        try:
+            # streamed response holds connection slot of host until it is closed, also on error
+            with os.fdopen(fd, "w") as datafile, \
+                    httpclient.open_url(self.compose + "/" + self.location, cache=False) as response:
+                lines = decompressed_lines(response, compressed=self.location.endswith(".gz"))
+                for text in split_documents(lines):
+                    for module, moduletext in _modules_of_document(text):
+                        data = module.get("data") or {}
+                        if not data.get("name"):
+                            # other documents (e.g. modulemd-defaults)
+                            continue
+                        datafile.write("---\n")
+                        index.append({"name": data["name"], "stream": str(data.get("stream")),
+                                      "version": str(data.get("version")), "offset": datafile.tell(),
+                                      "length": len(moduletext)})
+                        datafile.write(moduletext)
+            if not self.checksum:
+                # without checksum it is not possible to reuse it, nothing is cached
+                with open(tmpdata) as openfile:
+                    self.data = openfile.read()
+                return index
+            indexfile, datafile = self._paths()
+            os.rename(tmpdata, datafile)
+            tmpdata = None
+            fd, tmpindex = tempfile.mkstemp(dir=self.cachedir, prefix=".index")
+            with os.fdopen(fd, "w") as openfile:
+                json.dump({"format": INDEX_FORMAT, "compose": self.compose, "modules": index}, openfile)
+            os.rename(tmpindex, indexfile)
+        finally:
+            if tmpdata:
+                os.remove(tmpdata)
+        return index
+
+    def getModuleMD(self, item):
+        """
+        Return moduleMD of indexed module
+
+        :param item: dict from index
+        :return: dict
+        """
+        if self.data is not None:
+            return yaml.load(self.data[item["offset"]:item["offset"] + item["length"]], Loader=SafeLoader)
+        with open(self._paths()[1]) as datafile:
+            datafile.seek(item["offset"])
+            return yaml.load(datafile.read(item["length"]), Loader=SafeLoader)
+
+    def find(self, name, stream=None):
+        """
+        Return index item of latest version of module
+
+        :param name: str module name
+        :param stream: str optional
+        :return: dict or None
+        """
+        items = [x for x in self.index if x["name"] == name and (stream is None or x["stream"] == str(stream))]
+        return max(items, key=lambda x: _version_key(x["version"])) if items else None
 
     def getModuleList(self):
         """
@@ -68,32 +255,68 @@ class ComposeParser(object):
         :return: list
         """
         out = []
-        for foo in self.modules['modules']:
-            out.append({'name': foo['data']['name'], 'stream': foo['data'][
-                       'stream'], 'version': foo['data']['version'], })
+        for foo in self.index:
+            out.append({'name': foo['name'], 'stream': foo['stream'], 'version': foo['version'], })
         return out
 
-    def variableListForModule(self, name):
+    def variableListForModule(self, name, stream=None):
         """
         Return list of parameteres for CI's based on compose.
         Could be used for compose qualification.
 
         :param name: name of module what is stored in compose (latest one)
+        :param stream: stream of module, optional
         :return: list
         """
-        stream = None
-        version = None
-        thismodule = None
         out = []
-        for foo in self.modules['modules']:
-            if foo['data']['name'] == name:
-                thismodule = foo
+        thismodule = self.find(name, stream)
         if thismodule:
             mdo = file(common.conf["modularity"]["tempmodulefile"], mode="w")
-            yaml.dump(foo, mdo)
+            yaml.dump(self.getModuleMD(thismodule), mdo)
             mdo.close()
-            out.append("MODULENAME=%s" % foo['data']['name'])
+            out.append("MODULENAME=%s" % thismodule['name'])
             out.append("MODULE=%s" % "nspawn")
             out.append("URL=%s" % self.compose)
             out.append("MODULEMDURL=file://%s" % os.path.abspath(common.conf["modularity"]["tempmodulefile"]))
             return out
+
+
+def test_compose_parser():
+    import gzip
+    import shutil
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        documents = ["document: modulemd\nversion: 1\ndata:\n  name: %s\n  stream: master\n  version: %d\n" %
+                     (name, version) for name, version in [("nodejs", 1), ("nodejs", 3), ("perl", 2)]]
+        documents.append("document: modulemd-defaults\nversion: 1\ndata:\n  module: nodejs\n")
+        os.makedirs(os.path.join(tmpdir, "compose", "repodata"))
+        with gzip.open(os.path.join(tmpdir, "compose", "repodata", "modules.yaml.gz"), "w") as modulesfile:
+            modulesfile.write("---\n" + "...\n---\n".join(documents) + "...\n")
+        with open(os.path.join(tmpdir, "compose", common.conf["compose"]["repomd"]), "w") as repomd:
+            repomd.write('<repomd xmlns="http://linux.duke.edu/metadata/repo"><data type="modules">'
+                         '<checksum type="sha256">abc</checksum><location href="repodata/modules.yaml.gz"/>'
+                         '</data></repomd>')
+        compose = "file://%s" % os.path.join(tmpdir, "compose")
+        parser = ComposeParser(compose, os.path.join(tmpdir, "cache"))
+        assert len(parser.getModuleList()) == 3
+        assert parser.find("nodejs")["version"] == "3"
+        assert parser.getModuleMD(parser.find("perl"))["data"]["name"] == "perl"
+        # second parser uses cached index
+        os.remove(os.path.join(tmpdir, "compose", "repodata", "modules.yaml.gz"))
+        parser = ComposeParser(compose, os.path.join(tmpdir, "cache"))
+        assert parser.getModuleMD(parser.find("nodejs"))["data"]["version"] == 3
+        # without checksum, metadata are not cached
+        with gzip.open(os.path.join(tmpdir, "compose", "repodata", "modules.yaml.gz"), "w") as modulesfile:
+            modulesfile.write("---\n" + "...\n---\n".join(documents) + "...\n")
+        with open(os.path.join(tmpdir, "compose", common.conf["compose"]["repomd"]), "w") as repomd:
+            repomd.write('<repomd xmlns="http://linux.duke.edu/metadata/repo"><data type="modules">'
+                         '<location href="repodata/modules.yaml.gz"/></data></repomd>')
+        parser = ComposeParser(compose, os.path.join(tmpdir, "nochecksum"))
+        assert parser.getModuleMD(parser.find("perl"))["data"]["name"] == "perl"
+        assert os.listdir(os.path.join(tmpdir, "nochecksum")) == []
+        # old format, all modules in one document
+        assert [x[0]["data"]["name"] for x in _modules_of_document(
+            yaml.dump({"modules": [yaml.safe_load(x) for x in documents[:2]]}))] == ["nodejs", "nodejs"]
+    finally:
+        shutil.rmtree(tmpdir)
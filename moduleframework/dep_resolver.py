@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Resolver of module dependencies (modulemd requires) via PDC.
+
+Dependency graph is prefetched breadth first, all modules of one level are fetched by one
+PDC list query (name and stream parameters repeated), modules missing in its answer are
+queried one by one by pool of workers. Resolved modules are memoized for whole session,
+so that large module stacks are resolved in number of round trips close to depth of tree.
+Closure is then computed from memoized records depth first, so that the stream of module
+required by more modules is the same as chosen by the previous recursive solver.
+"""
+
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+import yaml
+
+import core
+import mtfexceptions
+import pdc_cache
+
+DEFAULT_WORKERS = 8
+_lock = threading.Lock()
+# (server, name, stream) -> PDC record of latest active version
+_resolved = {}
+
+
+def get_requires(record):
+    """
+    Return dependencies of module record
+
+    :param record: dict PDC record with modulemd
+    :return: dict name -> stream
+    """
+    modulemd = yaml.safe_load(record["modulemd"]) or {}
+    return modulemd.get("data", {}).get("dependencies", {}).get("requires", {}) or {}
+
+
+class DependencyResolver(object):
+    """
+    Resolver of module dependencies with concurrent breadth first prefetch
+    """
+
+    def __init__(self, cache=None, workers=None, batch=True):
+        """
+
+        :param cache: pdc_cache.PDCCache, default is cache shared by process
+        :param workers: int number of parallel PDC queries
+        :param batch: bool, fetch modules of one level by one list query
+        """
+        self.cache = cache or pdc_cache.get_cache()
+        self.workers = workers or DEFAULT_WORKERS
+        self.batch = batch
+        self.stats = {"queries": 0, "levels": [], "memoized": 0}
+
+    def _key(self, name, stream):
+        return self.cache.server, name, str(stream)
+
+    def _query(self, query):
+        with _lock:
+            self.stats["queries"] += 1
+        answer = self.cache.query(query)
+        # page_size=-1 returns plain list
+        return answer if isinstance(answer, list) else answer.get("results", [])
+
+    def _fetch_one(self, node):
+        """
+        Internal method, return latest active record of module, it is called by workers
+
+        :param node: tuple (name, stream)
+        :return: dict or None when module is not available
+        """
+        name, stream = node
+        results = self._query({"name": name, "stream": stream, "active": True})
+        return results[-1] if results else None
+
+    def _fetch_batch(self, nodes):
+        """
+        Internal method, return latest active records of modules by one list query
+
+        :param nodes: list of tuples (name, stream)
+        :return: dict (name, stream) -> record, modules not found are missing
+        """
+        query = {"name": sorted(set(x[0] for x in nodes)), "stream": sorted(set(str(x[1]) for x in nodes)),
+                 "active": True, "page_size": -1}
+        found = {}
+        for record in self._query(query):
+            node = (record["name"], str(record["stream"]))
+            if node in nodes and (node not in found or
+                                  pdc_cache._version_key(record) > pdc_cache._version_key(found[node])):
+                found[node] = record
+        return found
+
+    def fetch(self, nodes):
+        """
+        Fetch records of modules not resolved yet, concurrently
+
+        :param nodes: list of tuples (name, stream)
+        :return: None
+        """
+        missing = [(name, str(stream)) for name, stream in nodes if self._key(name, stream) not in _resolved]
+        self.stats["memoized"] += len(nodes) - len(missing)
+        if not missing:
+            return
+        records = {}
+        if self.batch and len(missing) > 1:
+            records = self._fetch_batch(missing)
+        rest = [x for x in missing if x not in records]
+        if rest:
+            pool = ThreadPool(min(self.workers, len(rest)))
+            try:
+                records.update(zip(rest, pool.map_async(self._fetch_one, rest, chunksize=1).get(timeout=3600)))
+            finally:
+                pool.terminate()
+        with _lock:
+            for (name, stream), record in records.items():
+                if record is not None:
+                    _resolved[self._key(name, stream)] = record
+
+    def record(self, name, stream):
+        """
+        Return record of resolved module
+
+        :param name: str
+        :param stream: str
+        :return: dict
+        :raises PDCExc: module is not available on PDC
+        """
+        try:
+            return _resolved[self._key(name, stream)]
+        except KeyError:
+            raise mtfexceptions.PDCExc("QUERY: %s:%s is not available on PDC" % (name, stream))
+
+    def resolve(self, name, stream, requires=None):
+        """
+        Return closure of module dependencies. Dependencies are visited depth first in sorted order,
+        first found stream of every module wins (as in the previous recursive solver).
+
+        :param name: str root module
+        :param stream: str root module stream
+        :param requires: dict dependencies of root module, they are resolved from PDC when not given
+        :return: dict with keys modules (name -> stream), records (name -> PDC record), levels, queries, seconds
+        """
+        started = time.time()
+        queries = self.stats["queries"]
+        if requires is None:
+            self.fetch([(name, stream)])
+            requires = get_requires(self.record(name, stream))
+        # prefetch every (name, stream) reachable from root, level by level
+        level = [(dep, str(requires[dep])) for dep in sorted(requires)]
+        expanded = set()
+        levels = []
+        while level:
+            level_started = time.time()
+            self.fetch(level)
+            following = []
+            for node in level:
+                if node in expanded or self._key(*node) not in _resolved:
+                    # module not available is reported when closure needs it
+                    continue
+                expanded.add(node)
+                deps = get_requires(self.record(*node))
+                core.print_debug("tree traverse from %s: %s" % (node[0], deps))
+                for item in sorted(deps):
+                    child = (item, str(deps[item]))
+                    if child not in expanded and child not in level and child not in following:
+                        following.append(child)
+            levels.append(time.time() - level_started)
+            level = following
+        self.stats["levels"] = levels
+        closure = {}
+
+        def visit(deps):
+            for dep in sorted(deps):
+                if dep not in closure:
+                    closure[dep] = deps[dep]
+                    self.fetch([(dep, deps[dep])])
+                    visit(get_requires(self.record(dep, deps[dep])))
+
+        visit(requires)
+        result = {"modules": closure,
+                  "records": dict((dep, self.record(dep, closure[dep])) for dep in closure),
+                  "levels": levels,
+                  "queries": self.stats["queries"] - queries,
+                  "seconds": time.time() - started}
+        core.print_debug("Dependencies of %s:%s resolved in %.2fs, %d levels, %d PDC queries" % (
+            name, stream, result["seconds"], len(levels), result["queries"]))
+        return result
+
+
+def test_resolve():
+    def record(name, requires):
+        return {"name": name, "stream": "master", "version": "1", "active": True,
+                "modulemd": yaml.dump({"data": {"dependencies": {"requires": requires}}})}
+
+    # root -> a, b -> c, d -> platform
+    records = [record("root", {"a": "master", "b": "master"}),
+               record("a", {"c": "master"}), record("b", {"c": "master", "d": "master"}),
+               record("c", {"platform": "master"}), record("d", {"platform": "master"}),
+               record("platform", {})]
+    requested = []
+    server = pdc_cache._fake_server(records, requested)
+    try:
+        url = "http://127.0.0.1:%d/modules/" % server.server_address[1]
+        cache = pdc_cache.PDCCache(url, ttl=0, snapshot="")
+        resolution = DependencyResolver(cache).resolve("root", "master")
+        assert sorted(resolution["modules"]) == ["a", "b", "c", "d", "platform"]
+        assert resolution["records"]["platform"]["name"] == "platform"
+        # root, then one list query per level
+        assert resolution["queries"] == 4 and len(resolution["levels"]) == 3
+        assert len(requested) == 4
+        # memoized for session
+        assert DependencyResolver(cache).resolve("b", "master")["queries"] == 0
+        # modules of level queried one by one
+        _resolved.clear()
+        records.append(record("e", {}))
+        resolution = DependencyResolver(cache, batch=False).resolve("x", "master",
+                                                                    requires={"a": "master", "e": "master"})
+        assert sorted(resolution["modules"]) == ["a", "c", "e", "platform"]
+        assert resolution["queries"] == 4
+        # stream found first depth first wins, b:other required by a is visited before b:master of root
+        _resolved.clear()
+        cache.memory.clear()
+        records.append(dict(record("b", {}), stream="other"))
+        records[1] = record("a", {"b": "other"})
+        resolution = DependencyResolver(cache).resolve("root", "master")
+        assert resolution["modules"] == {"a": "master", "b": "other"}
+        assert resolution["records"]["b"]["stream"] == "other"
+        # module not available on PDC
+        try:
+            DependencyResolver(cache).resolve("x", "master", requires={"missing": "master"})
+        except mtfexceptions.PDCExc:
+            pass
+        else:
+            assert False
+    finally:
+        _resolved.clear()
+        server.shutdown()
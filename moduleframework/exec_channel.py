@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Persistent shell channel (e.g. oc exec -i <pod> -- /bin/sh), commands are multiplexed over one stream.
+
+Every command is sent base64 encoded, shell stores its stdout and stderr to files and sends back
+framed reply::
+
+    <marker> <exit status>
+    <base64 stdout>
+    <marker>
+    <base64 stderr>
+    <marker>
+
+Channel is connected again by next command when shell ends (e.g. pod restarted). Shell without
+base64 utility is remembered as not usable, it is not started again.
+"""
+
+import os
+import time
+import uuid
+import base64
+import select
+import subprocess
+from avocado.utils import process
+
+import core
+import mtfexceptions
+
+INIT_SCRIPT = 'mtf_dir=$(mktemp -d 2>/dev/null || (mkdir -p /tmp/mtf.$$ && echo /tmp/mtf.$$)); ' \
+              'command -v base64 >/dev/null && echo "{marker} ok" || echo "{marker} missing"\n'
+COMMAND_SCRIPT = '( eval "$(echo {command} | base64 -d)" ) </dev/null >"$mtf_dir/o" 2>"$mtf_dir/e"; ' \
+                 'echo "{marker} $?"; base64 "$mtf_dir/o"; echo "{marker}"; base64 "$mtf_dir/e"; echo "{marker}"\n'
+CONNECT_TIMEOUT = 30
+
+
+class ExecChannel(object):
+    """
+    Long lived shell, commands are executed one by one
+    """
+
+    def __init__(self, argv_factory):
+        """
+
+        :param argv_factory: function returning command line (list) of shell, it is called for every connection,
+                             so that it can find current pod
+        """
+        self.argv_factory = argv_factory
+        self.proc = None
+        self.buffer = ""
+        self.connections = 0
+        # command lines of shells what are not able to handle framed commands
+        self.unusable = set()
+
+    def _readline(self, deadline):
+        """
+        Internal method, read line from shell
+
+        :param deadline: float time or None
+        :return: str line without newline
+        """
+        while "\n" not in self.buffer:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise mtfexceptions.ExecChannelExc("Timeout of command in exec channel")
+            ready = select.select([self.proc.stdout], [], [], remaining)[0]
+            if not ready:
+                continue
+            data = os.read(self.proc.stdout.fileno(), 65536)
+            if not data:
+                raise mtfexceptions.ExecChannelExc("Exec channel closed (exit status %s)" % self.proc.poll())
+            self.buffer += data
+        line, self.buffer = self.buffer.split("\n", 1)
+        return line
+
+    def _frame(self, marker, deadline):
+        """
+        Internal method, read lines until marker
+
+        :return: str
+        """
+        lines = []
+        while True:
+            line = self._readline(deadline)
+            if line == marker:
+                return "".join(lines)
+            lines.append(line)
+
+    def connect(self):
+        """
+        Start shell and check that it is able to handle framed commands
+
+        :return: None
+        :raises ExecChannelConnectExc: shell is not usable
+        """
+        self.close()
+        argv = self.argv_factory()
+        if tuple(argv) in self.unusable:
+            raise mtfexceptions.ExecChannelConnectExc("There is no base64 utility, exec channel is not usable")
+        core.print_debug("Opening exec channel: %s" % " ".join(argv))
+        marker = "MTF-%s" % uuid.uuid4().hex
+        try:
+            with open(os.devnull, "w") as devnull:
+                self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+            self.connections += 1
+            self.proc.stdin.write(INIT_SCRIPT.format(marker=marker))
+            self.proc.stdin.flush()
+            while True:
+                line = self._readline(time.time() + CONNECT_TIMEOUT)
+                if line.startswith(marker):
+                    break
+        except (IOError, OSError, mtfexceptions.ExecChannelExc) as e:
+            self.close()
+            raise mtfexceptions.ExecChannelConnectExc("Unable to open exec channel: %s" % e)
+        if line.split()[-1] != "ok":
+            self.close()
+            self.unusable.add(tuple(argv))
+            raise mtfexceptions.ExecChannelConnectExc("There is no base64 utility, exec channel is not usable")
+
+    def run(self, command, timeout=None):
+        """
+        Execute command in shell
+
+        :param command: str shell command
+        :param timeout: seconds, channel is closed in case of timeout
+        :return: avocado.utils.process.CmdResult
+        :raises ExecChannelConnectExc: command was not started, channel is not usable
+        :raises ExecChannelExc: timeout of command or shell ended during command
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            self.connect()
+        marker = "MTF-%s" % uuid.uuid4().hex
+        deadline = time.time() + timeout if timeout else None
+        started = time.time()
+        try:
+            self.proc.stdin.write(COMMAND_SCRIPT.format(command=base64.b64encode(command), marker=marker))
+            self.proc.stdin.flush()
+        except (IOError, OSError) as e:
+            # shell ended before it read command
+            self.close()
+            raise mtfexceptions.ExecChannelConnectExc("Exec channel closed: %s" % e)
+        try:
+            while True:
+                line = self._readline(deadline)
+                if line.startswith(marker + " "):
+                    break
+            exit_status = int(line.split()[1])
+            stdout = base64.b64decode(self._frame(marker, deadline))
+            stderr = base64.b64decode(self._frame(marker, deadline))
+        except (IOError, OSError, ValueError, TypeError, mtfexceptions.ExecChannelExc) as e:
+            # state of shell is not known, new one is started by next command
+            self.close()
+            raise mtfexceptions.ExecChannelExc("Command %s failed in exec channel: %s" % (command, e))
+        return process.CmdResult(command=command, stdout=stdout, stderr=stderr, exit_status=exit_status,
+                                 duration=time.time() - started)
+
+    def close(self):
+        """
+        Terminate shell
+
+        :return: None
+        """
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                try:
+                    self.proc.stdin.close()
+                except IOError:
+                    pass
+                self.proc.terminate()
+            self.proc.wait()
+        self.proc = None
+        self.buffer = ""
+
+
+def test_exec_channel():
+    channel = ExecChannel(lambda: ["/bin/sh"])
+    result = channel.run("echo out; echo err >&2; exit 3")
+    assert (result.stdout, result.stderr, result.exit_status) == ("out\n", "err\n", 3)
+    assert channel.run("printf '%s' \"quoted 'text'\"").stdout == "quoted 'text'"
+    # shell ended (like restarted pod), it is connected again by next command
+    channel.proc.kill()
+    channel.proc.wait()
+    assert channel.run("echo again").stdout == "again\n"
+    assert channel.connections == 2
+    try:
+        channel.run("sleep 10", timeout=1)
+    except mtfexceptions.ExecChannelExc:
+        pass
+    else:
+        assert False
+    assert channel.run("true").exit_status == 0
+    channel.close()
+    try:
+        ExecChannel(lambda: ["/nonexistent/sh"]).run("true")
+    except mtfexceptions.ExecChannelConnectExc:
+        pass
+    else:
+        assert False
+    # shell without base64 is not started again
+    channel = ExecChannel(lambda: ["/usr/bin/env", "PATH=/nonexistent", "/bin/sh"])
+    for x in range(2):
+        try:
+            channel.run("true")
+        except mtfexceptions.ExecChannelConnectExc:
+            pass
+        else:
+            assert False
+    assert channel.connections == 1
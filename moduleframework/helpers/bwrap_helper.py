@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+import os
+
+from avocado.core import exceptions
+
+import nspawn_helper
+from mtf.backend import bwrap
+from moduleframework import common
+
+
+class BwrapHelper(nspawn_helper.NspawnHelper):
+    """
+    Class for MODULE testing via bubblewrap sandbox. It uses same images as NSPAWN,
+    but there is no systemd boot, commands are executed directly in sandbox with read only root filesystem.
+    It is intended for package level tests (install packages, run binaries), services managed
+    by systemd are not supported. Packages are installed just when image is built, tests installing
+    other packages are cancelled (see install_packages).
+
+    This class is derived from NSPAWN HELPER, so that it uses same section in config file
+    """
+
+    def __init__(self):
+        super(BwrapHelper, self).__init__()
+        # image is shared read only by all sandboxes, there is no snapshot
+        self.ephemeral = True
+
+    def _use_layered_images(self):
+        """
+        Layers are mounted via overlayfs, what needs root privileges
+
+        :return: bool
+        """
+        return super(BwrapHelper, self)._use_layered_images() and os.geteuid() == 0
+
+    def _create_container(self, image):
+        """
+        Create bubblewrap sandbox on top of image
+
+        :param image: nspawn.Image
+        :return: bwrap.Sandbox
+        """
+        bwrapconf = common.conf.get("bwrap") or {}
+        return bwrap.Sandbox(image=image, name=self.name,
+                             writable_dirs=bwrapconf.get("writable_dirs"),
+                             overlay=bwrapconf.get("overlay", False),
+                             additional_options=bwrapconf.get("additional_options"))
+
+    def _boot_container(self, container):
+        """
+        Prepare sandbox, there is nothing to boot
+
+        :param container: bwrap.Sandbox
+        :return: None
+        """
+        container.boot_machine()
+
+    def install_packages(self, packages=None):
+        """
+        Root filesystem of sandbox is read only (or temporary overlay of one command), so that packages
+        are never installed, test needing packages what are not in image is cancelled
+
+        :param packages: list of packages, packages of module by default
+        :return: None
+        """
+        packages = packages or self.getPackageList()
+        missing = self.get_missing_packages(packages) if packages else []
+        if missing:
+            raise exceptions.TestCancel("Packages %s are not in image and root filesystem of bwrap sandbox "
+                                        "is read only, add them to packages of module in config "
+                                        "or use MODULE=nspawn" % " ".join(missing))
@@ -22,7 +22,7 @@
 
 import json
 import warnings
-from moduleframework import common, core, mtfexceptions
+from moduleframework import common, core, mtfexceptions, image_gc
 
 
 class ContainerHelper(common.CommonFunctions):
@@ -129,6 +129,8 @@ class ContainerHelper(common.CommonFunctions):
             pass
         else:
             self.runHost("docker pull %s" % self.name, verbose=core.is_not_silent())
+        if "docker=" not in self._icontainer and image_gc.is_enabled():
+            image_gc.mark_docker_used(self.name)
 
     def __load_inspect_json(self):
         """
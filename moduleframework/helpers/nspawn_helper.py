@@ -25,8 +25,9 @@ import hashlib
 import os
 
 import rpm_helper
+from avocado.utils import process
 from mtf.backend import nspawn
-from moduleframework import common, core
+from moduleframework import common, core, mtfexceptions, image_gc, pkgcache
 
 
 class NspawnHelper(rpm_helper.RpmHelper):
@@ -53,6 +54,12 @@ class NspawnHelper(rpm_helper.RpmHelper):
         else:
             self.name = self.component_name
         self.chrootpath = os.path.abspath(self.baseprefix + self.name)
+        # ephemeral containers are not stored on disk, so it is not possible to reuse them
+        self.ephemeral = common.get_if_nspawn_ephemeral() and not common.get_if_reuse()
+        # locks protecting used images and repositories against garbage collector
+        self.__gc_locks = []
+        # rpm database of machine is readable from host via rpm --root (None means not tested yet)
+        self.__host_rpm = None
 
     def setUp(self):
         """
@@ -64,7 +71,6 @@ class NspawnHelper(rpm_helper.RpmHelper):
         :return: None
         """
 
-        common.trans_dict["ROOT"] = self.chrootpath
         core.print_info("name of CHROOT directory:", self.chrootpath)
         self.setRepositoriesAndWhatToInstall()
         # never move this line to __init__ this localtion can change before setUp (set repositories)
@@ -72,14 +78,93 @@ class NspawnHelper(rpm_helper.RpmHelper):
                                                     self.component_name +
                                                     "_image_" +
                                                     hashlib.md5(" ".join(self.repos)).hexdigest())
-        self.__image_base = nspawn.Image(location=self.chrootpath_baseimage,
-                                  packageset=self.whattoinstallrpm,
-                                  repos=self.repos,
-                                  ignore_installed=True)
-        self.__image = self.__image_base.create_snapshot(self.chrootpath)
-        self.__container = nspawn.Container(image=self.__image, name=self.name)
+        self.__image_base = self.__get_image()
+        self.__gc_locks = image_gc.use_image(self.__image_base) + \
+            image_gc.use(pkgcache.local_repo_paths(self.repos))
+        if not self.ephemeral:
+            self.__gc_locks += image_gc.use([self.chrootpath])
+        if self.ephemeral:
+            # container boots directly from cached image, changes are kept in memory
+            self.__image = self.__image_base
+        else:
+            self.__image = self.__image_base.create_snapshot(self.chrootpath)
+        self.chrootpath = self.__image.get_location()
+        common.trans_dict["ROOT"] = self.chrootpath
+        self.__container = self._create_container(self.__image)
         self._callSetupFromConfig()
-        self.__container.boot_machine(nspawn_add_option_list=common.conf["nspawn"]["additional_boot_options"])
+        self._boot_container(self.__container)
+
+    def _create_container(self, image):
+        """
+        Create container object what executes commands on top of image, derived helpers
+        could use another isolation with same interface (execute, copy_to, copy_from, host_path, stop, rm)
+
+        :param image: nspawn.Image
+        :return: nspawn.Container
+        """
+        return nspawn.Container(image=image, name=self.name, ephemeral=self.ephemeral,
+                                ephemeral_option=common.conf["nspawn"].get("ephemeral_option", "--volatile=overlay"))
+
+    def _boot_container(self, container):
+        """
+        Start container created by _create_container
+
+        :param container: nspawn.Container
+        :return: None
+        """
+        container.boot_machine(nspawn_add_option_list=common.conf["nspawn"]["additional_boot_options"])
+
+    def _use_layered_images(self):
+        """
+        Return if module packages are installed as layer on top of shared base image
+
+        :return: bool
+        """
+        return bool(common.conf["nspawn"].get("layered_images"))
+
+    def __get_image(self):
+        """
+        Internal method, return image with all packages for module.
+        When layered images are enabled (nspawn.layered_images in MTF config), module packages
+        are installed as overlay layer on top of shared base image, what is built just once
+        per repository set and base package set
+
+        :return: nspawn.Image
+        """
+        if self._use_layered_images():
+            baserepos = self.__get_base_layer_repos()
+            base_id = hashlib.md5(" ".join(sorted(baserepos) + sorted(self.bootstrappackages))).hexdigest()
+            try:
+                image_base = nspawn.Image(location=os.path.abspath(self.baseprefix + "base_image_" + base_id),
+                                          packageset=self.bootstrappackages,
+                                          repos=baserepos,
+                                          ignore_installed=True)
+                layer_id = hashlib.md5(" ".join(sorted(self.repos) + sorted(self.whattoinstallrpm))).hexdigest()
+                self.chrootpath_baseimage = os.path.abspath(self.baseprefix + self.component_name +
+                                                            "_image_" + layer_id)
+                return nspawn.LayeredImage(base=image_base,
+                                           location=self.chrootpath_baseimage,
+                                           packageset=self.whattoinstallrpm,
+                                           repos=self.repos,
+                                           ignore_installed=True)
+            except mtfexceptions.NspawnExc as e:
+                core.print_info("Unable to use layered images, fallback to standalone image", e)
+        return nspawn.Image(location=self.chrootpath_baseimage,
+                            packageset=self.whattoinstallrpm,
+                            repos=self.repos,
+                            ignore_installed=True)
+
+    def __get_base_layer_repos(self):
+        """
+        Internal method, return repositories for base layer. Base compose is enough for modules,
+        so that all modules of one release share same base layer.
+
+        :return: list
+        """
+        baserepo = common.get_base_compose()
+        if self.is_it_module and baserepo in self.repos:
+            return [baserepo]
+        return self.repos
 
     def run(self, command, **kwargs):
         return self.__container.execute(command=common.translate_cmd(command, translation_dict=common.trans_dict), **kwargs)
@@ -106,6 +191,91 @@ class NspawnHelper(rpm_helper.RpmHelper):
         """
         return self.run(command="/bin/true").stdout
 
+    def __host_path(self, path):
+        """
+        Internal method, return host path of file inside machine for direct read only access
+
+        :return: str or None when file is not visible from host
+        """
+        return self.__container.host_path(common.translate_cmd(path, translation_dict=common.trans_dict))
+
+    def __host_rpm_available(self):
+        """
+        Internal method, test if rpm database of machine could be queried from host,
+        it is not possible for ephemeral machines or when host rpm is not able to read database
+
+        :return: bool
+        """
+        if self.__host_path("/var/lib/rpm") is None:
+            return False
+        if self.__host_rpm is None:
+            self.__host_rpm = process.run("rpm --root %s -q rpm" % self.chrootpath, ignore_status=True,
+                                          verbose=core.is_debug()).exit_status == 0
+            core.print_debug("rpm database of machine readable from host: %s" % self.__host_rpm)
+        return self.__host_rpm
+
+    def rpm_query(self, args, **kwargs):
+        """
+        Run read-only rpm query via rpm --root on host, command is executed inside machine
+        only when rpm database is not visible from host
+
+        :param args: str rpm arguments
+        :param kwargs: pass thru to avocado.process.run
+        :return: avocado.process.run
+        """
+        if not self.__host_rpm_available():
+            return super(NspawnHelper, self).rpm_query(args, **kwargs)
+        kwargs["shell"] = True
+        kwargs.setdefault("verbose", core.is_debug())
+        return process.run("rpm --root %s %s" % (self.chrootpath,
+                                                 common.translate_cmd(args, translation_dict=common.trans_dict)),
+                           **kwargs)
+
+    def file_exists(self, path):
+        """
+        Test if file exists in machine, root filesystem is accessed directly from host when possible
+
+        :param path: absolute path inside machine
+        :return: bool
+        """
+        hostpath = self.__host_path(path)
+        if hostpath is None:
+            return super(NspawnHelper, self).file_exists(path)
+        return os.path.exists(hostpath)
+
+    def read_file(self, path):
+        """
+        Return content of file in machine, root filesystem is accessed directly from host when possible
+
+        :param path: absolute path inside machine
+        :return: str
+        """
+        hostpath = self.__host_path(path)
+        if hostpath is not None:
+            try:
+                with open(hostpath) as openfile:
+                    return openfile.read()
+            except IOError:
+                pass
+        return super(NspawnHelper, self).read_file(path)
+
+    def stat_file(self, path):
+        """
+        Return basic information about file in machine, root filesystem is accessed directly from host when possible
+
+        :param path: absolute path inside machine
+        :return: dict with keys mode, size, uid, gid, mtime or None when file does not exist
+        """
+        hostpath = self.__host_path(path)
+        if hostpath is None:
+            return super(NspawnHelper, self).stat_file(path)
+        try:
+            info = os.stat(hostpath)
+        except OSError:
+            return None
+        return {"mode": info.st_mode, "size": info.st_size, "uid": info.st_uid, "gid": info.st_gid,
+                "mtime": int(info.st_mtime)}
+
     def copyTo(self, src, dest):
         """
         Copy file to module from host
@@ -137,10 +307,12 @@ class NspawnHelper(rpm_helper.RpmHelper):
                 self.__container.stop()
             except:
                 pass
-            try:
-                self.__container.rm()
-            except:
-                pass
+            if not self.ephemeral:
+                try:
+                    self.__container.rm()
+                except:
+                    pass
+            image_gc.release(self.__gc_locks)
         else:
             core.print_info("tearDown skipped", "running nspawn: %s" % self.name)
             core.print_info("To connect to a machine use:",
@@ -23,12 +23,15 @@
 import json
 import os
 import time
-import random
-import string
+import shlex
+from avocado.utils import process
 from avocado.utils.process import CmdError
-from moduleframework import core, common, mtfexceptions
+from moduleframework import core, common, mtfexceptions, openshift_api, project_pool, exec_channel
 import container_helper
 
+# registry address, tokens of users and docker logins are same for all tests of session
+_session_cache = {}
+
 
 class OpenShiftHelper(container_helper.ContainerHelper):
     """
@@ -47,6 +50,11 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         self.template = self.get_template()
         self.pod_id = None
         self._ip_address = None
+        # REST API client of current account, None means oc client (oc login) is used
+        self._api = None
+        self._namespace = None
+        # projects deleted by this helper, server removes them asynchronously
+        self._deleting_projects = set()
         if not self.icontainer:
             raise mtfexceptions.ConfigExc("No container image specified in the configuration file or environment variable.")
         if "docker=" in self.icontainer:
@@ -57,11 +65,73 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         # application name is taken from docker.io/modularitycontainer/memcached
         self.app_name = self.container_name.split('/')[-1]
         self.app_ip = None
-        random_str = ''.join(random.choice(string.lowercase) for _ in range(3))
         self.project_name = "{project}-{random_str}".format(project=self.app_name,
-                                                            random_str=random_str)
+                                                            random_str=project_pool.unique_suffix())
+        # leased project of project pool (openshift.project_pool in MTF config)
+        self._project_lease = None
+        # project was created by this helper (new-project), it is deleted by _app_remove
+        self._project_created = False
+        # persistent shell in application pod used by run()
+        self._channel = None
         core.print_debug(self.icontainer, self.app_name)
 
+    def _oc(self, args, **kwargs):
+        """
+        Run oc command as current account, credentials are passed as options when REST API client is used,
+        so that there is no need of oc login. Project of helper is always passed (-n), current project
+        of oc configuration shared by parallel tests is never used.
+        :param args: str oc arguments
+        :param kwargs: pass thru to runHost
+        :return: avocado.process.run
+        """
+        options = []
+        if self._api:
+            options.append(self._api.oc_options())
+        if "-n " not in args:
+            options.append("-n %s" % self._current_namespace())
+        return self.runHost(" ".join(["oc"] + options + [args]), **kwargs)
+
+    def _oc_admin(self, args, **kwargs):
+        """
+        Run oc command as system:admin and switch back to current account
+        :param args: str oc arguments
+        :param kwargs: pass thru to runHost
+        :return: avocado.process.run
+        """
+        return self._as_admin(self._oc, args, **kwargs)
+
+    def _as_admin(self, function, *args, **kwargs):
+        """
+        Call function as system:admin and switch back to current account
+        (to user account in case of oc login, current account is not known)
+        :param function: method of helper
+        :return: return value of function
+        """
+        api = self._api
+        self._change_openshift_account()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if api:
+                self._api = api
+            else:
+                self._change_openshift_account(account=common.get_openshift_user(),
+                                               password=common.get_openshift_passwd())
+
+    def _api_failed(self, error):
+        """
+        Report failure of REST API call, oc client is used instead
+        :param error: exception
+        """
+        core.print_debug("OpenShift REST API call failed, using oc client", error)
+
+    def _current_namespace(self):
+        """
+        Return project where resources are searched (project created or leased by helper)
+        :return: str
+        """
+        return self._namespace or self.project_name
+
     def _get_openshift_ip_registry(self):
         """
         Function returns an IP of OpenShift registry.
@@ -69,8 +139,16 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         :return: str or None
         """
         openshift_ip_registry = None
-        docker_registry = self.runHost('oc get svc -n default %s -o json' % common.conf["openshift"]["docker_registry"],
-                                       ignore_status=True).stdout
+        if self._api:
+            try:
+                for svc in self._api.list("svc", "default"):
+                    if svc["metadata"]["name"] == common.conf["openshift"]["docker_registry"]:
+                        openshift_ip_registry = svc.get("spec", {}).get("clusterIP")
+                return openshift_ip_registry
+            except openshift_api.API_ERRORS as e:
+                self._api_failed(e)
+        docker_registry = self._oc('get svc -n default %s -o json' % common.conf["openshift"]["docker_registry"],
+                                   ignore_status=True).stdout
         try:
             docker_registry = json.loads(docker_registry)
             openshift_ip_registry = docker_registry.get("spec").get("clusterIP")
@@ -80,46 +158,86 @@ class OpenShiftHelper(container_helper.ContainerHelper):
 
     def _change_openshift_account(self, account="system:admin", password=None):
         """
-        Function switches to specific account inside OpenShift environment
+        Function switches to specific account inside OpenShift environment.
+        Credentials of every account are obtained just once, REST API calls and oc commands then use them
+        directly, oc login is used only when REST API is not available.
         :param account: Either user specified account or 'system:admin'
         :param password: Either user specified account
         """
+        try:
+            self._api = openshift_api.ApiClient.for_account(self.runHost, account=account, password=password)
+            return
+        except openshift_api.API_ERRORS as e:
+            self._api = None
+            self._api_failed(e)
         if password is None:
             s = self.runHost("oc login -u %s" % account, verbose=core.is_debug())
         else:
             s = self.runHost("oc login -u %s -p %s" % (account, password), verbose=core.is_debug())
 
 
+    def _get_openshift_token(self):
+        """
+        Function returns token of user account (current account), it is cached per session
+        :return: str
+        """
+        user = common.get_openshift_user()
+        if not _session_cache.get(("token", user)):
+            if self._api and self._api.token:
+                _session_cache[("token", user)] = self._api.token
+            else:
+                whoami = self._oc("whoami -t", ignore_status=True, verbose=core.is_debug())
+                _session_cache[("token", user)] = whoami.stdout.strip()
+        return _session_cache[("token", user)]
+
+    def _get_openshift_registry(self):
+        """
+        Function returns address (IP:5000) of OpenShift docker-registry, it is cached per session
+        (failed lookup is not cached)
+        :return: str
+        """
+        if "registry" not in _session_cache:
+            ip_registry = self._as_admin(self._get_openshift_ip_registry)
+            if not ip_registry:
+                raise mtfexceptions.OpenShiftExc("Unable to find IP address of OpenShift docker registry %s" %
+                                                 common.conf["openshift"]["docker_registry"])
+            _session_cache["registry"] = "%s:5000" % ip_registry
+        return _session_cache["registry"]
+
     def _register_docker_to_openshift_registry(self):
         """
-        Function pushes an OpenShift docker-registry into docker
-        Commands which are use are in this order
-        * oc whoami -t
-        * switch to OpenShift system:admin account
-        * gets an IP of OpenShift registry
-        * switch to user defined OpenShift user and password.
-        * runs docker login with token and IP:5000
+        Function pushes an image into OpenShift docker-registry
+        Steps which are done in this order
+        * gets token of user and address of OpenShift registry (cached per session)
+        * docker pull (if enabled)
+        * compares docker image ID with image in registry, push is skipped when they are same
+        * runs docker login with token (once per session)
         * tag container name
         * push container name into docker
         """
-        whoami = self.runHost("oc whoami -t", ignore_status=True, verbose=core.is_debug())
-
-        self._change_openshift_account()
+        user = common.get_openshift_user()
+        token = self._get_openshift_token()
+        registry = self._get_openshift_registry()
         if self.get_docker_pull():
             self.runHost('docker pull %s' % self.container_name)
-        openshift_ip_register = self._get_openshift_ip_registry()
-        self._change_openshift_account(account=common.get_openshift_user(),
-                                password=common.get_openshift_passwd())
-
-        docker_login = self.runHost('docker login -u {user} -p {token} {ip}:5000'.format(
-            user=common.get_openshift_user(),
-            token=whoami.stdout.strip(),
-            ip=openshift_ip_register), ignore_status=True, verbose=core.is_debug())
-        oc_path = "{ip}:5000/{project}/{name}".format(ip=openshift_ip_register,
-                                                      name=self.app_name,
-                                                      project=self.project_name)
-
-
+        repository = "{project}/{name}".format(name=self.app_name, project=self.project_name)
+        oc_path = "{registry}/{repository}".format(registry=registry, repository=repository)
+        # not via runHost, go template of docker must not be formatted by trans_dict
+        image_id = process.run("docker inspect -f '{{.Id}}' %s" % self.container_name,
+                               ignore_status=True, verbose=core.is_debug()).stdout.strip()
+        try:
+            if image_id and openshift_api.registry_image_id(registry, repository, "latest", user, token) == image_id:
+                core.print_info("Image %s is already in OpenShift registry, push skipped" % oc_path)
+                return
+        except openshift_api.API_ERRORS as e:
+            self._api_failed(e)
+        if ("login", registry, user) not in _session_cache:
+            docker_login = self.runHost('docker login -u {user} -p {token} {registry}'.format(
+                user=user,
+                token=token,
+                registry=registry), ignore_status=True, verbose=core.is_debug())
+            if docker_login.exit_status == 0:
+                _session_cache[("login", registry, user)] = True
         self.runHost('docker tag %s %s' % (self.container_name,
                                            oc_path), ignore_status=True)
         self.runHost('docker push %s' % oc_path, ignore_status=True)
@@ -130,8 +248,16 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         :return: True, application exists
                  False, application does not exist
         """
-        oc_status = self.runHost("oc get dc %s -o json" % self.app_name, ignore_status=True)
-        if int(oc_status.exit_status) == 0:
+        exists = None
+        if self._api:
+            try:
+                exists = any(dc["metadata"]["name"] == self.app_name
+                             for dc in self._api.list("dc", self._current_namespace()))
+            except openshift_api.API_ERRORS as e:
+                self._api_failed(e)
+        if exists is None:
+            exists = self._oc("get dc %s -o json" % self.app_name, ignore_status=True).exit_status == 0
+        if exists:
             core.print_info("Application already exists.")
             return True
         oc_pods = self._oc_get_output('pods')
@@ -199,8 +325,13 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         :param resource:
         :return: dict ['item'] from JSON output for specific resource
         """
+        if self._api and resource != "all":
+            try:
+                return self._api.list(resource, self._current_namespace())
+            except openshift_api.API_ERRORS as e:
+                self._api_failed(e)
         # Check status of svc/dc/is
-        oc_get = self.runHost("oc get %s -o json" % resource, ignore_status=True).stdout
+        oc_get = self._oc("get %s -o json" % resource, ignore_status=True).stdout
         oc_get = self._convert_string_to_json(oc_get)
         return oc_get
 
@@ -211,10 +342,14 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         :param name: a name in given resource
         :return: return value from oc delete command
         """
-
-        oc_delete = self.runHost("oc delete %s %s" % (resource, name),
-                                 ignore_status=True,
-                                 verbose=core.is_debug())
+        if self._api:
+            try:
+                return 0 if self._api.delete(resource, name, self._current_namespace()) else 1
+            except openshift_api.API_ERRORS as e:
+                self._api_failed(e)
+        oc_delete = self._oc("delete %s %s" % (resource, name),
+                             ignore_status=True,
+                             verbose=core.is_debug())
         return oc_delete.exit_status
 
     def _remove_apps_from_openshift_resources(self, oc_service="svc"):
@@ -230,12 +365,78 @@ class OpenShiftHelper(container_helper.ContainerHelper):
 
     def _app_remove(self):
         """
-        Function removes an application from all OpenShift resources like 'svc', 'dc', 'is'
+        Function removes an application from OpenShift environment.
+        Only project created or leased by this helper is touched, project created by it is deleted as whole
+        (server removes its content asynchronously), application objects in leased project
+        are removed by one label selector deletion.
+        """
+        if self._project_lease:
+            self._oc("delete all,%s -l app=%s --ignore-not-found -n %s" % (common.conf["openshift"]["template"],
+                                                                          self.app_name, self._project_lease[0]),
+                     ignore_status=True, verbose=core.is_debug())
+        elif self._project_created:
+            if self._oc_delete(common.conf["openshift"]["project"], self.project_name) == 0:
+                self._deleting_projects.add(self.project_name)
+                self._project_created = False
+
+    def _create_project(self):
+        """
+        Lease project from project pool or create new project for application
+        :return: bool, project is ready
+        """
+        if project_pool.get_size():
+            pool = project_pool.ProjectPool(self._oc, admin_oc=self._oc_admin)
+            self._project_lease = pool.lease()
+            if self._project_lease:
+                # project of oc configuration is not switched (oc project), it is shared by parallel tests
+                if self._oc('get project %s -o name' % self._project_lease[0], ignore_status=True,
+                            verbose=core.is_debug()).exit_status == 0:
+                    self.project_name = self._project_lease[0]
+                    self._namespace = self.project_name
+                    return True
+                # project was removed from cluster, pool is created again by next test
+                pool.invalidate()
+                self._release_project()
+        for attempt in range(3):
+            project = self._oc('new-project %s --skip-config-write' % self.project_name,
+                               ignore_status=True,
+                               verbose=core.is_debug())
+            if project.exit_status == 0:
+                self._namespace = self.project_name
+                self._project_created = True
+                return True
+            if "already exists" not in project.stderr + project.stdout:
+                break
+            self.project_name = "{project}-{random_str}".format(project=self.app_name,
+                                                                random_str=project_pool.unique_suffix())
+        return False
+
+    def _release_project(self):
         """
-        if self._app_exists():
-            # TODO get info from oc status and delete relevant svc/dc/is/pods
-            for ns in ['svc', 'dc', 'is', 'pod', common.conf["openshift"]["template"], common.conf["openshift"]["project"]]:
-                self._remove_apps_from_openshift_resources(ns)
+        Return leased project to project pool
+        """
+        if self._project_lease:
+            project_pool.ProjectPool(self._oc).release(self._project_lease)
+            self._project_lease = None
+
+    def _wait_for_project_deletion(self, project):
+        """
+        Wait until project deleted by _app_remove is removed, so that it can be created again
+        :param project: str project name
+        :return: bool, False in case of timeout
+        """
+        timeout = common.conf["openshift"]["init_wait"]
+        self._deleting_projects.discard(project)
+        if self._api:
+            try:
+                return openshift_api.wait_deleted(self._api, "project", project, timeout=timeout)
+            except openshift_api.API_ERRORS as e:
+                self._api_failed(e)
+        for x in range(0, timeout):
+            if self._oc("get project %s" % project, ignore_status=True, verbose=False).exit_status != 0:
+                return True
+            time.sleep(1)
+        return False
 
     def _create_app(self, template=None):
         """
@@ -244,7 +445,7 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         :param template: If parameter present, then create an application from template
         :return: Exit status of oc new-app.
         """
-        cmd = ["oc", "new-app"]
+        cmd = ["new-app"]
         if template is None:
             cmd.append(self.container_name)
         else:
@@ -252,8 +453,7 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         cmd.extend(["-l", "mtf_testing=true"])
         cmd.extend(["--name", self.app_name])
         core.print_debug(cmd)
-        oc_new_app = self.runHost(' '.join(cmd), ignore_status=True)
-        time.sleep(1)
+        oc_new_app = self._oc(' '.join(cmd), ignore_status=True)
         core.print_debug(oc_new_app.stdout)
         return oc_new_app.exit_status
 
@@ -267,25 +467,24 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         :return:
         """
         self._register_docker_to_openshift_registry()
-        self.runHost('oc get is')
-        oc_template_app = self.runHost('oc process -f "%s"' % self.template, verbose=core.is_debug())
+        self._oc('get is')
+        oc_template_app = self._oc('process -f "%s"' % self.template, verbose=core.is_debug())
         self._change_openshift_account()
         oc_template_create = None
         try:
-            oc_template_create = self.runHost('oc create -f %s -n %s' % (self.template,
-                                                                         self.project_name),
-                                              verbose=core.is_debug())
+            oc_template_create = self._oc('create -f %s -n %s' % (self.template,
+                                                                  self.project_name),
+                                          verbose=core.is_debug())
         except CmdError as cme:
             core.print_info('oc create -f failed with traceback %s' % cme.message)
-            self.runHost('oc status')
+            self._oc('status')
             self._oc_get_output('all')
             return False
         self._change_openshift_account(account=common.get_openshift_user(),
                                        password=common.get_openshift_passwd())
         template_name = self._get_openshift_template()
-        time.sleep(1)
         self._create_app(template=template_name)
-        self.runHost('oc status')
+        self._oc('status')
         return True
 
     def _create_app_as_s2i(self):
@@ -309,9 +508,38 @@ class OpenShiftHelper(container_helper.ContainerHelper):
 
     def _verify_pod(self):
         """
-        It verifies if an application POD is initiated and ready for testing
-        :return: False, application is not initiated during 10 seconds
+        It verifies if an application POD is initiated and ready for testing.
+        Pods and deploymentconfigs of application are watched via REST API, polling by oc
+        is used when API is not available (e.g. login without token)
+        :return: False, application is not initiated during init_wait seconds
                  True, application is initiated and ready for testing
+        :raises mtfexceptions.OpenShiftExc: container is not able to start (image pull, crash loop)
+        """
+        try:
+            client = self._api or openshift_api.ApiClient.from_oc(self.runHost)
+            return self._watch_pod(client)
+        except openshift_api.API_ERRORS as e:
+            core.print_debug("Unable to watch pods via REST API, polling by oc", e)
+        return self._poll_pod()
+
+    def _watch_pod(self, client):
+        """
+        Wait for pod of application via watch API
+        :param client: openshift_api.ApiClient
+        :return: bool
+        """
+        pod = openshift_api.wait_for_app(client, self._current_namespace(), self.app_name,
+                                         timeout=common.conf["openshift"]["init_wait"])
+        if not pod:
+            return False
+        self.pod_id = pod["metadata"]["name"]
+        self._pod_status = pod["status"]["phase"]
+        return True
+
+    def _poll_pod(self):
+        """
+        Wait for pod of application via repeated oc get pod
+        :return: bool
         """
         pod_initiated = False
         for x in range(0, common.conf["openshift"]["init_wait"]):
@@ -363,11 +591,15 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         :return: None
         """
         super(OpenShiftHelper, self).tearDown()
+        self._close_channel()
+        if common.get_openshift_in_cluster():
+            return
         try:
             self._app_remove()
         except Exception as e:
             core.print_info(e, "OpenShift application already removed")
             pass
+        self._release_project()
 
     def _get_ip_instance(self):
         """
@@ -412,16 +644,25 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         :param command: Do not use it directly (It is defined in config.yaml)
         :return: None
         """
+        if common.get_openshift_in_cluster():
+            # runner pod of mtf --in-cluster, application is deployed by mtf outside of cluster
+            self.pod_id = os.environ.get("MTF_OPENSHIFT_POD")
+            if os.environ.get("MTF_OPENSHIFT_PROJECT"):
+                # project of application, not the random one generated by this helper
+                self._namespace = self.project_name = os.environ["MTF_OPENSHIFT_PROJECT"]
+            self.ip_address = os.environ.get("GUESTIPADDR")
+            common.trans_dict['GUESTIPADDR'] = self.ip_address
+            return
         # Clean environment before running tests
         try:
             self._app_remove()
         except Exception as e:
             core.print_info(e, "OpenShift applications were removed")
             pass
-
-        project = self.runHost('oc new-project %s' % self.project_name,
-                               ignore_status=True,
-                               verbose=core.is_debug())
+        if self.project_name in self._deleting_projects:
+            # same helper was started before, its project has to be removed first
+            self._wait_for_project_deletion(self.project_name)
+        self._create_project()
         if self.template is None:
             if not self._app_exists():
             # This part is used for running an application without template or s2i
@@ -446,15 +687,19 @@ class OpenShiftHelper(container_helper.ContainerHelper):
 
         :return: None
         """
+        self._close_channel()
+        if common.get_openshift_in_cluster():
+            return
         self._change_openshift_account(account=common.get_openshift_user(),
                                        password=common.get_openshift_passwd())
-        self._oc_get_output('all')
-        if self._app_exists():
-            try:
-                self._app_remove()
-            except Exception as e:
-                core.print_info(e, "OpenShift application already removed")
-                pass
+        if core.is_debug():
+            self._oc_get_output('all')
+        try:
+            self._app_remove()
+        except Exception as e:
+            core.print_info(e, "OpenShift application already removed")
+            pass
+        self._release_project()
 
     def status(self, command="ls /"):
 
@@ -463,25 +708,190 @@ class OpenShiftHelper(container_helper.ContainerHelper):
         and is Running in OpenShift environment
 
         :param command: Do not use it directly (It is defined in config.yaml)
-        :return: bool
+        :return: avocado.process.run
 
         """
         status = False
         if self._app_exists():
             command = self.info.get('start') or command
-            return self.runHost('oc exec %s %s' % (self.pod_id, common.sanitize_cmd(command)))
+            return self.run(command)
+
+    def _channel_argv(self):
+        """
+        Return command line of shell in application pod, pod is searched again
+        when channel is reconnected (pod could be restarted by deployment)
+        :return: list
+        """
+        if self._channel and self._channel.connections:
+            self._get_pod_status()
+        argv = ["oc"]
+        if self._api:
+            argv += shlex.split(self._api.oc_options())
+        argv += ["-n", self._current_namespace()]
+        return argv + ["exec", "-i", self.pod_id, "--", "/bin/sh"]
+
+    def _close_channel(self):
+        """
+        Close persistent shell in application pod
+        """
+        if self._channel:
+            self._channel.close()
+            self._channel = None
 
     def run(self, command="ls /", **kwargs):
         """
         Run command inside OpenShift POD, all params what allows avocado are passed inside shell,ignore_status, etc.
+        Commands are executed by one long lived shell in POD (oc exec is not called for every command),
+        single oc exec is used when the shell is not usable. Command what timed out or what was interrupted
+        in the shell is not executed again, ExecChannelExc is raised.
         https://docs.openshift.com/container-platform/3.6/dev_guide/executing_remote_commands.html
 
         :param command: str
         :param kwargs: dict
         :return: avocado.process.run
         """
-        ret_val = 0
-        cmd_object = self.runHost('oc exec %s %s' % (self.pod_id, common.sanitize_cmd(command)))
-        if cmd_object.exit_status != 0:
-            ret_val = 1
-        return ret_val
+        ignore_status = kwargs.pop("ignore_status", False)
+        if self._channel is None:
+            self._channel = exec_channel.ExecChannel(self._channel_argv)
+        try:
+            # same translation as for other module types (runHost does it for oc exec fallback)
+            result = self._channel.run(common.translate_cmd(command, translation_dict=common.trans_dict),
+                                       timeout=kwargs.get("timeout"))
+            if kwargs.get("verbose", core.is_not_silent()):
+                core.print_debug("Command '%s' in pod %s: exit status %s" % (command, self.pod_id,
+                                                                             result.exit_status),
+                                 result.stdout, result.stderr)
+        except mtfexceptions.ExecChannelConnectExc as e:
+            # command was not started in channel
+            core.print_debug(e)
+            result = self._oc('exec %s %s' % (self.pod_id, common.sanitize_cmd(command)),
+                              ignore_status=True, **kwargs)
+        if result.exit_status != 0 and not ignore_status:
+            raise CmdError(command, result)
+        return result
+
+
+def test_register_skips_unchanged_image():
+    class Result(object):
+        def __init__(self, stdout=""):
+            self.stdout = stdout
+            self.exit_status = 0
+
+    commands = []
+    saved = process.run, openshift_api.registry_image_id
+    helper = OpenShiftHelper.__new__(OpenShiftHelper)
+    helper.info = {"docker_pull": "False"}
+    helper.container_name = "docker.io/modularitycontainer/memcached"
+    helper.app_name = "memcached"
+    helper.project_name = "memcached-test"
+    helper.runHost = lambda command, **kwargs: commands.append(command) or Result()
+    user = common.get_openshift_user()
+    _session_cache[("token", user)] = "token"
+    _session_cache["registry"] = "127.0.0.1:5000"
+    process.run = lambda command, **kwargs: commands.append(command) or Result("sha256:abc\n")
+    openshift_api.registry_image_id = lambda registry, repository, tag, user, token: "sha256:abc"
+    try:
+        helper._register_docker_to_openshift_registry()
+        assert commands == ["docker inspect -f '{{.Id}}' docker.io/modularitycontainer/memcached"]
+        # changed image is pushed
+        openshift_api.registry_image_id = lambda registry, repository, tag, user, token: "sha256:old"
+        helper._register_docker_to_openshift_registry()
+        assert commands[-1] == "docker push 127.0.0.1:5000/memcached-test/memcached"
+    finally:
+        process.run, openshift_api.registry_image_id = saved
+        _session_cache.clear()
+
+
+def test_registry_lookup_not_cached():
+    addresses = [None, "172.30.1.1"]
+    helper = OpenShiftHelper.__new__(OpenShiftHelper)
+    helper._as_admin = lambda function: function()
+    helper._get_openshift_ip_registry = lambda: addresses.pop(0)
+    try:
+        helper._get_openshift_registry()
+    except mtfexceptions.OpenShiftExc:
+        pass
+    else:
+        assert False
+    try:
+        assert helper._get_openshift_registry() == "172.30.1.1:5000"
+        assert helper._get_openshift_registry() == "172.30.1.1:5000"
+    finally:
+        _session_cache.clear()
+
+
+def test_run_translates_command():
+    class Result(object):
+        stdout = stderr = ""
+        exit_status = 0
+
+    class Channel(object):
+        def __init__(self, broken):
+            self.broken = broken
+
+        def run(self, command, timeout=None):
+            if self.broken:
+                raise self.broken
+            commands.append(command)
+            return Result()
+
+    commands = []
+    helper = OpenShiftHelper.__new__(OpenShiftHelper)
+    helper.pod_id = "memcached-1-abc"
+    helper.project_name = "memcached-test"
+    helper._namespace = None
+    helper._api = None
+    helper.runHost = lambda command, **kwargs: commands.append(common.translate_cmd(
+        command, translation_dict=common.trans_dict)) or Result()
+    helper._channel = Channel(None)
+    helper.run("echo {{x}} {GUESTIPADDR}", verbose=False)
+    assert commands[-1] == "echo {x} %s" % common.trans_dict["GUESTIPADDR"]
+    # fallback uses project of helper
+    helper._channel = Channel(mtfexceptions.ExecChannelConnectExc("unable to connect"))
+    helper.run("echo {{x}}", verbose=False)
+    assert commands[-1] == "oc -n memcached-test exec memcached-1-abc echo {x}"
+    # command interrupted in channel is not executed again
+    helper._channel = Channel(mtfexceptions.ExecChannelExc("Timeout of command in exec channel"))
+    try:
+        helper.run("sleep 100", verbose=False, timeout=1)
+    except mtfexceptions.ExecChannelExc:
+        pass
+    else:
+        assert False
+    assert len(commands) == 2
+
+
+def test_run_in_cluster():
+    class Result(object):
+        stdout = stderr = ""
+        exit_status = 0
+
+    class Channel(object):
+        def run(self, command, timeout=None):
+            raise mtfexceptions.ExecChannelConnectExc("unable to connect")
+
+    commands = []
+    env = {"MTF_OPENSHIFT_IN_CLUSTER": "yes", "MTF_OPENSHIFT_POD": "memcached-1-abc",
+           "MTF_OPENSHIFT_PROJECT": "memcached-app", "GUESTIPADDR": "172.30.0.1"}
+    saved = dict((key, os.environ.get(key)) for key in env), common.trans_dict.get("GUESTIPADDR")
+    os.environ.update(env)
+    try:
+        helper = OpenShiftHelper.__new__(OpenShiftHelper)
+        helper.project_name = "memcached-random"
+        helper._namespace = None
+        helper._api = None
+        helper._channel = None
+        helper.runHost = lambda command, **kwargs: commands.append(command) or Result()
+        helper.start()
+        assert helper._channel_argv() == ["oc", "-n", "memcached-app", "exec", "-i", "memcached-1-abc",
+                                        "--", "/bin/sh"]
+        helper._channel = Channel()
+        helper.run("echo ok", verbose=False)
+        assert commands[-1] == "oc -n memcached-app exec memcached-1-abc echo ok"
+    finally:
+        for key, value in saved[0].items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        common.trans_dict["GUESTIPADDR"] = saved[1]
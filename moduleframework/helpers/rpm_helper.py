@@ -22,7 +22,7 @@
 
 import os
 import warnings
-from moduleframework import common, core
+from moduleframework import common, core, pkgcache, mirrors, mtfexceptions
 
 
 class RpmHelper(common.CommonFunctions):
@@ -47,6 +47,8 @@ class RpmHelper(common.CommonFunctions):
         self.whattoinstallrpm = []
         self.bootstrappackages = []
         self.repos = []
+        # repositories actually used, the best mirrors of self.repos (see mirrors.failover)
+        self.mirror_repos = []
 
     def getURL(self):
         """
@@ -129,22 +131,33 @@ class RpmHelper(common.CommonFunctions):
 
         :return: None
         """
-        counter = 0
-        f = open(self.yumrepo, 'w')
-        for repo in self.repos:
-            counter = counter + 1
-            add = """[%s%d]
-name=%s%d
-baseurl=%s
-enabled=1
-gpgcheck=0
-
-""" % (self.component_name, counter, self.component_name, counter, repo)
-            f.write(add)
-        f.close()
-        self.install_packages()
+        pkgcache.prepare()
+        mirrors.failover(self.repos, self.__install_from, errors=(mtfexceptions.CmdExc,))
+        pkgcache.touch(self.mirror_repos)
+        pkgcache.enforce_limit()
         self.ip_address = common.trans_dict["GUESTIPADDR"]
 
+    def __install_from(self, repos):
+        """
+        Internal method, set repositories (mirrors of self.repos) and install packages from them
+
+        :param repos: list of repository URLs
+        :return: None
+        """
+        self.mirror_repos = repos
+        with open(self.yumrepo, 'w') as f:
+            f.write(pkgcache.repo_file_content(repos))
+        self.install_packages()
+
+    def get_packager_cache_options(self):
+        """
+        Return packager options to use shared package cache, it is used on host and also inside
+        nspawn containers (cache directory is bind mounted there)
+
+        :return: str
+        """
+        return pkgcache.packager_options(self.get_packager(), self.mirror_repos or self.repos)
+
     def copyTo(self, src, dest):
         """
         Copy file from one location (host) to another one to (module)
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Shared HTTP client of MTF.
+
+All remote fetches use one keep-alive connection pool, number of parallel requests to one host
+is limited (http.per_host in MTF config). Cached fetches store response bodies to
+<http.cache_dir>/<hash of URL> together with ETag and Last-Modified headers, cached copy
+is revalidated by conditional request (304 Not Modified is just local hit) and it is used
+without revalidation while it is younger than http.fresh seconds. When server is not reachable,
+stale cached copy is used. Local paths and file:// URLs are read directly.
+"""
+
+import os
+import json
+import time
+import shutil
+import urllib
+import hashlib
+import tempfile
+import threading
+import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+import core
+import common
+
+DEFAULT_CACHE_DIR = "/var/cache/mtf/http"
+USER_CACHE_DIR = "~/.cache/mtf/http"
+DEFAULT_PER_HOST = 4
+DEFAULT_FRESH = 60
+DEFAULT_TIMEOUT = 60
+POOL_SIZE = 16
+CHUNK = 1024 * 1024
+_lock = threading.Lock()
+_session = []
+_host_limits = {}
+_cache_dir = []
+stats = {"hits": 0, "revalidated": 0, "downloaded": 0}
+
+
+def get_http_conf():
+    """
+    Return http section of MTF config
+
+    :return: dict
+    """
+    return common.conf.get("http") or {}
+
+
+def get_cache_dir():
+    """
+    Return directory of cached responses, per user directory (~/.cache/mtf/http) is used
+    when configured one is not writable (unprivileged user), temporary directory as last resort
+
+    :return: str
+    """
+    with _lock:
+        if not _cache_dir:
+            for cachedir in [get_http_conf().get("cache_dir") or DEFAULT_CACHE_DIR, USER_CACHE_DIR]:
+                cachedir = os.path.expanduser(cachedir)
+                try:
+                    if not os.path.isdir(cachedir):
+                        os.makedirs(cachedir)
+                except OSError:
+                    pass
+                if os.access(cachedir, os.W_OK | os.X_OK):
+                    break
+                core.print_debug("HTTP cache directory %s is not writable" % cachedir)
+            else:
+                cachedir = tempfile.mkdtemp(prefix="mtf_http_")
+            _cache_dir.append(cachedir)
+        return _cache_dir[0]
+
+
+def get_session():
+    """
+    Return HTTP session shared by whole process (keep-alive connection pool)
+
+    :return: requests.Session
+    """
+    with _lock:
+        if not _session:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session.append(session)
+        return _session[0]
+
+
+def _host_limit(url):
+    """
+    Internal function, return semaphore limiting parallel requests to host of URL
+
+    :return: threading.BoundedSemaphore
+    """
+    host = urlparse.urlparse(url).netloc
+    with _lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(
+                int(get_http_conf().get("per_host") or DEFAULT_PER_HOST))
+        return _host_limits[host]
+
+
+def local_path(url):
+    """
+    Return local file of URL (file:// or path), None for remote URL
+
+    :param url: str
+    :return: str or None
+    """
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == "file":
+        return urllib.url2pathname(parsed.path)
+    if not parsed.scheme:
+        return url
+    return None
+
+
+class _HostSlot(object):
+    """
+    Internal class, slot of host held by streamed response. It is released once, by close of response,
+    by end of its body or at latest when response is garbage collected.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.held = True
+
+    def release(self):
+        with self.lock:
+            if not self.held:
+                return
+            self.held = False
+        self.limit.release()
+
+    def __del__(self):
+        self.release()
+
+
+class _SlotResponse(requests.Response):
+    """
+    Internal class, streamed response releasing slot of host
+    """
+
+    def close(self):
+        try:
+            super(_SlotResponse, self).close()
+        finally:
+            self.slot.release()
+
+    def iter_content(self, *args, **kwargs):
+        for chunk in super(_SlotResponse, self).iter_content(*args, **kwargs):
+            yield chunk
+        self.slot.release()
+
+
+def request(method, url, **kwargs):
+    """
+    Send request through shared session, parallel requests to one host are limited.
+    Response body is read before the host slot is released unless stream=True is passed,
+    in that case the slot is held until caller closes the response or reads whole body.
+
+    :param method: str HTTP method
+    :param url: str
+    :param kwargs: arguments of requests.Session.request
+    :return: requests.Response
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    limit = _host_limit(url)
+    limit.acquire()
+    try:
+        response = get_session().request(method, url, **kwargs)
+        if not kwargs.get("stream"):
+            response.content
+    except BaseException:
+        limit.release()
+        raise
+    if not kwargs.get("stream"):
+        limit.release()
+        return response
+    # no reference cycle, so that slot of dropped response is released immediately
+    response.__class__ = _SlotResponse
+    response.slot = _HostSlot(limit)
+    return response
+
+
+class StreamedResponse(object):
+    """
+    File like object of streamed response body, host slot of request is released by close
+    or when whole body is read
+    """
+
+    def __init__(self, response):
+        self.response = response
+        response.raw.decode_content = True
+
+    def read(self, size=-1):
+        data = self.response.raw.read(size)
+        if not data and size != 0:
+            self.close()
+        return data
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _cache_paths(url, cachedir=None):
+    key = hashlib.sha1(url).hexdigest()
+    cachedir = cachedir or get_cache_dir()
+    return os.path.join(cachedir, key), os.path.join(cachedir, "%s.json" % key)
+
+
+def fetch(url, cachedir=None, fresh=None):
+    """
+    Return local file with content of URL, remote content is cached and revalidated
+
+    :param url: str
+    :param cachedir: str, default http.cache_dir from MTF config
+    :param fresh: int seconds, cached copy is used without revalidation while it is younger
+    :return: str path
+    :raises IOError: URL is not available and it is not cached (requests.RequestException is IOError)
+    """
+    path = local_path(url)
+    if path is not None:
+        if not os.path.exists(path):
+            raise IOError("File %s does not exist" % path)
+        return path
+    fresh = int(get_http_conf().get("fresh", DEFAULT_FRESH) if fresh is None else fresh)
+    bodyfile, metafile = _cache_paths(url, cachedir)
+    meta = {}
+    if os.path.exists(bodyfile):
+        try:
+            with open(metafile) as openfile:
+                meta = json.load(openfile)
+        except (IOError, ValueError):
+            meta = {}
+    if meta and time.time() - meta.get("checked", 0) < fresh:
+        stats["hits"] += 1
+        return bodyfile
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        response = request("GET", url, headers=headers, stream=True)
+    except requests.RequestException as e:
+        if meta:
+            core.print_debug("Unable to revalidate %s, using cached copy" % url, e)
+            return bodyfile
+        raise
+    try:
+        if response.status_code == 304 and meta:
+            stats["revalidated"] += 1
+        else:
+            response.raise_for_status()
+            if not os.path.isdir(os.path.dirname(bodyfile)):
+                os.makedirs(os.path.dirname(bodyfile))
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(bodyfile), prefix=".download")
+            with os.fdopen(fd, "wb") as openfile:
+                for chunk in response.iter_content(CHUNK):
+                    openfile.write(chunk)
+            os.rename(tmpname, bodyfile)
+            meta = {"url": url, "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")}
+            stats["downloaded"] += 1
+    except OSError as e:
+        # OSError is not IOError on python 2, callers expect IOError
+        raise IOError("Unable to store %s to cache %s: %s" % (url, os.path.dirname(bodyfile), e))
+    finally:
+        response.close()
+    meta["checked"] = time.time()
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(metafile), prefix=".meta")
+        with os.fdopen(fd, "w") as openfile:
+            json.dump(meta, openfile)
+        os.rename(tmpname, metafile)
+    except (IOError, OSError) as e:
+        core.print_debug("Unable to store cache metadata of %s" % url, e)
+    return bodyfile
+
+
+def open_url(url, cache=True):
+    """
+    Open URL for reading
+
+    :param url: str
+    :param cache: bool, use response cache (see fetch), otherwise response is streamed
+    :return: file like object
+    """
+    if cache or local_path(url) is not None:
+        return open(fetch(url), "rb")
+    response = request("GET", url, stream=True)
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        response.close()
+        raise
+    return StreamedResponse(response)
+
+
+def read(url, cache=True):
+    """
+    Return content of URL
+
+    :param url: str
+    :param cache: bool, use response cache (see fetch)
+    :return: str
+    """
+    if cache or local_path(url) is not None:
+        with open(fetch(url), "rb") as openfile:
+            return openfile.read()
+    response = request("GET", url)
+    response.raise_for_status()
+    return response.content
+
+
+def download(url, dest):
+    """
+    Store content of URL to file (through response cache)
+
+    :param url: str
+    :param dest: str destination file
+    :return: None
+    """
+    shutil.copyfile(fetch(url), dest)
+
+
+def test_fetch():
+    import BaseHTTPServer
+    import SocketServer
+
+    requested = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.headers.getheader("If-None-Match"))
+            if self.headers.getheader("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", "7")
+            self.end_headers()
+            self.wfile.write("content")
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    cachedir = tempfile.mkdtemp()
+    try:
+        url = "http://127.0.0.1:%d/repodata/repomd.xml" % server.server_address[1]
+        assert open(fetch(url, cachedir, fresh=0)).read() == "content"
+        # conditional request, 304
+        assert open(fetch(url, cachedir, fresh=0)).read() == "content"
+        assert requested == [None, '"v1"']
+        # fresh copy, no request
+        fetch(url, cachedir, fresh=60)
+        assert len(requested) == 2
+        # streamed response holds slot of host until it is closed
+        limit = _host_limit(url)
+        with open_url(url, cache=False) as streamed:
+            slots = 0
+            while limit.acquire(False):
+                slots += 1
+            for x in range(slots):
+                limit.release()
+            assert streamed.read() == "content"
+        assert slots == int(get_http_conf().get("per_host") or DEFAULT_PER_HOST) - 1
+        # slot is released at the end of body and when response is dropped, without close
+        for x in range(slots + 2):
+            streamed = open_url(url, cache=False)
+            assert streamed.read() == "content" and streamed.read() == ""
+            request("GET", url, stream=True).iter_content(CHUNK)
+            assert list(request("GET", url, stream=True).iter_content(CHUNK)) == ["content"]
+        server.shutdown()
+        server.server_close()
+        # server is gone, stale copy is used
+        assert open(fetch(url, cachedir, fresh=0)).read() == "content"
+        localfile = os.path.join(cachedir, "local.txt")
+        open(localfile, "w").write("local")
+        assert read("file://%s" % localfile) == "local"
+        # not writable cache directory, per user directory is used
+        saved = USER_CACHE_DIR, common.conf.get("http")
+        globals()["USER_CACHE_DIR"] = os.path.join(cachedir, "user")
+        common.conf["http"] = {"cache_dir": os.path.join(localfile, "http")}
+        del _cache_dir[:]
+        try:
+            assert get_cache_dir() == os.path.join(cachedir, "user")
+        finally:
+            globals()["USER_CACHE_DIR"], common.conf["http"] = saved
+            del _cache_dir[:]
+    finally:
+        shutil.rmtree(cachedir)
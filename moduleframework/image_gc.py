@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Garbage collector of nspawn images, leftover chroot directories, local koji repositories
+and docker images pulled by MTF.
+
+Every test holds shared lock on <path>.inuse of all directories it uses, mtime of this file
+is time of last use. Collector skips locked items and evicts least recently used items
+until their size fits to disk quota (gc section of MTF config).
+"""
+
+from __future__ import print_function
+import os
+import re
+import glob
+import json
+import time
+import fcntl
+import shutil
+import tempfile
+from distutils.spawn import find_executable
+from avocado.utils import process
+
+import core
+import common
+import rpmstore
+
+DEFAULT_QUOTA = 20480
+DEFAULT_STATEFILE = "/var/cache/mtf/docker_images.json"
+# snapshots of not reused tests are named chroot_<name>_<time>
+LEFTOVER_RE = re.compile(r"_\d+\.\d+$")
+
+
+def get_gc_conf():
+    """
+    Return gc section of MTF config
+
+    :return: dict
+    """
+    return common.conf.get("gc") or {}
+
+
+def get_quota():
+    """
+    Return disk quota for images, local repositories and docker images in MB
+
+    :return: int
+    """
+    return int(get_gc_conf().get("quota", DEFAULT_QUOTA))
+
+
+def get_statefile():
+    """
+    Return file with docker images pulled by MTF
+
+    :return: str
+    """
+    return get_gc_conf().get("docker_statefile") or DEFAULT_STATEFILE
+
+
+def _lockfile(path):
+    return "%s.inuse" % path.rstrip("/")
+
+
+def _lock_file(lockname, operation):
+    """
+    Internal function, open and lock file. Lock file removed (with its directory) by garbage collector
+    while waiting for lock is created and locked again.
+
+    :return: open lock file or None when non-blocking lock is not available
+    """
+    while True:
+        handle = open(lockname, "a")
+        try:
+            fcntl.flock(handle, operation)
+        except IOError:
+            handle.close()
+            return None
+        try:
+            if os.fstat(handle.fileno()).st_ino == os.stat(lockname).st_ino:
+                return handle
+        except OSError:
+            pass
+        handle.close()
+
+
+def use(paths):
+    """
+    Mark directories as used by running test, they are protected against garbage collector
+    until release() is called or process ends
+
+    :param paths: list of directories (images, snapshots, local repositories)
+    :return: list of open lock files, pass it to release()
+    """
+    handles = []
+    for path in paths:
+        if not os.path.isdir(os.path.dirname(path.rstrip("/"))):
+            continue
+        try:
+            handle = _lock_file(_lockfile(path), fcntl.LOCK_SH)
+        except IOError:
+            # directory is not writable (unprivileged user), garbage collector is not able to remove it anyway
+            continue
+        os.utime(_lockfile(path), None)
+        handles.append(handle)
+    return handles
+
+
+def use_image(image):
+    """
+    Mark nspawn image and all its lower images as used
+
+    :param image: nspawn.Image or nspawn.LayeredImage
+    :return: list of open lock files
+    """
+    basedir = os.path.dirname(image.location)
+    lowers = [os.path.join(basedir, x) for x in getattr(image, "lower_images", [])]
+    return use([image.location] + lowers)
+
+
+def touch(paths):
+    """
+    Update time of last use of directories without holding them
+
+    :param paths: list of directories
+    :return: None
+    """
+    release(use(paths))
+
+
+def release(handles):
+    """
+    Release locks taken by use()
+
+    :param handles: list of open lock files
+    :return: None
+    """
+    for handle in handles:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+
+def _try_lock(path):
+    """
+    Internal function, take exclusive locks (in use and build lock) without waiting
+
+    :return: list of open lock files or None when item is in use
+    """
+    handles = []
+    for lockname in [_lockfile(path), "%s.lock" % path]:
+        handle = _lock_file(lockname, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if handle is None:
+            release(handles)
+            return None
+        handles.append(handle)
+    return handles
+
+
+def last_used(path):
+    """
+    Return time of last use of directory
+
+    :param path: str
+    :return: float
+    """
+    for candidate in [_lockfile(path), "%s.json" % path, path]:
+        if os.path.exists(candidate):
+            return os.stat(candidate).st_mtime
+    return 0
+
+
+def dir_size(path):
+    """
+    Return disk usage of directory in bytes, mounted filesystems inside are not counted
+
+    :param path: str
+    :return: int
+    """
+    out = process.run("du -sxb %s" % path, ignore_status=True, verbose=core.is_debug())
+    try:
+        return int(out.stdout.split()[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+def _mounts_under(path):
+    """
+    Internal function, return mount points inside directory, deepest first
+
+    :return: list
+    """
+    output = []
+    if os.path.exists("/proc/mounts"):
+        with open("/proc/mounts") as mounts:
+            for line in mounts:
+                mountpoint = line.split()[1]
+                if mountpoint.startswith(path.rstrip("/") + "/"):
+                    output.append(mountpoint)
+    return sorted(output, reverse=True)
+
+
+def list_items(basedir=None):
+    """
+    Return items in nspawn base directory managed by garbage collector
+
+    :param basedir: directory with images, default is nspawn.basedir from MTF config
+    :return: list of dicts with keys path, kind (image, leftover, snapshot, localrepo), lowers, last_used
+    """
+    basedir = basedir or common.conf["nspawn"]["basedir"]
+    output = []
+    for path in glob.glob(os.path.join(basedir, "chroot_*")) + glob.glob(os.path.join(basedir, "localrepo_*")):
+        if not os.path.isdir(path) or os.path.islink(path):
+            continue
+        lowers = []
+        if os.path.basename(path).startswith("localrepo_"):
+            kind = "localrepo"
+        elif os.path.exists("%s.json" % path):
+            kind = "image"
+            with open("%s.json" % path) as metafile:
+                lowers = json.load(metafile).get("lowers", [])
+        elif LEFTOVER_RE.search(path):
+            kind = "leftover"
+        else:
+            kind = "snapshot"
+        output.append({"path": path, "kind": kind, "lowers": lowers, "last_used": last_used(path)})
+    return output
+
+
+def remove_dir(path):
+    """
+    Remove directory of image or repository with its metadata and lock files, mounted filesystems
+    are umounted first. Caller holds exclusive locks of directory (see _try_lock).
+
+    :param path: str
+    :return: bool True when removed
+    """
+    for mountpoint in _mounts_under(path):
+        if process.run("umount %s" % mountpoint, ignore_status=True, verbose=core.is_debug()).exit_status:
+            core.print_info("GC: unable to umount %s, %s is not removed" % (mountpoint, path))
+            return False
+    shutil.rmtree(path, ignore_errors=True)
+    if os.path.exists(path):
+        return False
+    for filename in ["%s.json" % path, _lockfile(path), "%s.lock" % path]:
+        if os.path.exists(filename):
+            os.remove(filename)
+    return True
+
+
+def is_enabled():
+    """
+    Return True when garbage collection is enabled (gc.auto in MTF config)
+
+    :return: bool
+    """
+    return bool(get_gc_conf().get("auto", True))
+
+
+def mark_docker_used(name, statefile=None):
+    """
+    Store docker image pulled (or imported) by MTF with time of use.
+    Failures (e.g. not writable state file of unprivileged user) are just reported in debug mode.
+
+    :param name: docker image name
+    :param statefile: file with docker images, default from MTF config
+    :return: None
+    """
+    statefile = statefile or get_statefile()
+    try:
+        if not os.path.exists(os.path.dirname(statefile)):
+            os.makedirs(os.path.dirname(statefile))
+        with open(statefile, "a+") as openfile:
+            fcntl.flock(openfile, fcntl.LOCK_EX)
+            openfile.seek(0)
+            content = openfile.read()
+            images = json.loads(content) if content else {}
+            images[name] = time.time()
+            openfile.seek(0)
+            openfile.truncate()
+            json.dump(images, openfile, indent=2)
+    except (IOError, OSError, ValueError) as e:
+        core.print_debug("GC: unable to store use of docker image %s to %s" % (name, statefile), e)
+
+
+def _docker_items(statefile=None):
+    """
+    Internal function, return docker images pulled by MTF, which still exist
+
+    :return: list of dicts
+    """
+    statefile = statefile or get_statefile()
+    if not find_executable("docker") or not os.path.exists(statefile):
+        return []
+    with open(statefile) as openfile:
+        images = json.load(openfile)
+    output = []
+    for name, used in images.items():
+        out = process.run("docker image inspect -f '{{.Size}}' %s" % name, ignore_status=True,
+                          verbose=core.is_debug())
+        if out.exit_status == 0:
+            output.append({"path": name, "kind": "docker", "lowers": [], "last_used": used,
+                           "size": int(out.stdout.strip() or 0)})
+    return output
+
+
+def _remove_docker(name, statefile=None):
+    """
+    Internal function, remove docker image if there is no container based on it
+
+    :return: bool True when removed
+    """
+    statefile = statefile or get_statefile()
+    if process.run("docker ps -a -q --filter ancestor=%s" % name, ignore_status=True,
+                   verbose=core.is_debug()).stdout.strip():
+        return False
+    if process.run("docker rmi %s" % name, ignore_status=True, verbose=core.is_debug()).exit_status:
+        return False
+    with open(statefile, "a+") as openfile:
+        fcntl.flock(openfile, fcntl.LOCK_EX)
+        openfile.seek(0)
+        images = json.loads(openfile.read() or "{}")
+        images.pop(name, None)
+        openfile.seek(0)
+        openfile.truncate()
+        json.dump(images, openfile, indent=2)
+    return True
+
+
+def collect(quota=None, basedir=None, statefile=None, dry_run=False):
+    """
+    Run garbage collection. Leftover snapshots of finished tests are removed always,
+    other items are evicted in LRU order until their size fits to quota.
+    Items in use and images what are lower layers of another images are skipped.
+    RPMs in RPM store not linked to any local repository are removed at the end.
+
+    :param quota: int size in MB, default from config, 0 means remove everything what is not in use
+    :param basedir: nspawn base directory, default from config
+    :param statefile: file with docker images pulled by MTF
+    :param dry_run: bool, just print what would be removed
+    :return: list of removed items (directories or docker image names)
+    """
+    quota = get_quota() if quota is None else quota
+    items = list_items(basedir)
+    for item in items:
+        item["size"] = dir_size(item["path"])
+    items += _docker_items(statefile)
+    total = sum([x["size"] for x in items])
+    removed = []
+    remaining = items[:]
+    skipped = []
+    progress = True
+    # images are freed from top layer down, so repeat until nothing more can be removed
+    while progress:
+        progress = False
+        for item in sorted(remaining, key=lambda x: (x["kind"] != "leftover", x["last_used"], x["path"])):
+            if item["kind"] != "leftover" and total <= quota * 1024 * 1024:
+                break
+            if item["path"] in skipped:
+                continue
+            name = os.path.basename(item["path"])
+            if [x for x in remaining if name in x["lowers"]]:
+                core.print_debug("GC: %s is lower layer of another image, skipped" % item["path"])
+                continue
+            if item["kind"] == "docker":
+                success = dry_run or _remove_docker(item["path"], statefile)
+            else:
+                locks = _try_lock(item["path"])
+                if locks is None:
+                    core.print_debug("GC: %s is in use, skipped" % item["path"])
+                    skipped.append(item["path"])
+                    continue
+                try:
+                    success = dry_run or remove_dir(item["path"])
+                finally:
+                    release(locks)
+            if not success:
+                skipped.append(item["path"])
+                continue
+            core.print_info("GC: %s %s (%d MB, last used %s)" % ("would remove" if dry_run else "removed",
+                                                                 item["path"], item["size"] / 1024 / 1024,
+                                                                 time.ctime(item["last_used"])))
+            total -= item["size"]
+            removed.append(item["path"])
+            remaining.remove(item)
+            progress = True
+            break
+    # RPMs of removed local repositories stay in RPM store until nothing links them
+    stale = rpmstore.prune(basedir, dry_run=dry_run)
+    if stale:
+        core.print_info("GC: %s %d RPMs not used by any local repository" % (
+            "would remove" if dry_run else "removed", len(stale)))
+    return removed
+
+
+def auto_collect():
+    """
+    Garbage collection pass at start of test session, enabled by gc.auto in MTF config.
+    Failures are reported but they never break test session.
+
+    :return: list of removed items
+    """
+    if not is_enabled():
+        return []
+    try:
+        return collect()
+    except (OSError, IOError, ValueError, process.CmdError) as e:
+        core.print_info("GC: garbage collection failed", e)
+        return []
+
+
+def test_collect():
+    basedir = tempfile.mkdtemp()
+    statefile = os.path.join(basedir, "docker.json")
+    for counter, name in enumerate(["chroot_base_image_a", "chroot_mod_image_b", "chroot_mod_1.5",
+                                    "localrepo_mod_1_2", "chroot_other_image_c"]):
+        os.makedirs(os.path.join(basedir, name))
+        with open(os.path.join(basedir, name, "data"), "w") as datafile:
+            datafile.write("x" * 1024 * 1024)
+        os.utime(os.path.join(basedir, name), (counter, counter))
+    for name, lowers in [("chroot_base_image_a", []), ("chroot_mod_image_b", ["chroot_base_image_a"]),
+                         ("chroot_other_image_c", [])]:
+        with open(os.path.join(basedir, "%s.json" % name), "w") as metafile:
+            json.dump({"name": name, "lowers": lowers}, metafile)
+        os.utime(os.path.join(basedir, "%s.json" % name), (1, 1))
+    kinds = dict([(os.path.basename(x["path"]), x["kind"]) for x in list_items(basedir)])
+    assert kinds["chroot_mod_1.5"] == "leftover"
+    assert kinds["localrepo_mod_1_2"] == "localrepo"
+    handles = use([os.path.join(basedir, "chroot_other_image_c")])
+    # leftover is removed always, than least recently used items until quota is reached
+    removed = collect(quota=3, basedir=basedir, statefile=statefile)
+    assert [os.path.basename(x) for x in removed] == ["chroot_mod_1.5", "chroot_mod_image_b",
+                                                      "chroot_base_image_a"]
+    # image in use is never removed
+    collect(quota=0, basedir=basedir, statefile=statefile)
+    assert os.path.exists(os.path.join(basedir, "chroot_other_image_c"))
+    assert not os.path.exists(os.path.join(basedir, "localrepo_mod_1_2"))
+    assert sorted(x for x in os.listdir(basedir) if x != "docker.json") == [
+        "chroot_other_image_c", "chroot_other_image_c.inuse", "chroot_other_image_c.json"]
+    release(handles)
+    shutil.rmtree(basedir)
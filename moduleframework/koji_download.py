@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Parallel and resumable download of packages tagged in koji.
+
+Builds of all tags and their RPMs are listed by one koji multicall, RPMs are downloaded
+by pool of workers (generic.download_workers in MTF config). Every RPM is downloaded to
+<name>.part file (continued by HTTP range request after interruption), verified by rpm -K
+and by payload hash from koji and stored to content addressed store (see rpmstore), destination
+directory gets hardlinks. RPMs already present in store (e.g. downloaded for other version of module)
+are not downloaded nor verified again.
+"""
+
+import os
+import time
+import fcntl
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+import requests
+from avocado.utils import process
+
+import core
+import common
+import mtfexceptions
+import rpmstore
+import httpclient
+
+DEFAULT_WORKERS = 4
+CHUNK = 1024 * 1024
+
+
+def get_workers():
+    """
+    Return number of parallel downloads
+
+    :return: int
+    """
+    return int(common.conf["generic"].get("download_workers") or DEFAULT_WORKERS)
+
+
+def fetch(url, dest, size=None, timeout=60):
+    """
+    Download URL to file, partially downloaded file (<dest>.part) is continued
+
+    :param url: str
+    :param dest: str destination file
+    :param size: int expected size, download is restarted in case it does not match
+    :param timeout: int socket timeout
+    :return: int number of downloaded bytes
+    """
+    part = dest + ".part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if size is not None and offset > size:
+        os.remove(part)
+        offset = 0
+    downloaded = 0
+    if size is None or offset < size:
+        headers = {"Range": "bytes=%d-" % offset} if offset else {}
+        response = httpclient.request("GET", url, headers=headers, stream=True, timeout=timeout)
+        try:
+            if response.status_code == 416:
+                # part file is broken, start again (host slot of this response is released first)
+                response.close()
+                os.remove(part)
+                return fetch(url, dest, size, timeout)
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                # server does not support range requests
+                offset = 0
+            with open(part, "ab" if offset else "wb") as openfile:
+                for data in response.iter_content(CHUNK):
+                    openfile.write(data)
+                    downloaded += len(data)
+        finally:
+            response.close()
+    if size is not None and os.path.getsize(part) != size:
+        raise IOError("Size of %s is %d, expected %d" % (part, os.path.getsize(part), size))
+    os.rename(part, dest)
+    return downloaded
+
+
+class KojiDownloader(object):
+    """
+    Download RPMs of koji tags for given architectures
+    """
+
+    def __init__(self, dirname, arches=None, workers=None, profile="koji", basedir=None):
+        """
+
+        :param dirname: str destination directory
+        :param arches: list of architectures, default is generic.arch from MTF config and noarch
+        :param workers: int number of parallel downloads
+        :param profile: str koji profile (client configuration)
+        :param basedir: str nspawn base directory with RPM store, default from MTF config
+        :raises ImportError: python koji library is not installed
+        """
+        import koji
+        options = koji.read_config(profile)
+        self.session = koji.ClientSession(options["server"])
+        self.pathinfo = koji.PathInfo(topdir=options["topurl"])
+        self.dirname = dirname
+        self.arches = arches or [common.conf["generic"]["arch"], "noarch"]
+        self.workers = workers or get_workers()
+        self.basedir = basedir
+        self.lock = threading.Lock()
+        self.stats = {"downloaded": 0, "present": 0, "bytes": 0}
+        self.progress = {}
+
+    def list_rpms(self, tags):
+        """
+        Return RPMs of all builds tagged by tags, koji is contacted twice (multicall)
+
+        :param tags: list of koji tags
+        :return: list of tuples (build, rpm)
+        """
+        self.session.multicall = True
+        for tag in tags:
+            self.session.listTagged(tag)
+        builds = {}
+        for result in self.session.multiCall(strict=True):
+            for build in result[0]:
+                builds[build["build_id"]] = build
+        self.session.multicall = True
+        for build_id in builds:
+            self.session.listRPMs(buildID=build_id, arches=self.arches)
+        jobs = []
+        for build_id, result in zip(builds.keys(), self.session.multiCall(strict=True)):
+            jobs += [(builds[build_id], rpm) for rpm in result[0]]
+            self.progress[builds[build_id]["nvr"]] = len(result[0])
+        return jobs
+
+    def _verify(self, dest, rpm):
+        """
+        Internal method, check integrity of RPM and compare its payload hash (SIGMD5) with koji
+
+        :param dest: str RPM file
+        :param rpm: dict RPM info from koji
+        :return: bool
+        """
+        check = process.run("rpm -K --nosignature {0} >/dev/null && rpm -qp --nosignature --qf '%{{SIGMD5}}' {0}".format(
+            dest), shell=True, ignore_status=True, verbose=False)
+        return check.exit_status == 0 and check.stdout.strip() == rpm["payloadhash"]
+
+    def _download(self, job):
+        """
+        Internal method, download and verify one RPM to store and link it to destination directory,
+        it is called by workers. Store directory of RPM is locked, so that parallel sessions do not download it twice.
+
+        :param job: tuple (build, rpm)
+        :return: None
+        """
+        build, rpm = job
+        relpath = self.pathinfo.rpm(rpm)
+        filename = os.path.basename(relpath)
+        dest = os.path.join(self.dirname, filename)
+        stored = rpmstore.store_path(rpm["payloadhash"], filename, self.basedir)
+        if not os.path.isdir(os.path.dirname(stored)):
+            try:
+                os.makedirs(os.path.dirname(stored))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(stored)):
+                    raise
+        downloaded = None
+        with open(os.path.join(os.path.dirname(stored), ".lock"), "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if os.path.exists(stored):
+                pass
+            elif os.path.exists(dest) and self._verify(dest, rpm):
+                # RPM downloaded before the store existed
+                rpmstore.adopt(dest, rpm["payloadhash"], self.basedir)
+            else:
+                downloaded = self._fetch_verified("%s/%s" % (self.pathinfo.build(build), relpath),
+                                                  stored + ".download", rpm)
+                os.rename(stored + ".download", stored)
+            # linked under lock, so that rpmstore.prune does not remove it meanwhile
+            rpmstore.link(stored, dest)
+        with self.lock:
+            if downloaded is None:
+                self.stats["present"] += 1
+            else:
+                self.stats["downloaded"] += 1
+                self.stats["bytes"] += downloaded
+            self.progress[build["nvr"]] -= 1
+            if not self.progress[build["nvr"]]:
+                done = len([x for x in self.progress.values() if not x])
+                core.print_info("DOWNLOADED [%d/%d] %s" % (done, len(self.progress), build["nvr"]))
+
+    def _fetch_verified(self, url, dest, rpm):
+        """
+        Internal method, download RPM with retries until it is verified
+
+        :param url: str
+        :param dest: str destination file
+        :param rpm: dict RPM info from koji
+        :return: int number of downloaded bytes
+        """
+        attempts = common.conf["generic"]["retrycount"] * 10
+        for attempt in range(attempts):
+            try:
+                downloaded = fetch(url, dest, rpm.get("size"))
+                if self._verify(dest, rpm):
+                    return downloaded
+                os.remove(dest)
+                core.print_debug("Checksum of %s does not match, downloading again" % url)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    raise mtfexceptions.KojiExc("UNABLE TO DOWNLOAD package (KOJI issue, BAD):", url)
+                core.print_debug("Download of %s failed" % url, e)
+            except (IOError, OSError) as e:
+                core.print_debug("Download of %s failed" % url, e)
+            time.sleep(min(common.conf["generic"]["retrytimeout"], 2 ** attempt))
+        raise mtfexceptions.KojiExc("RETRY: Unable to fetch package from koji after %d attempts" % attempts, url)
+
+    def download(self, tags):
+        """
+        Download RPMs of tags by pool of workers
+
+        :param tags: list of koji tags
+        :return: dict with statistics (downloaded, present, bytes, seconds)
+        """
+        started = time.time()
+        jobs = self.list_rpms(tags)
+        core.print_info("DOWNLOADING %d packages of %d builds by %d workers" %
+                        (len(jobs), len(self.progress), self.workers))
+        pool = ThreadPool(self.workers)
+        try:
+            # map_async().get() keeps main thread interruptible
+            pool.map_async(self._download, jobs, chunksize=1).get(timeout=3600 * 24)
+        finally:
+            pool.terminate()
+        self.stats["seconds"] = time.time() - started
+        core.print_info("DOWNLOADING finished: %d packages downloaded (%.1f MB, %.1f MB/s), %d already present" % (
+            self.stats["downloaded"], self.stats["bytes"] / 1024.0 / 1024,
+            self.stats["bytes"] / 1024.0 / 1024 / max(self.stats["seconds"], 0.001), self.stats["present"]))
+        return self.stats
+
+
+def test_fetch_resume():
+    import shutil
+    import BaseHTTPServer
+    import SocketServer
+
+    content = os.urandom(3 * CHUNK + 123)
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            offset = int(self.headers.getheader("Range", "bytes=0-")[6:-1])
+            self.send_response(206 if offset else 200)
+            self.end_headers()
+            self.wfile.write(content[offset:])
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    dirname = tempfile.mkdtemp()
+    try:
+        dest = os.path.join(dirname, "package.rpm")
+        # interrupted download
+        with open(dest + ".part", "wb") as openfile:
+            openfile.write(content[:CHUNK])
+        url = "http://127.0.0.1:%d/package.rpm" % server.server_address[1]
+        assert fetch(url, dest, len(content)) == len(content) - CHUNK
+        assert open(dest, "rb").read() == content
+        assert not os.path.exists(dest + ".part")
+    finally:
+        shutil.rmtree(dirname)
+        server.shutdown()
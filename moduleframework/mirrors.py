@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Selection of repository mirrors.
+
+Candidate mirrors of repository are defined in mirrors section of MTF config, by prefixes
+(repository URL starting with prefix is also available under every listed prefix) or by metalink
+of exact repository URL. Candidates are probed concurrently for repodata/repomd.xml, mirrors with
+freshest metadata (same checksum as metalink, or newest revision) are ordered by latency,
+stale mirrors follow them. Packages are installed from the best mirror and installation fails over
+to next mirror when it fails (see failover). Repositories without configured mirrors are used directly.
+"""
+
+import time
+import hashlib
+import threading
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
+import requests
+
+import core
+import common
+import httpclient
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_WORKERS = 8
+REPOMD = "repodata/repomd.xml"
+_lock = threading.Lock()
+# repository URL -> ordered list of mirrors, mirrors are selected once per process
+_ranked = {}
+
+
+def get_mirror_conf():
+    """
+    Return mirrors section of MTF config
+
+    :return: dict
+    """
+    return common.conf.get("mirrors") or {}
+
+
+def _localname(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def parse_metalink(content):
+    """
+    Return mirrors and expected checksum of repomd.xml from metalink
+
+    :param content: str metalink XML
+    :return: tuple (list of repository URLs ordered by preference, sha256 checksum or None)
+    """
+    root = ElementTree.fromstring(content)
+    checksum = None
+    urls = []
+    for element in root.iter():
+        name = _localname(element)
+        if name == "hash" and element.get("type") == "sha256" and checksum is None:
+            checksum = element.text.strip()
+        elif name == "url" and element.get("protocol") in ["http", "https"] and element.text:
+            url = element.text.strip()
+            if url.endswith(REPOMD):
+                urls.append((-int(element.get("preference") or 0), url[:-len(REPOMD)]))
+    return [url for _, url in sorted(urls, key=lambda x: x[0])], checksum
+
+
+def candidates(repo):
+    """
+    Return candidate mirrors of repository, repository itself is the first one
+
+    :param repo: str repository URL
+    :return: tuple (list of URLs, expected sha256 checksum of repomd.xml or None)
+    """
+    output = [repo]
+    checksum = None
+    if httpclient.local_path(repo) is not None:
+        return output, checksum
+    conf = get_mirror_conf()
+    for prefix, mirrors in (conf.get("prefixes") or {}).items():
+        if repo.startswith(prefix):
+            output += [mirror + repo[len(prefix):] for mirror in mirrors]
+    metalink = (conf.get("metalinks") or {}).get(repo)
+    if metalink:
+        try:
+            urls, checksum = parse_metalink(httpclient.read(metalink, cache=False))
+            output += urls
+        except (IOError, ElementTree.ParseError) as e:
+            core.print_debug("Unable to read metalink %s" % metalink, e)
+    unique = []
+    for url in output:
+        if url.rstrip("/") not in [x.rstrip("/") for x in unique]:
+            unique.append(url)
+    return unique, checksum
+
+
+def probe(url):
+    """
+    Download repomd.xml of repository and measure latency
+
+    :param url: str repository URL
+    :return: dict with keys url, latency, checksum, revision and error (None when mirror is usable)
+    """
+    output = {"url": url, "latency": None, "checksum": None, "revision": 0, "error": None}
+    started = time.time()
+    try:
+        response = httpclient.request("GET", "%s/%s" % (url.rstrip("/"), REPOMD),
+                                      timeout=float(get_mirror_conf().get("timeout", DEFAULT_TIMEOUT)))
+        response.raise_for_status()
+        output["latency"] = time.time() - started
+        output["checksum"] = hashlib.sha256(response.content).hexdigest()
+        for element in ElementTree.fromstring(response.content):
+            if _localname(element) == "revision" and (element.text or "").strip().isdigit():
+                output["revision"] = int(element.text)
+    except (requests.RequestException, ElementTree.ParseError) as e:
+        output["error"] = str(e)
+    return output
+
+
+def rank(repo):
+    """
+    Return mirrors of repository ordered from the best one, mirrors with freshest metadata ordered
+    by latency first, then stale mirrors. Unreachable mirrors are omitted.
+
+    :param repo: str repository URL
+    :return: list of URLs, [repo] when there are no mirrors or none is reachable
+    """
+    with _lock:
+        if repo in _ranked:
+            return _ranked[repo]
+    urls, checksum = candidates(repo)
+    if len(urls) == 1:
+        ranked = urls
+    else:
+        pool = ThreadPool(min(int(get_mirror_conf().get("workers") or DEFAULT_WORKERS), len(urls)))
+        try:
+            probes = pool.map_async(probe, urls, chunksize=1).get(timeout=3600)
+        finally:
+            pool.terminate()
+        reachable = [x for x in probes if x["error"] is None]
+        for item in probes:
+            if item["error"]:
+                core.print_debug("Mirror %s is not usable: %s" % (item["url"], item["error"]))
+        if checksum:
+            fresh = [x for x in reachable if x["checksum"] == checksum]
+        else:
+            newest = max([x["revision"] for x in reachable] or [0])
+            fresh = [x for x in reachable if x["revision"] == newest]
+        stale = [x for x in reachable if x not in fresh]
+        ranked = [x["url"] for x in sorted(fresh, key=lambda x: x["latency"]) +
+                  sorted(stale, key=lambda x: x["latency"])] or [repo]
+        core.print_debug("Mirrors of %s: %s" % (repo, ranked))
+    with _lock:
+        _ranked[repo] = ranked
+    return ranked
+
+
+def select(repos):
+    """
+    Return the best mirror of every repository
+
+    :param repos: list of repository URLs
+    :return: list of URLs
+    """
+    return [rank(repo)[0] for repo in repos]
+
+
+def failover(repos, action, errors=(Exception,)):
+    """
+    Call action with the best mirrors of repositories, when it fails, every repository with
+    another mirror is switched to the next one and action is called again
+
+    :param repos: list of repository URLs
+    :param action: function called with list of mirror URLs (same order as repos)
+    :param errors: tuple of exceptions leading to failover
+    :return: result of action
+    :raises: last error of action when all mirrors failed
+    """
+    ranked = [rank(repo) for repo in repos]
+    attempts = max([len(x) for x in ranked] or [1])
+    for attempt in range(attempts):
+        mirrors = [x[min(attempt, len(x) - 1)] for x in ranked]
+        try:
+            return action(mirrors)
+        except errors as e:
+            if attempt + 1 == attempts:
+                raise
+            core.print_info("Installation from mirrors %s failed, trying next mirrors" % mirrors, e)
+
+
+def test_rank():
+    import BaseHTTPServer
+    import SocketServer
+
+    def repomd(revision):
+        return '<?xml version="1.0"?><repomd xmlns="http://linux.duke.edu/metadata/repo">' \
+               '<revision>%s</revision></repomd>' % revision
+
+    # path prefix -> (delay, repomd)
+    mirrors = {"/slow/": (0.3, repomd(2)), "/fast/": (0, repomd(2)), "/stale/": (0, repomd(1))}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metalink":
+                port = self.server.server_address[1]
+                body = '<metalink xmlns="urn:ietf:params:xml:ns:metalink"><file name="repomd.xml">' \
+                       '<verification><hash type="sha256">%s</hash></verification><resources>' \
+                       '<url protocol="http" preference="90">http://127.0.0.1:%d/slow/os/%s</url>' \
+                       '<url protocol="http" preference="100">http://127.0.0.1:%d/stale/os/%s</url>' \
+                       '</resources></file></metalink>' % (hashlib.sha256(repomd(1)).hexdigest(),
+                                                           port, REPOMD, port, REPOMD)
+            else:
+                prefix = "/%s/" % self.path.split("/")[1]
+                if prefix not in mirrors:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                time.sleep(mirrors[prefix][0])
+                body = mirrors[prefix][1]
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    saved = common.conf.get("mirrors")
+    try:
+        base = "http://127.0.0.1:%d" % server.server_address[1]
+        repo = "%s/broken/os/" % base
+        common.conf["mirrors"] = {"prefixes": {"%s/broken/" % base: ["%s/slow/" % base, "%s/fast/" % base,
+                                                                    "%s/stale/" % base]},
+                                  "metalinks": {"%s/other/os/" % base: "%s/metalink" % base}}
+        assert rank(repo) == ["%s/fast/os/" % base, "%s/slow/os/" % base, "%s/stale/os/" % base]
+        assert select([repo, "file:///tmp/repo"]) == ["%s/fast/os/" % base, "file:///tmp/repo"]
+        # metalink checksum wins over newest revision
+        assert rank("%s/other/os/" % base) == ["%s/stale/os/" % base, "%s/slow/os/" % base]
+        used = []
+
+        def action(urls):
+            used.append(urls[0])
+            if "/fast/" in urls[0]:
+                raise IOError("broken mirror")
+            return urls
+
+        assert failover([repo], action, errors=(IOError,)) == ["%s/slow/os/" % base]
+        assert len(used) == 2
+    finally:
+        _ranked.clear()
+        common.conf["mirrors"] = saved
+        server.shutdown()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Cache of parsed moduleMD files with index of profiles, packages and dependencies.
+
+ModuleMD file is fetched by shared HTTP client (remote file is revalidated), parsed once and stored
+as JSON to <modularity.modulemd_cache>/<hash of URL and validator>.json, validator is modification time
+and size of local (or cached) file, so that all test processes of session share one parsed document.
+Values what JSON does not represent (dates, sets, non string keys) are stored tagged, so that cached
+document is equal to freshly parsed one.
+"""
+
+import os
+import json
+import hashlib
+import datetime
+import tempfile
+import threading
+import yaml
+
+import core
+import common
+import httpclient
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+INDEX_FORMAT = 2
+DEFAULT_CACHE_DIR = "/var/cache/mtf/modulemd"
+_lock = threading.Lock()
+# (url, validator, cachedir) -> ModuleMDIndex
+_loaded = {}
+
+
+def get_cache_dir():
+    """
+    Return directory of parsed moduleMD files
+
+    :return: str
+    """
+    return common.conf.get("modularity", {}).get("modulemd_cache") or DEFAULT_CACHE_DIR
+
+
+class ModuleMDIndex(object):
+    """
+    Parsed moduleMD with precomputed sets of packages
+    """
+
+    def __init__(self, modulemd):
+        """
+
+        :param modulemd: dict moduleMD document
+        """
+        self.modulemd = modulemd if isinstance(modulemd, dict) else {}
+        data = self.modulemd.get("data") or {}
+        # profile -> frozenset of rpms
+        self.profiles = dict((name, frozenset((profile or {}).get("rpms") or []))
+                             for name, profile in (data.get("profiles") or {}).items())
+        self.rpms = frozenset().union(*self.profiles.values()) if self.profiles else frozenset()
+        self.components = frozenset(((data.get("components") or {}).get("rpms") or {}).keys())
+        dependencies = data.get("dependencies") or {}
+        self.requires = dependencies.get("requires") or {}
+        self.buildrequires = dependencies.get("buildrequires") or {}
+        # rpm -> frozenset of profiles
+        package_profiles = {}
+        for name, rpms in self.profiles.items():
+            for rpm in rpms:
+                package_profiles.setdefault(rpm, set()).add(name)
+        self.package_profiles = dict((rpm, frozenset(names)) for rpm, names in package_profiles.items())
+
+    def profile(self, name):
+        """
+        Return packages of profile
+
+        :param name: str profile name
+        :return: frozenset
+        :raises KeyError: profile is not defined in moduleMD
+        """
+        return self.profiles[name]
+
+    def profiles_of(self, package):
+        """
+        Return profiles containing package
+
+        :param package: str rpm name
+        :return: frozenset
+        """
+        return self.package_profiles.get(package, frozenset())
+
+    def has_package(self, package):
+        """
+        Return True when package is part of some profile or it is component of module
+
+        :param package: str rpm name
+        :return: bool
+        """
+        return package in self.rpms or package in self.components
+
+
+def _encode(value):
+    """
+    Internal function, return JSON serializable form of parsed YAML value
+
+    :raises ValueError: type of value is not supported
+    """
+    if isinstance(value, dict):
+        if "__type__" not in value and all(isinstance(key, basestring) for key in value):
+            return dict((key, _encode(item)) for key, item in value.items())
+        return {"__type__": "dict", "items": [[_encode(key), _encode(item)] for key, item in value.items()]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, set):
+        return {"__type__": "set", "items": [_encode(item) for item in value]}
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            raise ValueError("Unsupported value %r" % value)
+        return {"__type__": "datetime", "value": [value.year, value.month, value.day, value.hour,
+                                                  value.minute, value.second, value.microsecond]}
+    if isinstance(value, datetime.date):
+        return {"__type__": "date", "value": [value.year, value.month, value.day]}
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    raise ValueError("Unsupported value %r" % value)
+
+
+def _decode(value):
+    """
+    Internal function, return parsed YAML value from form stored by _encode
+    """
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    kind = value.get("__type__")
+    if kind == "dict":
+        return dict((_decode(key), _decode(item)) for key, item in value["items"])
+    if kind == "set":
+        return set(_decode(item) for item in value["items"])
+    if kind == "datetime":
+        return datetime.datetime(*value["value"])
+    if kind == "date":
+        return datetime.date(*value["value"])
+    return dict((key, _decode(item)) for key, item in value.items())
+
+
+def _validator(path):
+    stat = os.stat(path)
+    return "%s-%s" % (stat.st_mtime, stat.st_size)
+
+
+def load(url, cachedir=None):
+    """
+    Return index of moduleMD file
+
+    :param url: str URL or path of moduleMD file
+    :param cachedir: str directory of parsed files, default modularity.modulemd_cache from MTF config
+    :return: ModuleMDIndex
+    :raises IOError: file is not available
+    :raises yaml.YAMLError: file is not valid YAML
+    """
+    path = httpclient.fetch(url)
+    cachedir = cachedir or get_cache_dir()
+    key = (url, _validator(path), cachedir)
+    with _lock:
+        if key in _loaded:
+            return _loaded[key]
+    cachefile = os.path.join(cachedir, "%s.json" % hashlib.sha1(url + key[1]).hexdigest())
+    modulemd = None
+    try:
+        with open(cachefile) as openfile:
+            data = json.load(openfile)
+        if data.get("format") == INDEX_FORMAT:
+            modulemd = _decode(data["modulemd"])
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    if modulemd is None:
+        with open(path) as openfile:
+            modulemd = yaml.load(openfile, Loader=SafeLoader)
+        try:
+            encoded = _encode(modulemd)
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            fd, tmpname = tempfile.mkstemp(dir=cachedir, prefix=".modulemd")
+            with os.fdopen(fd, "w") as openfile:
+                json.dump({"format": INDEX_FORMAT, "url": url, "modulemd": encoded}, openfile)
+            os.rename(tmpname, cachefile)
+        except (IOError, OSError, ValueError) as e:
+            core.print_debug("Unable to store parsed moduleMD to %s" % cachedir, e)
+    index = ModuleMDIndex(modulemd)
+    with _lock:
+        _loaded[key] = index
+    return index
+
+
+def test_load():
+    import shutil
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        mdfile = os.path.join(tmpdir, "module.yaml")
+        with open(mdfile, "w") as openfile:
+            yaml.dump({"document": "modulemd", "version": 1,
+                       "data": {"profiles": {"default": {"rpms": ["memcached", "perl"]},
+                                             "minimal": {"rpms": ["memcached"]}},
+                                "components": {"rpms": {"libevent": {}}},
+                                "eol": datetime.date(2020, 1, 1),
+                                "xmd": {1: set(["x"]), "built": datetime.datetime(2018, 1, 2, 3, 4, 5)},
+                                "dependencies": {"requires": {"platform": "master"}}}}, openfile)
+        cachedir = os.path.join(tmpdir, "cache")
+        index = load(mdfile, cachedir)
+        # cached document is same as parsed one
+        _loaded.clear()
+        assert load(mdfile, cachedir).modulemd == index.modulemd
+        assert index.profile("minimal") == frozenset(["memcached"])
+        assert index.profiles_of("memcached") == frozenset(["default", "minimal"])
+        assert index.has_package("perl") and index.has_package("libevent") and not index.has_package("bash")
+        assert index.requires == {"platform": "master"}
+        assert len(os.listdir(cachedir)) == 1
+        # other cache directory and changed file are loaded again
+        assert load(mdfile, os.path.join(tmpdir, "other")) is not index
+        with open(mdfile, "a") as openfile:
+            openfile.write("# changed\n")
+        assert load(mdfile, cachedir) is not index
+        assert len(os.listdir(cachedir)) == 2
+        # other process uses parsed document from cache
+        _loaded.clear()
+        os.chmod(mdfile, 0)
+        if os.getuid() != 0:
+            assert load(mdfile, cachedir).rpms == frozenset(["memcached", "perl"])
+    finally:
+        _loaded.clear()
+        shutil.rmtree(tmpdir)
@@ -31,6 +31,7 @@ import mtf_scheduler
 from environment_prepare.docker_prepare import EnvDocker
 from environment_prepare.rpm_prepare import EnvRpm
 from environment_prepare.nspawn_prepare import EnvNspawn
+from environment_prepare.bwrap_prepare import EnvBwrap
 from environment_prepare.openshift_prepare import EnvOpenShift
 
 # I'm lazy to do own argument parser here.
@@ -47,6 +48,8 @@ elif module_name == "rpm":
     env = EnvRpm()
 elif module_name == "nspawn":
     env = EnvNspawn()
+elif module_name == "bwrap":
+    env = EnvBwrap()
 elif module_name == "openshift":
     env = EnvOpenShift()
 
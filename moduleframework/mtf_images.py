@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Export and import of nspawn images as portable, content addressed artifacts.
+Image is built once and distributed to other machines (CI nodes) via shared directory or HTTP server.
+
+Artifact directory contains:
+  <sha256>.tar.gz - compressed tar stream of image root filesystem (upper directory in case of layer)
+  <sha256>.json - manifest: image metadata, checksums of repositories, list of packages and
+                  sha256 of artifacts of lower images (layer is imported only on top of them)
+  index.json - image names mapped to sha256 of last exported artifact
+"""
+
+from __future__ import print_function
+import os
+import re
+import json
+import glob
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from distutils.spawn import find_executable
+from avocado.utils import process
+
+import core
+import common
+import mtfexceptions
+import image_gc
+import httpclient
+from mtf.backend import nspawn
+
+INDEX = "index.json"
+CHUNK = 1024 * 1024
+
+
+def get_basedir():
+    return common.conf["nspawn"]["basedir"]
+
+
+def list_images(basedir=None):
+    """
+    Return metadata of all images registered in local image cache
+
+    :param basedir: directory with images, default is nspawn.basedir from MTF config
+    :return: list of dicts
+    """
+    basedir = basedir or get_basedir()
+    output = []
+    for metafile in sorted(glob.glob(os.path.join(basedir, "chroot_*.json"))):
+        location = metafile[:-len(".json")]
+        if os.path.isdir(location):
+            output.append(nspawn.read_metadata(location))
+    return output
+
+
+def _image_tree(location, metadata):
+    """
+    Internal function, return directory what is stored in artifact
+
+    :return: str
+    """
+    if metadata.get("layout") == "layer":
+        return os.path.join(location, "upper")
+    return location
+
+
+def _open_source(source, filename):
+    """
+    Internal function, open file from shared directory or from HTTP server
+
+    :return: file like object
+    """
+    if source.startswith("http://") or source.startswith("https://"):
+        try:
+            # index and manifests are revalidated by conditional requests, artifacts are streamed
+            return httpclient.open_url("%s/%s" % (source.rstrip("/"), filename), cache=filename.endswith(".json"))
+        except IOError as e:
+            raise mtfexceptions.NspawnExc("Unable to download %s from %s" % (filename, source), e)
+    return open(os.path.join(source, filename), "rb")
+
+
+def repo_checksums(repos):
+    """
+    Return sha256 checksums of repomd.xml files of repositories, None for unreachable repository
+
+    :param repos: list of repository URLs
+    :return: dict
+    """
+    output = {}
+    for repo in repos:
+        try:
+            repomd = httpclient.read("%s/%s" % (repo.rstrip("/"), common.conf["compose"]["repomd"]))
+            output[repo] = hashlib.sha256(repomd).hexdigest()
+        except IOError:
+            output[repo] = None
+    return output
+
+
+def package_list(location, metadata):
+    """
+    Return list of installed packages in image
+
+    :return: list
+    """
+    root = location
+    if metadata.get("layout") == "layer":
+        root = os.path.join(location, "rootfs")
+        if not os.path.ismount(root):
+            return metadata.get("packageset", [])
+    out = process.run("rpm --root %s -qa" % root, ignore_status=True, verbose=core.is_debug())
+    return sorted([x.strip() for x in out.stdout.split("\n") if x.strip()])
+
+
+def export_image(name, destination, basedir=None):
+    """
+    Store image as content addressed artifact to destination directory
+
+    :param name: name of image (directory name in basedir)
+    :param destination: directory for artifacts (shared directory or document root of HTTP server)
+    :param basedir: directory with images
+    :return: dict manifest
+    """
+    basedir = basedir or get_basedir()
+    location = os.path.join(basedir, name)
+    metadata = nspawn.read_metadata(location)
+    if not metadata or not os.path.isdir(location):
+        raise mtfexceptions.NspawnExc("Image %s is not registered in local image cache (%s)" % (name, basedir))
+    if metadata.get("sha256") and os.path.exists(os.path.join(destination, "%s.json" % metadata["sha256"])):
+        # image was exported (or imported) as this artifact, it was not rebuilt since
+        return json.load(open(os.path.join(destination, "%s.json" % metadata["sha256"])))
+    # layer is bound to exact artifacts of lower images, they are exported first
+    lower_digests = dict((lower, export_image(lower, destination, basedir=basedir)["sha256"])
+                         for lower in metadata.get("lowers", []))
+    if not os.path.exists(destination):
+        os.makedirs(destination)
+    core.print_info("Exporting image %s" % name)
+    compress = ["-I", "pigz"] if find_executable("pigz") else ["-z"]
+    tmpfd, tmpname = tempfile.mkstemp(dir=destination, suffix=".part")
+    tar = subprocess.Popen(["tar", "-C", _image_tree(location, metadata), "--numeric-owner", "--xattrs",
+                            "--acls", "-cp"] + compress + ["-f", "-", "."], stdout=subprocess.PIPE)
+    checksum = hashlib.sha256()
+    size = 0
+    with os.fdopen(tmpfd, "wb") as artifact:
+        for chunk in iter(lambda: tar.stdout.read(CHUNK), ""):
+            checksum.update(chunk)
+            artifact.write(chunk)
+            size += len(chunk)
+    if tar.wait() != 0:
+        os.remove(tmpname)
+        raise mtfexceptions.NspawnExc("Unable to create tar stream of image %s" % name)
+    digest = checksum.hexdigest()
+    os.rename(tmpname, os.path.join(destination, "%s.tar.gz" % digest))
+    manifest = dict(metadata)
+    manifest.update({"sha256": digest,
+                     "size": size,
+                     "artifact": "%s.tar.gz" % digest,
+                     "repo_checksums": repo_checksums(metadata.get("repos", [])),
+                     "packages": package_list(location, metadata),
+                     "lower_digests": lower_digests,
+                     "exported": time.time()})
+    _write_json(os.path.join(destination, "%s.json" % digest), manifest)
+    # local image remembers its artifact, layers exported later refer to it
+    metadata["sha256"] = digest
+    _write_json("%s.json" % location, metadata)
+    index_file = os.path.join(destination, INDEX)
+    index = json.load(open(index_file)) if os.path.exists(index_file) else {}
+    index[name] = digest
+    _write_json(index_file, index)
+    core.print_info("Image %s exported: %s (%d MB)" % (name, manifest["artifact"], size / 1024 / 1024))
+    return manifest
+
+
+def _write_json(filename, data):
+    """
+    Internal function, write json file atomically, another nodes can read it in meantime
+
+    :return: None
+    """
+    tmpfd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".part")
+    with os.fdopen(tmpfd, "w") as openfile:
+        json.dump(data, openfile, indent=2)
+    os.chmod(tmpname, 0o644)
+    os.rename(tmpname, filename)
+
+
+def read_index(source):
+    """
+    Return index of artifacts (image name -> sha256)
+
+    :param source: shared directory or URL
+    :return: dict
+    """
+    return json.load(_open_source(source, INDEX))
+
+
+def _check_image_name(name):
+    """
+    Internal function, reject image names from remote index what would point outside of image directory
+
+    :param name: str image name
+    :return: None
+    :raises NspawnExc: name is not plain image name
+    """
+    if not isinstance(name, basestring) or not name.startswith("chroot_") or \
+            os.path.basename(name) != name or name in [".", ".."]:
+        raise mtfexceptions.NspawnExc("Invalid image name in manifest: %r" % (name,))
+
+
+def import_image(source, name=None, digest=None, basedir=None, force=False):
+    """
+    Download artifact, verify its checksum and register image in local image cache
+
+    :param source: shared directory or URL of HTTP server with artifacts
+    :param name: image name to import (latest artifact from index is used)
+    :param digest: sha256 of artifact, it can be used instead of name
+    :param basedir: directory with images
+    :param force: replace existing image
+    :return: dict manifest
+    """
+    basedir = basedir or get_basedir()
+    digest = digest or read_index(source).get(name)
+    if not digest:
+        raise mtfexceptions.NspawnExc("Image %s is not available in %s" % (name, source))
+    if not re.match(r"^[0-9a-f]{64}$", str(digest)):
+        raise mtfexceptions.NspawnExc("Invalid digest of image %s: %r" % (name, digest))
+    manifest = json.load(_open_source(source, "%s.json" % digest))
+    _check_image_name(manifest.get("name"))
+    for lower in manifest.get("lowers", []):
+        _check_image_name(lower)
+    if os.path.basename(str(manifest.get("artifact"))) != manifest.get("artifact"):
+        raise mtfexceptions.NspawnExc("Invalid artifact name in manifest: %r" % (manifest.get("artifact"),))
+    location = os.path.join(basedir, manifest["name"])
+    local = nspawn.read_metadata(location)
+    if local and local.get("sha256") == digest and os.path.isdir(location):
+        core.print_info("Image %s is already imported" % manifest["name"])
+        return manifest
+    if os.path.exists(location) and not force:
+        raise mtfexceptions.NspawnExc("Image %s already exists, use force to replace it" % location)
+    for lower in manifest.get("lowers", []):
+        lower_metadata = nspawn.read_metadata(os.path.join(basedir, lower))
+        if not lower_metadata:
+            raise mtfexceptions.NspawnExc("Image %s needs lower image %s, import it first" %
+                                          (manifest["name"], lower))
+        if lower_metadata.get("sha256") != manifest.get("lower_digests", {}).get(lower):
+            raise mtfexceptions.NspawnExc("Image %s was exported on top of other version of lower image %s, "
+                                          "import it first (with force)" % (manifest["name"], lower))
+    if not os.path.exists(basedir):
+        os.makedirs(basedir)
+    core.print_info("Importing image %s (%s)" % (manifest["name"], digest))
+    tmpfd, tmpname = tempfile.mkstemp(dir=basedir, prefix=".import_", suffix=".tar.gz")
+    checksum = hashlib.sha256()
+    remote = _open_source(source, manifest["artifact"])
+    try:
+        with os.fdopen(tmpfd, "wb") as artifact:
+            for chunk in iter(lambda: remote.read(CHUNK), ""):
+                checksum.update(chunk)
+                artifact.write(chunk)
+    finally:
+        # streamed HTTP response holds connection slot of host until it is closed
+        remote.close()
+    if checksum.hexdigest() != digest:
+        os.remove(tmpname)
+        raise mtfexceptions.NspawnExc("Checksum of artifact %s does not match (%s)" %
+                                      (manifest["artifact"], checksum.hexdigest()))
+    extractdir = tempfile.mkdtemp(dir=basedir, prefix=".import_")
+    tree = _image_tree(extractdir, manifest)
+    if not os.path.exists(tree):
+        os.makedirs(tree)
+    try:
+        process.run("tar -C %s --numeric-owner --xattrs --acls -xpzf %s" % (tree, tmpname),
+                    verbose=core.is_debug())
+    finally:
+        os.remove(tmpname)
+    if manifest.get("layout") == "layer":
+        os.makedirs(os.path.join(extractdir, "work"))
+        os.makedirs(os.path.join(extractdir, "rootfs"))
+    if os.path.exists(location):
+        if os.path.ismount(os.path.join(location, "rootfs")):
+            process.run("umount %s" % os.path.join(location, "rootfs"), verbose=core.is_debug())
+        shutil.rmtree(location)
+    os.rename(extractdir, location)
+    manifest["imported_from"] = source
+    manifest["imported"] = time.time()
+    _write_json("%s.json" % location, manifest)
+    return manifest
+
+
+def import_all(source, basedir=None, force=False):
+    """
+    Import all images from index, lower images are imported before layers
+
+    :return: list of manifests
+    """
+    basedir = basedir or get_basedir()
+    pending = read_index(source)
+    manifests = {}
+    for name, digest in pending.items():
+        manifests[name] = json.load(_open_source(source, "%s.json" % digest))
+    output = []
+    while manifests:
+        ready = [x for x in manifests
+                 if not [y for y in manifests[x].get("lowers", []) if y in manifests]]
+        if not ready:
+            raise mtfexceptions.NspawnExc("Unable to solve order of image layers: %s" % manifests.keys())
+        for name in ready:
+            output.append(import_image(source, digest=pending[name], basedir=basedir, force=force))
+            del manifests[name]
+    return output
+
+
+def changed_repos(manifest):
+    """
+    Return repositories, which content changed since the image was exported
+
+    :param manifest: dict
+    :return: list
+    """
+    actual = repo_checksums(manifest.get("repos", []))
+    return [x for x in actual if actual[x] != manifest.get("repo_checksums", {}).get(x)]
+
+
+def cli(arguments=None):
+    parser = ArgumentParser(prog="mtf images",
+                            description="Share nspawn images between machines as content addressed artifacts")
+    parser.add_argument("--basedir", default=None, help="directory with images (default from MTF config)")
+    subparsers = parser.add_subparsers(dest="action")
+    subparsers.add_parser("list", help="list images in local image cache")
+    exportparser = subparsers.add_parser("export", help="export images to artifact directory")
+    exportparser.add_argument("destination", help="artifact directory (shared directory or HTTP document root)")
+    exportparser.add_argument("names", nargs="*", help="image names, all images are exported by default")
+    importparser = subparsers.add_parser("import", help="import images from artifact directory or URL")
+    importparser.add_argument("source", help="artifact directory or URL")
+    importparser.add_argument("names", nargs="*", help="image names, all images are imported by default")
+    importparser.add_argument("--force", action="store_true", default=False, help="replace existing images")
+    gcparser = subparsers.add_parser("gc", help="remove least recently used images, repositories and docker images")
+    gcparser.add_argument("--quota", type=int, default=None, help="disk quota in MB (default from MTF config)")
+    gcparser.add_argument("--dry-run", dest="dry_run", action="store_true", default=False,
+                          help="just print what would be removed")
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    args = cli(arguments)
+    if args.action == "list":
+        for metadata in list_images(args.basedir):
+            print("%s %s %s" % (metadata["name"], metadata.get("layout"), metadata.get("sha256", "")))
+    elif args.action == "export":
+        names = args.names or [x["name"] for x in list_images(args.basedir)]
+        for name in names:
+            manifest = export_image(name, args.destination, basedir=args.basedir)
+            print("%s %s" % (name, manifest["sha256"]))
+    elif args.action == "import":
+        if args.names:
+            manifests = [import_image(args.source, name=x, basedir=args.basedir, force=args.force)
+                         for x in args.names]
+        else:
+            manifests = import_all(args.source, basedir=args.basedir, force=args.force)
+        for manifest in manifests:
+            print("%s %s" % (manifest["name"], manifest["sha256"]))
+            for repo in changed_repos(manifest):
+                core.print_info("WARNING: repository changed since image was exported: %s" % repo)
+    elif args.action == "gc":
+        image_gc.collect(quota=args.quota, basedir=args.basedir, dry_run=args.dry_run)
+    return 0
+
+
+def test_export_import():
+    basedir = tempfile.mkdtemp()
+    otherdir = tempfile.mkdtemp()
+    artifacts = tempfile.mkdtemp()
+    location = os.path.join(basedir, "chroot_test_image")
+    os.makedirs(os.path.join(location, "etc"))
+    with open(os.path.join(location, "etc", "os-release"), "w") as openfile:
+        openfile.write("NAME=test\n")
+    _write_json("%s.json" % location, {"name": "chroot_test_image", "layout": "flat", "repos": []})
+    manifest = export_image("chroot_test_image", artifacts, basedir=basedir)
+    assert read_index(artifacts) == {"chroot_test_image": manifest["sha256"]}
+    assert [x["name"] for x in import_all(artifacts, basedir=otherdir)] == ["chroot_test_image"]
+    assert open(os.path.join(otherdir, "chroot_test_image", "etc", "os-release")).read() == "NAME=test\n"
+    assert nspawn.read_metadata(os.path.join(otherdir, "chroot_test_image"))["sha256"] == manifest["sha256"]
+    # manifest must not point outside of image directory
+    for name in ["../chroot_test_image", "/tmp/chroot_x", "test_image"]:
+        _write_json(os.path.join(artifacts, "%s.json" % manifest["sha256"]), dict(manifest, name=name))
+        try:
+            import_image(artifacts, digest=manifest["sha256"], basedir=otherdir, force=True)
+            assert False, "image %s imported" % name
+        except mtfexceptions.NspawnExc:
+            pass
+    assert os.path.isdir(os.path.join(otherdir, "chroot_test_image"))
+    _write_json(os.path.join(artifacts, "%s.json" % manifest["sha256"]), manifest)
+    # layer refers to exact artifact of its lower image
+    layer = os.path.join(basedir, "chroot_test_layer")
+    os.makedirs(os.path.join(layer, "upper", "etc"))
+    _write_json("%s.json" % layer, {"name": "chroot_test_layer", "layout": "layer",
+                                    "lowers": ["chroot_test_image"], "repos": []})
+    layer_manifest = export_image("chroot_test_layer", artifacts, basedir=basedir)
+    assert layer_manifest["lower_digests"] == {"chroot_test_image": manifest["sha256"]}
+    import_image(artifacts, name="chroot_test_layer", basedir=otherdir)
+    metadata = nspawn.read_metadata(os.path.join(otherdir, "chroot_test_image"))
+    _write_json(os.path.join(otherdir, "chroot_test_image.json"), dict(metadata, sha256="0" * 64))
+    shutil.rmtree(os.path.join(otherdir, "chroot_test_layer"))
+    try:
+        import_image(artifacts, name="chroot_test_layer", basedir=otherdir)
+        assert False, "layer imported on top of other lower image"
+    except mtfexceptions.NspawnExc:
+        pass
+    for item in [basedir, otherdir, artifacts]:
+        shutil.rmtree(item)
+
+
+def test_import_http():
+    import threading
+    import BaseHTTPServer
+    import SimpleHTTPServer
+    import SocketServer
+
+    basedir = tempfile.mkdtemp()
+    otherdir = tempfile.mkdtemp()
+    artifacts = tempfile.mkdtemp()
+
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(artifacts, path.lstrip("/"))
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        # more images than connections allowed to one host, every artifact stream has to release its slot
+        per_host = int(httpclient.get_http_conf().get("per_host") or httpclient.DEFAULT_PER_HOST)
+        names = ["chroot_test_image%d" % x for x in range(per_host + 2)]
+        for name in names:
+            location = os.path.join(basedir, name)
+            os.makedirs(os.path.join(location, "etc"))
+            _write_json("%s.json" % location, {"name": name, "layout": "flat", "repos": []})
+            export_image(name, artifacts, basedir=basedir)
+        source = "http://127.0.0.1:%d" % server.server_address[1]
+        assert sorted(x["name"] for x in import_all(source, basedir=otherdir)) == names
+    finally:
+        server.shutdown()
+        for item in [basedir, otherdir, artifacts]:
+            shutil.rmtree(item)
@@ -28,6 +28,7 @@ import json
 import glob
 import imp
 import re
+import sys
 
 import subprocess
 import core, common, mtfexceptions
@@ -56,6 +57,7 @@ VARIABLES
             =docker uses the docker section of config.yaml.
             =rpm uses the rpm section of config.yaml and tests RPMs directly on a host.
             =nspawn tests RPMs in a virtual environment with systemd-nspawn.
+            =bwrap tests RPMs in bubblewrap sandbox on top of nspawn images (no systemd boot).
 
     URL overrides the value of module.docker.container or module.rpm.repo.
        The URL should correspond to the MODULE variable, for example:
@@ -94,6 +96,9 @@ VARIABLES
                         help='Action for avocado, see avocado --help for subcommands')
     parser.add_argument("--version", action="store_true",
                         default=False, help='show version and exit')
+    parser.add_argument("--in-cluster", action="store_true", default=False,
+                        help="""OpenShift module type: deploy application once and run tests inside runner pod
+                        in the cluster (openshift.runner section of MTF config)""")
     parser.add_argument("--metadata", action="store_true",
                         default=False, help="""load configuration for test sets from metadata file
                         (https://github.com/fedora-modularity/meta-test-family/blob/devel/mtf/metadata/README.md)""")
@@ -120,7 +125,7 @@ It tests container images and/or modules with user defined tests using avocado f
     group = parser.add_argument_group(
         'additional arguments are like environment variables up to the http://meta-test-family.readthedocs.io/en/latest/user_guide/environment_variables.html ')
     group.add_argument("--module", action="store",
-                       help='Module type, like: docker, nspawn, rpm or openshift')
+                       help='Module type, like: docker, nspawn, bwrap, rpm or openshift')
     group.add_argument("--debug", action="store_true", help='more logging')
     group.add_argument("--config", action="store",
                        help='defines the module configuration file')
@@ -275,11 +280,26 @@ class AvocadoStart(object):
     def avocado_run(self):
         self.check_tests()
         self.json_tmppath = tempfile.mktemp()
+        if self.args.in_cluster:
+            return self.avocado_in_cluster()
         avocado_args = ["--json", self.json_tmppath]
         if self.args.xunit:
             avocado_args += ["--xunit", self.args.xunit]
         return self.avocado_general(action=self.args.action, avocado_default_args=avocado_args)
 
+    def avocado_in_cluster(self):
+        """
+        Run tests inside runner pod in OpenShift cluster, JSON results are stored as for local run
+
+        :return: return code of avocado inside runner pod
+        """
+        if self.args.module != "openshift":
+            raise mtfexceptions.ModuleFrameworkException("--in-cluster is supported only for MODULE=openshift")
+        if self.args.xunit:
+            core.print_info("xUnit results are not supported together with --in-cluster")
+        from moduleframework import openshift_runner
+        return openshift_runner.run_tests(self.tests, self.additionalAvocadoArg, self.json_tmppath)
+
     def avocado_general(self, action, avocado_default_args=[]):
         """
 
@@ -372,6 +392,10 @@ class AvocadoStart(object):
 
 
 def main():
+    if sys.argv[1:2] == ["images"]:
+        # image artifacts are handled by separate tool, avocado is not involved
+        from moduleframework import mtf_images
+        exit(mtf_images.main(sys.argv[2:]))
     core.print_debug('verbose/debug mode')
     args, unknown = cli()
 
@@ -380,6 +404,10 @@ def main():
         from moduleframework.mtf_environment import mtfenvset
         mtfenvset()
 
+    if args.action == 'run':
+        # free disk space used by old images and repositories before new ones are created
+        from moduleframework import image_gc
+        image_gc.auto_collect()
     a = AvocadoStart(args, unknown)
     if args.action == 'run':
         returncode = a.avocado_run()
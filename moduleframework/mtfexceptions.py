@@ -43,6 +43,14 @@ class NspawnExc(ModuleFrameworkException):
         super(NspawnExc, self).__init__('TYPE nspawn', *args, **kwargs)
 
 
+class BwrapExc(ModuleFrameworkException):
+    """
+    Indicates Bwrap module error.
+    """
+    def __init__(self, *args, **kwargs):
+        super(BwrapExc, self).__init__('TYPE bwrap', *args, **kwargs)
+
+
 class RpmExc(ModuleFrameworkException):
     """
     Indicates Rpm module error.
@@ -59,6 +67,33 @@ class ContainerExc(ModuleFrameworkException):
         super(ContainerExc, self).__init__('TYPE container', *args, **kwargs)
 
 
+class OpenShiftExc(ModuleFrameworkException):
+    """
+    Indicates OpenShift module error.
+    """
+    def __init__(self, *args, **kwargs):
+        super(OpenShiftExc, self).__init__('TYPE openshift', *args, **kwargs)
+
+
+class OpenShiftApiExc(OpenShiftExc):
+    """
+    Indicates that OpenShift REST API is not available, oc client is used instead.
+    """
+
+
+class ExecChannelExc(OpenShiftExc):
+    """
+    Indicates that command in persistent exec channel to pod failed (timeout, shell ended),
+    it is reconnected by next command.
+    """
+
+
+class ExecChannelConnectExc(ExecChannelExc):
+    """
+    Indicates that persistent exec channel to pod is not usable, command was not started in it.
+    """
+
+
 class ConfigExc(ModuleFrameworkException):
     """
     Indicates ``tests/config.yaml`` or module's ModuleMD YAML file error.
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Concurrent ODCS composes of module and its dependencies.
+
+Composes of all modules are requested at once, their states are polled together
+(one round of parallel requests, then sleep) and every state change is reported immediately,
+so that waiting takes as long as the slowest compose instead of sum of all of them.
+
+Composes are stored to registry (odcs.registry in MTF config) keyed by ODCS server, source,
+compose type and compose options. Live composes of registry are reused (and renewed when they
+expire soon) instead of requesting new ones, expired composes are evicted.
+"""
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import calendar
+import threading
+from multiprocessing.pool import ThreadPool
+
+import core
+import common
+import mtfexceptions
+
+WAITING_STATES = ["wait", "generating"]
+REUSABLE_STATES = WAITING_STATES + ["done"]
+POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 10
+DEFAULT_WORKERS = 8
+DEFAULT_REGISTRY = "/var/cache/mtf/odcs_composes.json"
+# compose expiring sooner is renewed, so that it is not removed during test
+RENEW_MARGIN = 3600
+
+
+def get_client():
+    """
+    Return ODCS client configured by odcs section of MTF config,
+    OpenIDC token is requested just once per process
+
+    :return: odcs.client.odcs.ODCS
+    """
+    # import moved here, to avoid messages when you don't need to use ODCS
+    from odcs.client.odcs import ODCS, AuthMech
+
+    odcsauth = common.conf["odcs"]["auth"]
+    if odcsauth.get("auth_mech") == AuthMech.OpenIDC:
+        if not odcsauth.get("openidc_token"):
+            odcsauth["openidc_token"] = common.get_openidc_auth()
+    return ODCS(common.conf["odcs"]["url"], **odcsauth)
+
+
+def repo_url(compose, arch=None):
+    """
+    Return URL of repository of finished compose
+
+    :param compose: dict compose from ODCS
+    :param arch: str, default generic.arch from MTF config
+    :return: str
+    """
+    return "{compose}/{arch}/os".format(compose=compose["result_repo"], arch=arch or common.conf["generic"]["arch"])
+
+
+def expiry(compose):
+    """
+    Return expiration time of compose
+
+    :param compose: dict compose from ODCS
+    :return: float seconds since epoch, 0 when it is not known
+    """
+    try:
+        return calendar.timegm(time.strptime(compose.get("time_to_expire") or "", "%Y-%m-%dT%H:%M:%SZ"))
+    except ValueError:
+        return 0
+
+
+class ComposeRegistry(object):
+    """
+    Persistent registry of composes shared by test runs on host
+    """
+
+    def __init__(self, path=None):
+        """
+
+        :param path: str registry file, default odcs.registry from MTF config
+        """
+        self.path = path or common.conf["odcs"].get("registry") or DEFAULT_REGISTRY
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(server, source, compose_type, options):
+        """
+        Return registry key of compose
+
+        :param server: str ODCS URL
+        :param source: str module identifier
+        :param compose_type: str ODCS source type
+        :param options: dict additional arguments of new compose (sigkeys, ...)
+        :return: str
+        """
+        return hashlib.sha1(json.dumps([server, source, compose_type, options], sort_keys=True)).hexdigest()
+
+    def _update(self, function):
+        """
+        Internal method, call function with content of registry under lock and store it,
+        expired composes are evicted
+
+        :param function: function getting dict key -> compose
+        :return: return value of function
+        """
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with self.lock, open(self.path, "a+") as openfile:
+            fcntl.flock(openfile, fcntl.LOCK_EX)
+            openfile.seek(0)
+            content = openfile.read()
+            try:
+                composes = json.loads(content) if content else {}
+            except ValueError:
+                composes = {}
+            now = time.time()
+            for key in [x for x in composes if expiry(composes[x]) < now]:
+                core.print_debug("ODCS compose %s of %s expired" % (composes[key]["id"], composes[key]["source"]))
+                del composes[key]
+            output = function(composes)
+            openfile.seek(0)
+            openfile.truncate()
+            json.dump(composes, openfile, indent=2, sort_keys=True)
+        return output
+
+    def get(self, key):
+        """
+        Return live compose
+
+        :param key: str
+        :return: dict or None
+        """
+        return self._update(lambda composes: composes.get(key))
+
+    def put(self, key, compose, source):
+        """
+        Store compose, composes not usable anymore (failed, removed) are removed
+
+        :param key: str
+        :param compose: dict compose from ODCS
+        :param source: str module identifier
+        :return: None
+        """
+        def store(composes):
+            if compose["state_name"] in REUSABLE_STATES:
+                composes[key] = {"id": compose["id"], "state_name": compose["state_name"], "source": source,
+                                 "result_repo": compose.get("result_repo"),
+                                 "time_to_expire": compose.get("time_to_expire")}
+            else:
+                composes.pop(key, None)
+        self._update(store)
+
+
+class ComposeOrchestrator(object):
+    """
+    Composes of many modules requested and awaited together
+    """
+
+    def __init__(self, client=None, compose_type=None, timeout=None, workers=None, new_compose_dict=None,
+                 registry=None):
+        """
+
+        :param client: ODCS client, default from MTF config
+        :param compose_type: str ODCS source type, default odcs.compose_type from MTF config
+        :param timeout: int seconds to wait for all composes, default odcs.timeout from MTF config
+        :param workers: int number of parallel requests
+        :param new_compose_dict: dict of additional arguments of new compose, default from MTF config
+        :param registry: ComposeRegistry, default from MTF config, False disables reuse of composes
+        """
+        self.client = client or get_client()
+        self.compose_type = compose_type or common.conf["odcs"]["compose_type"]
+        self.timeout = timeout or common.conf["odcs"]["timeout"]
+        self.workers = workers or DEFAULT_WORKERS
+        self.new_compose_dict = common.conf["odcs"]["new_compose_dict"] if new_compose_dict is None \
+            else new_compose_dict
+        if registry is None:
+            # empty odcs.registry in MTF config disables reuse
+            registry = ComposeRegistry() if common.conf["odcs"].get("registry", DEFAULT_REGISTRY) else False
+        self.registry = registry
+        self.server = getattr(self.client, "server_url", None) or common.conf["odcs"]["url"]
+        # source -> last known compose
+        self.composes = {}
+
+    def _map(self, function, items):
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map_async(function, items, chunksize=1).get(timeout=self.timeout)
+        finally:
+            pool.terminate()
+
+    def _key(self, source):
+        return ComposeRegistry.key(self.server, source, self.compose_type, self.new_compose_dict)
+
+    def _reuse(self, source):
+        """
+        Internal method, return live compose of source from registry, it is renewed when it expires soon
+
+        :param source: str
+        :return: dict or None
+        """
+        entry = self.registry.get(self._key(source))
+        if not entry:
+            return None
+        try:
+            compose = self.client.get_compose(entry["id"])
+            if compose["state_name"] not in REUSABLE_STATES:
+                return None
+            if compose["state_name"] == "done" and expiry(compose) - time.time() < RENEW_MARGIN:
+                compose = self.client.renew_compose(entry["id"])
+                core.print_debug("ODCS compose %s of %s renewed" % (compose["id"], source))
+        except Exception as e:
+            core.print_debug("ODCS: unable to reuse compose %s of %s" % (entry["id"], source), e)
+            return None
+        core.print_info("ODCS compose %s of %s reused" % (compose["id"], source))
+        return compose
+
+    def _new_compose(self, source):
+        compose = self._reuse(source) if self.registry else None
+        if compose is None:
+            compose = self.client.new_compose(source, self.compose_type, **self.new_compose_dict)
+        if self.registry:
+            self.registry.put(self._key(source), compose, source)
+        return compose
+
+    def _get_compose(self, source):
+        """
+        Internal method, return current compose, last known one in case of failure of ODCS request
+        """
+        try:
+            return self.client.get_compose(self.composes[source]["id"])
+        except Exception as e:
+            core.print_debug("ODCS: unable to get state of compose for %s" % source, e)
+            return self.composes[source]
+
+    def submit(self, sources):
+        """
+        Request composes of all sources in parallel
+
+        :param sources: list of module identifiers (name:stream[:version])
+        :return: None
+        """
+        sources = [x for x in sources if x not in self.composes]
+        if not sources:
+            return
+        core.print_debug("ODCS Starting module composing: %s" % self.client,
+                         "%s composes for: %s" % (self.compose_type, " ".join(sources)))
+        for source, compose in zip(sources, self._map(self._new_compose, sources)):
+            self.composes[source] = compose
+            core.print_info("ODCS compose %s of %s: %s" % (compose["id"], source, compose["state_name"]))
+
+    def watch(self):
+        """
+        Poll all submitted composes until they are finished
+
+        :return: generator of (source, compose) for every change of compose state
+        :raises PDCExc: composes are not finished in timeout
+        """
+        deadline = time.time() + self.timeout
+        interval = POLL_INTERVAL
+        while True:
+            pending = sorted(x for x in self.composes if self.composes[x]["state_name"] in WAITING_STATES)
+            if not pending:
+                return
+            if time.time() > deadline:
+                raise mtfexceptions.PDCExc("ODCS: composes of %s were not finished in %ss" % (
+                    " ".join(pending), self.timeout))
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+            for source, compose in zip(pending, self._map(self._get_compose, pending)):
+                if compose["state_name"] != self.composes[source]["state_name"]:
+                    self.composes[source] = compose
+                    yield source, compose
+
+    def wait(self):
+        """
+        Wait for all submitted composes, state changes are printed as they happen
+
+        :return: dict source -> repository URL
+        :raises PDCExc: some compose failed
+        """
+        for source, compose in self.watch():
+            core.print_info("ODCS compose %s of %s: %s" % (compose["id"], source, compose["state_name"]))
+            if self.registry:
+                self.registry.put(self._key(source), compose, source)
+        failed = [x for x in self.composes if self.composes[x]["state_name"] != "done"]
+        for source in failed:
+            core.print_debug("ODCS compose debug info for: %s" % source, self.composes[source])
+        if failed:
+            raise mtfexceptions.PDCExc("ODCS: Failed to generate compose for module: %s" % " ".join(sorted(failed)))
+        return dict((source, repo_url(compose)) for source, compose in self.composes.items())
+
+    def compose(self, sources):
+        """
+        Request composes of all sources and wait for them
+
+        :param sources: list of module identifiers
+        :return: dict source -> repository URL
+        """
+        self.submit(sources)
+        return self.wait()
+
+
+def _fake_server(failing=(), seconds_to_live=86400):
+    """
+    Internal function, start fake ODCS server, every compose is generating for two polls and then it is done
+    (or failed when its source is in failing). Composes are available in attribute composes of server,
+    renewed compose IDs in attribute renewed.
+
+    :return: HTTPServer
+    """
+    import json
+    import threading
+    import BaseHTTPServer
+    import SocketServer
+
+    composes = {}
+    renewed = []
+    lock = threading.Lock()
+
+    def expire(seconds):
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + seconds))
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def _reply(self, data, code=200):
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(data))
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length"))))
+            with lock:
+                compose = {"id": len(composes) + 1, "state_name": "wait", "polls": 0,
+                           "source": request["source"]["source"], "result_repo": None,
+                           "time_to_expire": expire(seconds_to_live)}
+                composes[compose["id"]] = compose
+            self._reply(compose)
+
+        def do_GET(self):
+            compose = composes.get(int(self.path.rstrip("/").split("/")[-1]))
+            if compose is None:
+                return self._reply({"error": "Not Found"}, 404)
+            with lock:
+                compose["polls"] += 1
+                if compose["polls"] == 1:
+                    compose["state_name"] = "generating"
+                elif compose["polls"] == 3:
+                    compose["state_name"] = "failed" if compose["source"] in failing else "done"
+                    compose["result_repo"] = "http://odcs.example.com/composes/odcs-%d/compose/Temporary" % \
+                                             compose["id"]
+            self._reply(compose)
+
+        def do_PATCH(self):
+            compose = composes[int(self.path.rstrip("/").split("/")[-1])]
+            with lock:
+                renewed.append(compose["id"])
+                compose["time_to_expire"] = expire(86400)
+            self._reply(compose)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.composes = composes
+    server.renewed = renewed
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test_compose():
+    import shutil
+    import tempfile
+    from odcs.client.odcs import ODCS, AuthMech
+
+    server = _fake_server(failing=["broken:master"])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        client = ODCS("http://127.0.0.1:%d" % server.server_address[1], auth_mech=AuthMech.Anonymous)
+        registry = ComposeRegistry(os.path.join(tmpdir, "composes.json"))
+        sources = ["nodejs:8", "platform:master", "python3:master"]
+        orchestrator = ComposeOrchestrator(client, "module", timeout=60, new_compose_dict={}, registry=registry)
+        orchestrator.submit(sources)
+        events = list(orchestrator.watch())
+        assert [x[1]["state_name"] for x in events] == ["generating"] * 3 + ["done"] * 3
+        repos = orchestrator.wait()
+        assert sorted(repos) == sorted(sources)
+        assert repos["nodejs:8"].endswith("/compose/Temporary/%s/os" % common.conf["generic"]["arch"])
+        try:
+            ComposeOrchestrator(client, "module", timeout=60, new_compose_dict={}, registry=registry).compose(
+                ["broken:master", "nodejs:8"])
+        except mtfexceptions.PDCExc as e:
+            assert "broken:master" in str(e)
+        else:
+            assert False
+        # finished composes are reused without new requests, failed one is not stored
+        assert len(server.composes) == 4
+        assert ComposeOrchestrator(client, "module", timeout=60, new_compose_dict={},
+                                   registry=registry).compose(sources) == repos
+        assert len(server.composes) == 4
+        assert registry.get(ComposeRegistry.key(orchestrator.server, "broken:master", "module", {})) is None
+        # different compose options
+        ComposeOrchestrator(client, "module", timeout=60, new_compose_dict={"sigkeys": ["abc"]},
+                            registry=registry).submit(["nodejs:8"])
+        assert len(server.composes) == 5
+    finally:
+        shutil.rmtree(tmpdir)
+        server.shutdown()
+
+
+def test_registry_expiry():
+    import shutil
+    import tempfile
+    from odcs.client.odcs import ODCS, AuthMech
+
+    server = _fake_server(seconds_to_live=60)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        client = ODCS("http://127.0.0.1:%d" % server.server_address[1], auth_mech=AuthMech.Anonymous)
+        registry = ComposeRegistry(os.path.join(tmpdir, "composes.json"))
+        repos = ComposeOrchestrator(client, "module", timeout=60, new_compose_dict={},
+                                    registry=registry).compose(["nodejs:8"])
+        # compose expiring soon is renewed
+        assert ComposeOrchestrator(client, "module", timeout=60, new_compose_dict={},
+                                   registry=registry).compose(["nodejs:8"]) == repos
+        assert server.renewed == [1]
+        registry.put("old", {"id": 99, "state_name": "done", "time_to_expire": "2017-01-01T00:00:00Z"}, "old:1")
+        assert registry.get("old") is None
+    finally:
+        shutil.rmtree(tmpdir)
+        server.shutdown()
@@ -0,0 +1,689 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Minimal client of OpenShift (Kubernetes) REST API.
+HTTPS sessions are pooled per server and credentials of accounts are obtained just once,
+so that switching between accounts does not need oc login.
+It allows to wait for application via watch API (streamed events) instead of polling by oc commands.
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import atexit
+import base64
+import urllib
+import urlparse
+import tempfile
+import Queue
+import threading
+import requests
+
+import core
+import common
+import mtfexceptions
+
+# reasons of waiting containers, what never lead to running application without user action
+FAILURE_REASONS = ["ErrImagePull", "ImagePullBackOff", "CrashLoopBackOff", "InvalidImageName",
+                   "CreateContainerConfigError", "CreateContainerError", "RunContainerError"]
+PODS_PATH = "/api/v1/namespaces/{namespace}/pods"
+DC_PATH = "/apis/apps.openshift.io/v1/namespaces/{namespace}/deploymentconfigs"
+# pause between watch requests in case server closes stream immediately
+REWATCH_SLEEP = 1
+# resource name used by oc -> (API group path, plural name, namespaced)
+RESOURCES = {
+    "pod": ("/api/v1", "pods", True),
+    "svc": ("/api/v1", "services", True),
+    "dc": ("/apis/apps.openshift.io/v1", "deploymentconfigs", True),
+    "is": ("/apis/image.openshift.io/v1", "imagestreams", True),
+    "template": ("/apis/template.openshift.io/v1", "templates", True),
+    "project": ("/apis/project.openshift.io/v1", "projects", False),
+}
+RESOURCE_ALIASES = {"pods": "pod", "service": "svc", "services": "svc", "deploymentconfig": "dc",
+                    "imagestream": "is", "templates": "template", "projects": "project"}
+ADMIN_ACCOUNT = "system:admin"
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+# errors of REST API calls, callers fall back to oc client
+API_ERRORS = (requests.RequestException, ValueError, mtfexceptions.OpenShiftApiExc)
+
+_lock = threading.Lock()
+# (server, verify) -> requests.Session
+_sessions = {}
+# (server, account) -> dict with token or cert
+_contexts = {}
+_server = {}
+# docker registry address -> working URL scheme
+_registry_schemes = {}
+
+
+def get_session(server, verify):
+    """
+    Return keep-alive HTTP session shared by all clients of server
+
+    :param server: str API server URL
+    :param verify: bool verify server certificate (or str path of CA bundle), it applies just to this session
+    :return: requests.Session
+    """
+    with _lock:
+        if (server, verify) not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.verify = verify
+            _sessions[(server, verify)] = session
+        return _sessions[(server, verify)]
+
+
+def get_server(runner):
+    """
+    Return URL of API server, where oc client points to
+
+    :param runner: function running host command (CommonFunctions.runHost)
+    :return: str
+    """
+    if "url" not in _server:
+        out = runner("oc whoami --show-server", ignore_status=True, verbose=core.is_debug())
+        if out.exit_status != 0 or not out.stdout.strip():
+            raise mtfexceptions.OpenShiftApiExc("Unable to get OpenShift API server from oc client")
+        _server["url"] = out.stdout.strip().rstrip("/")
+    return _server["url"]
+
+
+def request_token(server, account, password, verify):
+    """
+    Get OAuth access token for account, same way as oc login does (challenging client)
+
+    :return: str
+    """
+    response = get_session(server, verify).get(
+        server + "/oauth/authorize", params={"response_type": "token", "client_id": "openshift-challenging-client"},
+        auth=(account, password), headers={"X-CSRF-Token": "1"}, allow_redirects=False, timeout=30)
+    fragment = urlparse.parse_qs(urlparse.urlparse(response.headers.get("Location", "")).fragment)
+    if not fragment.get("access_token"):
+        raise mtfexceptions.OpenShiftApiExc("Unable to get OAuth token for %s (HTTP %s)" %
+                                            (account, response.status_code))
+    return fragment["access_token"][0]
+
+
+def admin_certificate(runner):
+    """
+    Return client certificate and key files of system:admin from oc configuration, embedded data
+    are decoded to temporary directory removed at exit of process
+
+    :param runner: function running host command (CommonFunctions.runHost)
+    :return: dict with cert tuple (certificate file, key file) and user name in oc configuration
+    """
+    out = runner("oc config view --raw -o json", ignore_status=True, verbose=False)
+    if out.exit_status != 0:
+        raise mtfexceptions.OpenShiftApiExc("Unable to read oc configuration")
+    for user in json.loads(out.stdout).get("users") or []:
+        if not user.get("name", "").startswith(ADMIN_ACCOUNT + "/"):
+            continue
+        data = user.get("user", {})
+        if data.get("client-certificate") and data.get("client-key"):
+            return {"cert": (data["client-certificate"], data["client-key"]), "user": user["name"]}
+        if data.get("client-certificate-data") and data.get("client-key-data"):
+            certdir = tempfile.mkdtemp(prefix="mtf_oc_")
+            # private key must not stay on disk after test process
+            atexit.register(shutil.rmtree, certdir, True)
+            files = []
+            for item in ["client-certificate-data", "client-key-data"]:
+                filename = os.path.join(certdir, item)
+                with os.fdopen(os.open(filename, os.O_WRONLY | os.O_CREAT, 0o600), "w") as openfile:
+                    openfile.write(base64.b64decode(data[item]))
+                files.append(filename)
+            return {"cert": tuple(files), "user": user["name"]}
+    raise mtfexceptions.OpenShiftApiExc("There is no client certificate of %s in oc configuration" % ADMIN_ACCOUNT)
+
+
+def get_verify():
+    """
+    Return if certificate of API server is verified (openshift.api_verify_ssl in MTF config),
+    it is verified by default. Verification is disabled just for sessions of OpenShift API (see get_session).
+
+    :return: bool or str path of CA bundle
+    """
+    verify = common.conf.get("openshift", {}).get("api_verify_ssl", True)
+    return True if verify is None else verify
+
+
+class ApiClient(object):
+    """
+    Client of OpenShift REST API authenticated by bearer token or client certificate,
+    all clients of same server share one pool of connections
+    """
+
+    def __init__(self, server, token=None, cert=None, user=None, verify=None):
+        """
+
+        :param server: str API server URL like https://127.0.0.1:8443
+        :param token: str bearer token (oc whoami -t)
+        :param cert: tuple (certificate file, key file) for certificate based accounts (system:admin)
+        :param user: str name of user in oc configuration with the certificate
+        :param verify: bool verify server certificate, default from MTF config (openshift.api_verify_ssl)
+        """
+        self.server = server.rstrip("/")
+        self.verify = get_verify() if verify is None else verify
+        self.session = get_session(self.server, self.verify)
+        self.token = token
+        self.cert = cert
+        self.user = user
+        self.headers = {"Authorization": "Bearer %s" % token} if token else {}
+
+    @classmethod
+    def for_account(cls, runner, account=ADMIN_ACCOUNT, password=None):
+        """
+        Create client for account, credentials are obtained just once per account
+
+        :param runner: function running host command (CommonFunctions.runHost)
+        :param account: str user name, system:admin uses client certificate from oc configuration
+        :param password: str password of user
+        :return: ApiClient
+        """
+        server = get_server(runner)
+        verify = get_verify()
+        if (server, account) not in _contexts:
+            if password is not None:
+                context = {"token": request_token(server, account, password, verify)}
+            elif account == ADMIN_ACCOUNT:
+                context = admin_certificate(runner)
+            else:
+                raise mtfexceptions.OpenShiftApiExc("Password of %s is not known" % account)
+            _contexts[(server, account)] = context
+        return cls(server, verify=verify, **_contexts[(server, account)])
+
+    def oc_options(self):
+        """
+        Return oc options to run oc command with credentials of this client (without oc login)
+
+        :return: str
+        """
+        if self.token:
+            return "--token=%s" % self.token
+        if self.user:
+            return "--user=%s" % self.user
+        return ""
+
+    @classmethod
+    def from_oc(cls, runner):
+        """
+        Create client for server and user what oc client is logged in
+
+        :param runner: function running host command (CommonFunctions.runHost)
+        :return: ApiClient
+        """
+        server = get_server(runner)
+        token = runner("oc whoami -t", ignore_status=True, verbose=core.is_debug())
+        if token.exit_status != 0 or not token.stdout.strip():
+            raise mtfexceptions.OpenShiftApiExc("oc client is not logged in by token, REST API is not available")
+        return cls(server, token=token.stdout.strip())
+
+    def get(self, path, **params):
+        """
+        Return object or list of objects from API
+
+        :param path: str API path
+        :param params: query parameters
+        :return: dict
+        """
+        response = self.session.get(self.server + path, params=params, headers=self.headers, cert=self.cert,
+                                    timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def watch(self, path, timeout, **params):
+        """
+        Generator of watch events (dicts with type and object keys)
+
+        :param path: str API path of list
+        :param timeout: int how long server keeps stream opened
+        :param params: query parameters (labelSelector, resourceVersion)
+        :return: generator
+        """
+        params.update({"watch": "true", "timeoutSeconds": int(timeout)})
+        response = self.session.get(self.server + path, params=params, headers=self.headers, cert=self.cert,
+                                    stream=True, timeout=(10, timeout + 10))
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+    def resource_path(self, resource, namespace=None, name=None):
+        """
+        Return API path of resource
+
+        :param resource: str resource name as used by oc (pod, svc, dc, is, template, project)
+        :param namespace: str project, ignored for cluster wide resources
+        :param name: str name of object, path of list is returned without it
+        :return: str
+        """
+        resource = RESOURCE_ALIASES.get(resource, resource)
+        if resource not in RESOURCES:
+            raise mtfexceptions.OpenShiftApiExc("Resource %s is not supported by REST client" % resource)
+        prefix, plural, namespaced = RESOURCES[resource]
+        path = prefix
+        if namespaced:
+            path += "/namespaces/%s" % namespace
+        path += "/%s" % plural
+        if name:
+            path += "/%s" % urllib.quote(name)
+        return path
+
+    def list(self, resource, namespace=None, label_selector=None):
+        """
+        Return objects of resource
+
+        :param resource: str resource name as used by oc
+        :param namespace: str project
+        :param label_selector: str like app=memcached
+        :return: list of dicts
+        """
+        params = {"labelSelector": label_selector} if label_selector else {}
+        return self.get(self.resource_path(resource, namespace), **params).get("items") or []
+
+    def delete(self, resource, name, namespace=None):
+        """
+        Delete object
+
+        :param resource: str resource name as used by oc
+        :param name: str object name
+        :param namespace: str project
+        :return: bool, False when object does not exist
+        """
+        response = self.session.delete(self.server + self.resource_path(resource, namespace, name),
+                                       headers=self.headers, cert=self.cert, timeout=30)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    def create_project(self, name):
+        """
+        Create project (same as oc new-project)
+
+        :param name: str project name
+        :return: dict project object
+        """
+        body = {"kind": "ProjectRequest", "apiVersion": "project.openshift.io/v1", "metadata": {"name": name}}
+        response = self.session.post(self.server + "/apis/project.openshift.io/v1/projectrequests", json=body,
+                                     headers=self.headers, cert=self.cert, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+
+def pod_state(pod):
+    """
+    Return state of pod
+
+    :param pod: dict pod object
+    :return: tuple (state, reason), state is one of "ready", "failed", "pending"
+    """
+    status = pod.get("status", {})
+    if status.get("phase") == "Failed":
+        return "failed", "%s %s" % (status.get("reason", "Failed"), status.get("message", ""))
+    for container in status.get("containerStatuses", []) + status.get("initContainerStatuses", []):
+        waiting = container.get("state", {}).get("waiting") or {}
+        if waiting.get("reason") in FAILURE_REASONS:
+            return "failed", "%s: %s %s" % (container.get("name"), waiting.get("reason"), waiting.get("message", ""))
+    ready = [x for x in status.get("conditions", []) if x.get("type") == "Ready" and x.get("status") == "True"]
+    if status.get("phase") == "Running" and ready:
+        return "ready", None
+    return "pending", None
+
+
+def dc_state(dc):
+    """
+    Return state of deploymentconfig
+
+    :param dc: dict deploymentconfig object
+    :return: tuple (state, reason), state is one of "failed", "pending"
+    """
+    for condition in dc.get("status", {}).get("conditions", []):
+        if condition.get("type") == "Progressing" and condition.get("status") == "False":
+            return "failed", "%s %s" % (condition.get("reason"), condition.get("message", ""))
+    return "pending", None
+
+
+def is_application_pod(pod):
+    """
+    Return False for helper pods of OpenShift (deployer, builder)
+
+    :param pod: dict pod object
+    :return: bool
+    """
+    labels = pod.get("metadata", {}).get("labels", {})
+    return not [x for x in labels if x.startswith("openshift.io/deployer-pod") or x.startswith("openshift.io/build")]
+
+
+def _watch_resource(client, path, selector, deadline, kind, events, stop):
+    """
+    Internal function, push objects of one resource type to queue, list first and continue by watch
+
+    :return: None
+    """
+    try:
+        resource_version = None
+        while not stop.is_set() and time.time() < deadline:
+            if resource_version is None:
+                objects = client.get(path, labelSelector=selector)
+                for item in objects.get("items", []):
+                    events.put((kind, item))
+                resource_version = objects.get("metadata", {}).get("resourceVersion")
+            started = time.time()
+            for event in client.watch(path, max(1, deadline - time.time()),
+                                      labelSelector=selector, resourceVersion=resource_version):
+                if stop.is_set():
+                    return
+                if event.get("type") == "ERROR":
+                    # resource version is too old, list again
+                    resource_version = None
+                    break
+                resource_version = event["object"].get("metadata", {}).get("resourceVersion", resource_version)
+                if event.get("type") != "DELETED":
+                    events.put((kind, event["object"]))
+            if time.time() - started < REWATCH_SLEEP:
+                time.sleep(REWATCH_SLEEP)
+    except BaseException as e:
+        events.put(("error", e))
+
+
+def wait_for_app(client, namespace, app_name, timeout):
+    """
+    Wait until pod of application is running and ready, pods and deploymentconfigs with label app=<app_name>
+    are watched in parallel.
+
+    :param client: ApiClient
+    :param namespace: str project name
+    :param app_name: str application name (app label)
+    :param timeout: int seconds
+    :return: dict ready pod or None in case of timeout
+    :raises mtfexceptions.OpenShiftExc: pod or deployment failed (image pull, crash loop, deadline)
+    """
+    selector = "app=%s" % app_name
+    deadline = time.time() + timeout
+    events = Queue.Queue()
+    stop = threading.Event()
+    for kind, path in [("pod", PODS_PATH), ("dc", DC_PATH)]:
+        watcher = threading.Thread(target=_watch_resource,
+                                   args=(client, path.format(namespace=namespace), selector, deadline,
+                                         kind, events, stop))
+        watcher.daemon = True
+        watcher.start()
+    try:
+        while time.time() < deadline:
+            try:
+                kind, item = events.get(timeout=max(0.1, deadline - time.time()))
+            except Queue.Empty:
+                break
+            if kind == "error":
+                raise item
+            if kind == "pod" and is_application_pod(item):
+                state, reason = pod_state(item)
+            elif kind == "dc":
+                state, reason = dc_state(item)
+            else:
+                continue
+            core.print_debug("%s %s: %s %s" % (kind, item.get("metadata", {}).get("name"), state, reason or ""))
+            if state == "failed":
+                raise mtfexceptions.OpenShiftExc("Application %s failed to start: %s" % (app_name, reason))
+            if state == "ready":
+                return item
+        return None
+    finally:
+        stop.set()
+
+
+def _registry_get(session, url, user, token):
+    """
+    Internal function, GET request to docker registry, bearer token challenge is followed
+
+    :return: requests.Response
+    """
+    headers = {"Accept": MANIFEST_V2, "Authorization": "Bearer %s" % token}
+    response = session.get(url, headers=headers, timeout=30)
+    challenge = response.headers.get("WWW-Authenticate", "")
+    if response.status_code == 401 and challenge.startswith("Bearer "):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm", None)
+        if realm:
+            auth = session.get(realm, params=params, auth=(user, token), timeout=30)
+            auth.raise_for_status()
+            headers["Authorization"] = "Bearer %s" % (auth.json().get("token") or auth.json().get("access_token"))
+            response = session.get(url, headers=headers, timeout=30)
+    return response
+
+
+def registry_image_id(registry, repository, tag, user, token, verify=None, insecure=None):
+    """
+    Return ID of image (digest of its config) stored in docker registry, it is same as docker image ID
+    of local image, so that it is possible to check if image has to be pushed.
+    HTTPS is tried first, plain HTTP is used when HTTPS port is not reachable or when TLS fails
+    on insecure registry (registry of oc cluster up), token is never sent in cleartext after failed
+    verification of secure registry.
+
+    :param registry: str registry address like 172.30.1.1:5000
+    :param repository: str like project/name
+    :param tag: str image tag
+    :param user: str user name
+    :param token: str OpenShift token of user
+    :param verify: bool verify server certificate, default from MTF config (openshift.api_verify_ssl)
+    :param insecure: bool registry is plain HTTP, default from MTF config (openshift.insecure_registry)
+    :return: str or None when image is not in registry
+    """
+    verify = get_verify() if verify is None else verify
+    if insecure is None:
+        insecure = common.conf.get("openshift", {}).get("insecure_registry", False)
+    schemes = [_registry_schemes[registry]] if registry in _registry_schemes else ["https", "http"]
+    for scheme in schemes:
+        url = "%s://%s/v2/%s/manifests/%s" % (scheme, registry, repository, tag)
+        try:
+            response = _registry_get(get_session("%s://%s" % (scheme, registry), verify), url, user, token)
+        except requests.exceptions.SSLError as e:
+            if not insecure:
+                raise mtfexceptions.OpenShiftApiExc("TLS connection to docker registry %s failed, set "
+                                                    "openshift.insecure_registry for plain HTTP registry" % registry, e)
+            continue
+        except requests.exceptions.ConnectionError:
+            continue
+        _registry_schemes[registry] = scheme
+        if response.status_code in [401, 403, 404]:
+            return None
+        response.raise_for_status()
+        return response.json().get("config", {}).get("digest")
+    raise mtfexceptions.OpenShiftApiExc("Docker registry %s is not available" % registry)
+
+
+def wait_deleted(client, resource, name, namespace=None, timeout=60):
+    """
+    Wait until object is removed, deletion of project finishes asynchronously (server removes its content)
+
+    :param client: ApiClient
+    :param resource: str resource name as used by oc
+    :param name: str object name
+    :param namespace: str project
+    :param timeout: int seconds
+    :return: bool, False in case of timeout
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            client.get(client.resource_path(resource, namespace, name))
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
+                return True
+            raise
+        started = time.time()
+        for event in client.watch(client.resource_path(resource, namespace), max(1, deadline - time.time()),
+                                  fieldSelector="metadata.name=%s" % name):
+            if event.get("type") == "DELETED":
+                return True
+        if time.time() - started < REWATCH_SLEEP:
+            time.sleep(REWATCH_SLEEP)
+    return False
+
+
+def _fake_server(responses):
+    """
+    Internal function, start fake API server, it serves list and watch requests from responses dict
+    (path -> (list object, watch events)) and closes watch stream after last event,
+    path with None value is reported as not found
+
+    :return: HTTPServer
+    """
+    import BaseHTTPServer
+    import SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            if responses.get(url.path, True) is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            listobj, watchevents = responses.get(url.path, ({"items": []}, []))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            if "watch=true" in url.query:
+                for event in watchevents:
+                    self.wfile.write(json.dumps(event) + "\n")
+                    self.wfile.flush()
+            else:
+                self.wfile.write(json.dumps(listobj))
+
+        def do_DELETE(self):
+            self.send_response(200 if urlparse.urlparse(self.path).path in responses else 404)
+            self.end_headers()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+            self.send_response(201)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _fake_pod(name, phase, ready=False, waiting_reason=None, labels=None):
+    pod = {"metadata": {"name": name, "labels": dict({"app": "memcached"}, **(labels or {})), "resourceVersion": "2"},
+           "status": {"phase": phase, "conditions": [{"type": "Ready", "status": str(ready)}]}}
+    if waiting_reason:
+        pod["status"]["containerStatuses"] = [{"name": "memcached", "state": {"waiting": {"reason": waiting_reason}}}]
+    return pod
+
+
+def test_wait_for_app_ready():
+    path = PODS_PATH.format(namespace="test")
+    server = _fake_server({path: ({"metadata": {"resourceVersion": "1"},
+                                   "items": [_fake_pod("memcached-1-deploy", "Running", ready=True,
+                                                       labels={"openshift.io/deployer-pod-for.name": "memcached-1"})]},
+                                  [{"type": "ADDED", "object": _fake_pod("memcached-1-abc", "Pending")},
+                                   {"type": "MODIFIED", "object": _fake_pod("memcached-1-abc", "Running", True)}])})
+    client = ApiClient("http://127.0.0.1:%d" % server.server_address[1], token="token", verify=True)
+    # deployer pod is ignored although it is ready
+    pod = wait_for_app(client, "test", "memcached", timeout=10)
+    assert pod["metadata"]["name"] == "memcached-1-abc"
+    server.shutdown()
+
+
+def test_wait_for_app_failure():
+    path = PODS_PATH.format(namespace="test")
+    server = _fake_server({path: ({"metadata": {"resourceVersion": "1"}, "items": []},
+                                  [{"type": "ADDED",
+                                    "object": _fake_pod("memcached-1-abc", "Pending",
+                                                        waiting_reason="ImagePullBackOff")}])})
+    client = ApiClient("http://127.0.0.1:%d" % server.server_address[1], verify=True)
+    started = time.time()
+    try:
+        wait_for_app(client, "test", "memcached", timeout=30)
+    except mtfexceptions.OpenShiftExc as e:
+        assert "ImagePullBackOff" in str(e)
+    else:
+        assert False
+    assert time.time() - started < 10
+    server.shutdown()
+
+
+def test_typed_calls():
+    podpath = ApiClient("http://fake").resource_path("pod", "test")
+    server = _fake_server({podpath: ({"items": [_fake_pod("memcached-1-abc", "Running", True)]}, []),
+                           "/apis/project.openshift.io/v1/projects/test": ({}, [])})
+    client = ApiClient("http://127.0.0.1:%d" % server.server_address[1], token="token", verify=True)
+    assert client.oc_options() == "--token=token"
+    assert client.list("pods", "test", label_selector="app=memcached")[0]["metadata"]["name"] == "memcached-1-abc"
+    assert client.delete("project", "test")
+    assert not client.delete("svc", "memcached", "test")
+    assert client.create_project("new")["metadata"]["name"] == "new"
+    # clients of one server share connection pool
+    assert ApiClient(client.server, verify=True).session is client.session
+    server.shutdown()
+
+
+def test_wait_deleted():
+    project = {"metadata": {"name": "memcached-abc"}, "status": {"phase": "Terminating"}}
+    server = _fake_server({"/apis/project.openshift.io/v1/projects/memcached-abc": (project, []),
+                           "/apis/project.openshift.io/v1/projects": ({}, [{"type": "MODIFIED", "object": project},
+                                                                           {"type": "DELETED", "object": project}]),
+                           "/apis/project.openshift.io/v1/projects/memcached-xyz": None})
+    client = ApiClient("http://127.0.0.1:%d" % server.server_address[1], verify=True)
+    assert wait_deleted(client, "project", "memcached-abc", timeout=10)
+    assert wait_deleted(client, "project", "memcached-xyz", timeout=10)
+    server.shutdown()
+
+
+def test_registry_image_id():
+    server = _fake_server({"/v2/test/memcached/manifests/latest": ({"schemaVersion": 2, "mediaType": MANIFEST_V2,
+                                                                     "config": {"digest": "sha256:abc"}}, []),
+                           "/v2/test/other/manifests/latest": None})
+    registry = "127.0.0.1:%d" % server.server_address[1]
+    # fake server does not speak TLS, token is not sent over plain HTTP unless registry is insecure
+    try:
+        registry_image_id(registry, "test/memcached", "latest", "developer", "token", verify=True, insecure=False)
+    except mtfexceptions.OpenShiftApiExc:
+        pass
+    else:
+        assert False
+    assert registry not in _registry_schemes
+    assert registry_image_id(registry, "test/memcached", "latest", "developer", "token",
+                             verify=True, insecure=True) == "sha256:abc"
+    assert _registry_schemes[registry] == "http"
+    assert registry_image_id(registry, "test/other", "latest", "developer", "token", verify=True) is None
+    server.shutdown()
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+In-cluster execution of tests for OpenShift module type (mtf --in-cluster).
+
+Application is deployed just once, test files and config are shipped as ConfigMap into runner pod
+in the same project and avocado runs them there (MODULE=openshift, MTF_OPENSHIFT_IN_CLUSTER=yes),
+so that commands executed in application pod (oc exec) and connections to cluster IP of service
+do not leave the cluster. Results are streamed back in log of runner pod as avocado JSON between markers.
+"""
+
+from __future__ import print_function
+import os
+import json
+import time
+import pipes
+import shlex
+import tempfile
+import subprocess
+
+import core
+import common
+import mtfexceptions
+import project_pool
+
+RESULTS_BEGIN = "=== MTF RESULTS BEGIN ==="
+RESULTS_END = "=== MTF RESULTS END ==="
+TESTS_DIR = "/mtf/tests"
+RESULTS_FILE = "/tmp/mtf-results.json"
+DEFAULT_TIMEOUT = 3600
+# environment variables passed to runner pod
+PASSED_ENV = ["URL", "DEBUG", "AVOCADO_LOG_DEBUG", "MTF_DISABLE_MODULE", "MTF_REUSE"]
+
+
+def get_runner_conf():
+    """
+    Return openshift.runner section of MTF config
+
+    :return: dict
+    """
+    return common.conf.get("openshift", {}).get("runner") or {}
+
+
+def parse_log(lines):
+    """
+    Split log of runner pod to avocado output and results
+
+    :param lines: iterable of log lines
+    :return: generator of avocado output lines, results are stored to last item, which is dict
+    """
+    results = None
+    for line in lines:
+        stripped = line.rstrip("\n")
+        if stripped == RESULTS_BEGIN:
+            results = []
+        elif stripped == RESULTS_END and results is not None:
+            yield json.loads("".join(results))
+            return
+        elif results is not None:
+            results.append(stripped)
+        else:
+            yield stripped
+    yield None
+
+
+class InClusterRunner(object):
+    """
+    Runner pod executing tests inside project of deployed application
+    """
+
+    def __init__(self, helper, image=None, timeout=None):
+        """
+
+        :param helper: OpenShiftHelper with started application
+        :param image: str image containing MTF, avocado and oc client, default from MTF config (openshift.runner)
+        :param timeout: int seconds for all tests
+        """
+        conf = get_runner_conf()
+        self.helper = helper
+        self.image = image or conf.get("image")
+        self.timeout = int(timeout or conf.get("timeout") or DEFAULT_TIMEOUT)
+        if not self.image:
+            raise mtfexceptions.ConfigExc("Image of runner pod is not set (openshift.runner.image in MTF config)")
+        self.name = "mtf-runner-%s" % project_pool.unique_suffix()
+        self.project = helper.project_name
+        # path inside runner pod -> local path
+        self.paths = {}
+
+    def _oc(self, args, **kwargs):
+        return self.helper._oc("%s -n %s" % (args, self.project), **kwargs)
+
+    def ship(self, tests):
+        """
+        Create ConfigMap with test files and module config
+
+        :param tests: list of tests (files, optionally with :Class.method suffix)
+        :return: list of tests with paths inside runner pod
+        """
+        files = {}
+        pod_tests = []
+        for test in tests:
+            path, sep, method = test.partition(":")
+            if not os.path.isfile(path):
+                pod_tests.append(test)
+                continue
+            files[os.path.basename(path)] = path
+            self.paths[os.path.join(TESTS_DIR, os.path.basename(path))] = path
+            pod_tests.append(os.path.join(TESTS_DIR, os.path.basename(path)) + sep + method)
+        config = os.environ.get("CONFIG") or "config.yaml"
+        if os.path.isfile(config):
+            files[os.path.basename(config)] = config
+        options = " ".join("--from-file=%s=%s" % (key, pipes.quote(value)) for key, value in sorted(files.items()))
+        self._oc("create configmap %s %s" % (self.name, options), verbose=core.is_debug())
+        return pod_tests
+
+    def pod_spec(self, tests, avocado_args):
+        """
+        Return runner pod object
+
+        :param tests: list of tests inside runner pod
+        :param avocado_args: list of additional avocado arguments
+        :return: dict
+        """
+        env = {"MODULE": "openshift",
+               "MTF_OPENSHIFT_IN_CLUSTER": "yes",
+               "MTF_OPENSHIFT_POD": self.helper.pod_id or "",
+               "MTF_OPENSHIFT_PROJECT": self.project,
+               "GUESTIPADDR": self.helper.ip_address or "",
+               "CONFIG": os.path.join(TESTS_DIR, os.path.basename(os.environ.get("CONFIG") or "config.yaml"))}
+        for item in PASSED_ENV:
+            if os.environ.get(item):
+                env[item] = os.environ[item]
+        script = "cd {tests_dir} && avocado run --json {results} {args} 1>&2; rc=$?; " \
+                 "echo '{begin}'; cat {results}; echo; echo '{end}'; exit $rc".format(
+                     tests_dir=TESTS_DIR, results=RESULTS_FILE, begin=RESULTS_BEGIN, end=RESULTS_END,
+                     args=" ".join(pipes.quote(x) for x in avocado_args + tests))
+        return {"apiVersion": "v1",
+                "kind": "Pod",
+                "metadata": {"name": self.name, "labels": {"mtf_testing": "true", "app": self.name}},
+                "spec": {"restartPolicy": "Never",
+                         "activeDeadlineSeconds": self.timeout,
+                         "containers": [{"name": "runner",
+                                         "image": self.image,
+                                         "command": ["/bin/sh", "-c", script],
+                                         "env": [{"name": k, "value": v} for k, v in sorted(env.items())],
+                                         "volumeMounts": [{"name": "tests", "mountPath": TESTS_DIR}]}],
+                         "volumes": [{"name": "tests", "configMap": {"name": self.name}}]}}
+
+    def _pod_status(self):
+        """
+        Return status of runner pod (oc get -o json, jsonpath templates would be formatted by trans_dict)
+
+        :return: dict, empty when pod is not available
+        """
+        out = self._oc("get pod %s -o json" % self.name, ignore_status=True, verbose=False)
+        try:
+            return json.loads(out.stdout).get("status") or {}
+        except ValueError:
+            return {}
+
+    def _wait_for_start(self):
+        """
+        Wait until runner pod is not pending
+
+        :return: str pod phase
+        """
+        phase = "Pending"
+        for x in range(0, common.conf["openshift"]["init_wait"]):
+            phase = self._pod_status().get("phase", "")
+            if phase and phase != "Pending":
+                break
+            time.sleep(1)
+        return phase
+
+    def _logs(self):
+        """
+        Stream log of runner pod
+
+        :return: generator of lines
+        """
+        options = self.helper._api.oc_options() if self.helper._api else ""
+        cmd = ["oc"] + shlex.split(options) + ["logs", "-f", self.name, "-n", self.project]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            for line in iter(proc.stdout.readline, ""):
+                yield line
+        finally:
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+
+    def run(self, tests, avocado_args, json_path):
+        """
+        Run tests inside runner pod and store avocado JSON results
+
+        :param tests: list of local tests
+        :param avocado_args: list of additional avocado arguments
+        :param json_path: str where to store avocado JSON results
+        :return: int return code of avocado inside runner pod
+        """
+        # default service account is used by oc exec inside runner pod
+        self._oc("policy add-role-to-user edit -z default", ignore_status=True, verbose=core.is_debug())
+        pod_tests = self.ship(tests)
+        specfile = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        try:
+            json.dump(self.pod_spec(pod_tests, avocado_args), specfile)
+            specfile.close()
+            self._oc("create -f %s" % specfile.name, verbose=core.is_debug())
+        finally:
+            os.remove(specfile.name)
+        phase = self._wait_for_start()
+        if phase in ["Pending", ""]:
+            raise mtfexceptions.OpenShiftExc("Runner pod %s did not start" % self.name)
+        results = None
+        for item in parse_log(self._logs()):
+            if isinstance(item, dict) or item is None:
+                results = item
+            else:
+                print(item)
+        if results is None:
+            raise mtfexceptions.OpenShiftExc("Runner pod %s did not return results" % self.name)
+        # test IDs point to local files, so that failures are reported same way as for local run
+        for test in results.get("tests", []):
+            for podpath, localpath in self.paths.items():
+                test["id"] = test.get("id", "").replace(podpath, localpath)
+        with open(json_path, "w") as openfile:
+            json.dump(results, openfile)
+        statuses = self._pod_status().get("containerStatuses") or [{}]
+        exitcode = statuses[0].get("state", {}).get("terminated", {}).get("exitCode")
+        if isinstance(exitcode, int):
+            return exitcode
+        return 1 if results.get("failures") or results.get("errors") else 0
+
+    def cleanup(self):
+        """
+        Remove runner pod and ConfigMap with tests
+
+        :return: None
+        """
+        self._oc("delete pod,configmap %s --ignore-not-found" % self.name, ignore_status=True,
+                 verbose=core.is_debug())
+
+
+def run_tests(tests, avocado_args, json_path):
+    """
+    Deploy application, run tests inside cluster and remove application
+
+    :param tests: list of local tests
+    :param avocado_args: list of additional avocado arguments
+    :param json_path: str where to store avocado JSON results
+    :return: int return code
+    """
+    from moduleframework.helpers.openshift_helper import OpenShiftHelper
+    helper = OpenShiftHelper()
+    helper.setUp()
+    runner = None
+    try:
+        if helper.start() is False:
+            raise mtfexceptions.OpenShiftExc("Application %s was not started" % helper.app_name)
+        runner = InClusterRunner(helper)
+        return runner.run(tests, avocado_args, json_path)
+    finally:
+        if runner and common.get_if_do_cleanup():
+            runner.cleanup()
+        helper.tearDown()
+
+
+def test_parse_log():
+    results = {"tests": [{"id": "1-/mtf/tests/simple.py:Smoke.test", "status": "PASS"}], "failures": 0}
+    lines = ["JOB ID : 1\n", " (1/1) simple.py:Smoke.test: PASS\n", RESULTS_BEGIN + "\n"] + \
+            [x + "\n" for x in json.dumps(results, indent=2).splitlines()] + ["\n", RESULTS_END + "\n", "trailing\n"]
+    items = list(parse_log(lines))
+    assert items[:2] == ["JOB ID : 1", " (1/1) simple.py:Smoke.test: PASS"]
+    assert items[-1] == results
+    assert list(parse_log(["broken pod\n"])) == ["broken pod", None]
+
+
+def test_wait_for_start():
+    class Result(object):
+        def __init__(self, stdout, exit_status=0):
+            self.stdout = stdout
+            self.exit_status = exit_status
+
+    class Helper(object):
+        project_name = "memcached-test"
+        pod_id = "memcached-1-abc"
+        ip_address = "172.30.0.1"
+        _api = None
+
+        def _oc(self, args, **kwargs):
+            # same formatting as runHost
+            command = common.translate_cmd("oc %s" % args, translation_dict=common.trans_dict)
+            commands.append(command)
+            if len(commands) < 2:
+                return Result("", 1)
+            return Result(json.dumps({"status": {"phase": "Running" if len(commands) < 3 else "Succeeded",
+                                                 "containerStatuses": [{"state": {"terminated": {"exitCode": 3}}}]}}))
+
+    commands = []
+    saved = common.conf["openshift"].get("init_wait")
+    common.conf["openshift"]["init_wait"] = 5
+    try:
+        runner = InClusterRunner(Helper(), image="mtf-runner")
+        assert runner._wait_for_start() == "Running"
+        assert commands[-1] == "oc get pod %s -o json -n memcached-test" % runner.name
+        assert runner._pod_status()["containerStatuses"][0]["state"]["terminated"]["exitCode"] == 3
+        env = runner.pod_spec(["test.py"], [])["spec"]["containers"][0]["env"]
+        assert {"name": "MTF_OPENSHIFT_PROJECT", "value": "memcached-test"} in env
+    finally:
+        common.conf["openshift"]["init_wait"] = saved
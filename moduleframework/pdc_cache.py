@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Cache of PDC queries.
+
+Answers of PDC server are stored to <pdc.cache.dir>/<hash of query>.json and reused
+until they are older than pdc.cache.ttl seconds. Queries use shared HTTP client (see httpclient).
+
+Offline snapshot (MTF_PDC_SNAPSHOT or pdc.cache.snapshot) is JSON file with module records
+(including modulemd) indexed by name and stream, it is created by
+``mtf-pdc-module-info-reader --create-snapshot FILE`` for module and all its dependencies.
+When snapshot is used, PDC server is never contacted.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import requests
+
+import core
+import common
+import mtfexceptions
+import httpclient
+
+DEFAULT_CACHEDIR = "/var/cache/mtf/pdc"
+DEFAULT_TTL = 3600
+SNAPSHOT_FORMAT = 1
+REQUEST_TIMEOUT = 60
+_lock = threading.Lock()
+_caches = {}
+
+
+def get_cache_conf():
+    """
+    Return pdc.cache section of MTF config
+
+    :return: dict
+    """
+    return common.conf.get("pdc", {}).get("cache") or {}
+
+
+def get_snapshot_file():
+    """
+    Return offline snapshot file, MTF_PDC_SNAPSHOT overrides MTF config
+
+    :return: str or None
+    """
+    return os.environ.get("MTF_PDC_SNAPSHOT") or get_cache_conf().get("snapshot")
+
+
+def cache_key(server, query):
+    """
+    Return name of cache file of query
+
+    :param server: str PDC endpoint
+    :param query: dict query parameters
+    :return: str
+    """
+    return hashlib.sha1(json.dumps([server, query], sort_keys=True)).hexdigest()
+
+
+def _version_key(record):
+    version = str(record.get("version"))
+    return (0, int(version), "") if version.isdigit() else (1, 0, version)
+
+
+class Snapshot(object):
+    """
+    Offline snapshot of module records
+    """
+
+    def __init__(self, path=None):
+        """
+
+        :param path: str snapshot file, empty snapshot is created when it is None
+        :raises PDCExc: file is not snapshot
+        """
+        self.path = path
+        # name -> stream -> version -> record
+        self.index = {}
+        if path:
+            try:
+                with open(path) as openfile:
+                    data = json.load(openfile)
+            except (IOError, ValueError) as e:
+                raise mtfexceptions.PDCExc("Unable to read PDC snapshot %s: %s" % (path, e))
+            if data.get("format") != SNAPSHOT_FORMAT:
+                raise mtfexceptions.PDCExc("%s is not PDC snapshot of format %s" % (path, SNAPSHOT_FORMAT))
+            self.index = data["modules"]
+
+    def add(self, record):
+        """
+        Add module record (PDC result)
+
+        :param record: dict
+        :return: None
+        """
+        streams = self.index.setdefault(record["name"], {})
+        streams.setdefault(str(record["stream"]), {})[str(record["version"])] = record
+
+    def query(self, query):
+        """
+        Return records matching PDC query, in the same form as PDC server
+
+        :param query: dict with keys name, stream, version, active, name and stream could be lists
+        :return: dict with keys count and results (sorted by version)
+        """
+        def values(key):
+            value = query.get(key)
+            if value in [None, ""]:
+                return None
+            return [str(x) for x in value] if isinstance(value, list) else [str(value)]
+
+        results = []
+        names, streams, versions_filter = values("name"), values("stream"), values("version")
+        for name in names or []:
+            for stream, versions in self.index.get(name, {}).items():
+                if streams and stream not in streams:
+                    continue
+                for version, record in versions.items():
+                    if versions_filter and version not in versions_filter:
+                        continue
+                    if "active" in query and record.get("active", True) != query["active"]:
+                        continue
+                    results.append(record)
+        results.sort(key=_version_key)
+        return {"count": len(results), "results": results}
+
+    def save(self, path=None):
+        """
+        Store snapshot to file
+
+        :param path: str, default is file snapshot was loaded from
+        :return: None
+        """
+        path = path or self.path
+        with open(path, "w") as openfile:
+            json.dump({"format": SNAPSHOT_FORMAT, "modules": self.index}, openfile, indent=1, sort_keys=True)
+
+
+class PDCCache(object):
+    """
+    Cached PDC queries
+    """
+
+    def __init__(self, server=None, cachedir=None, ttl=None, snapshot=None):
+        """
+
+        :param server: str PDC modules endpoint, default pdc.pdc_server from MTF config
+        :param cachedir: str directory of cached answers, default from MTF config
+        :param ttl: int seconds, 0 disables disk cache
+        :param snapshot: str offline snapshot file, default MTF_PDC_SNAPSHOT or from MTF config
+        """
+        conf = get_cache_conf()
+        self.server = server or common.conf["pdc"]["pdc_server"]
+        self.cachedir = cachedir or conf.get("dir") or DEFAULT_CACHEDIR
+        self.ttl = int(conf.get("ttl", DEFAULT_TTL) if ttl is None else ttl)
+        snapshot = snapshot or get_snapshot_file()
+        self.snapshot = Snapshot(snapshot) if snapshot else None
+        # answers of this process, PDC data do not change during test session
+        self.memory = {}
+
+    def _cachefile(self, query):
+        return os.path.join(self.cachedir, "%s.json" % cache_key(self.server, query))
+
+    def _load(self, query):
+        """
+        Internal method, return cached answer younger than TTL
+
+        :param query: dict
+        :return: dict or None
+        """
+        cachefile = self._cachefile(query)
+        try:
+            if time.time() - os.path.getmtime(cachefile) > self.ttl:
+                return None
+            with open(cachefile) as openfile:
+                return json.load(openfile)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _store(self, query, data):
+        """
+        Internal method, store answer to disk cache, failures are ignored (e.g. read only cache)
+
+        :param query: dict
+        :param data: dict
+        :return: None
+        """
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            fd, tmpname = tempfile.mkstemp(dir=self.cachedir, prefix=".pdc")
+            with os.fdopen(fd, "w") as openfile:
+                json.dump(data, openfile)
+            os.rename(tmpname, self._cachefile(query))
+        except (IOError, OSError) as e:
+            core.print_debug("Unable to store PDC answer to cache %s" % self.cachedir, e)
+
+    def fetch(self, query):
+        """
+        Query PDC server, with retries
+
+        :param query: dict
+        :return: dict
+        """
+        attempts = common.conf["generic"]["retrycount"]
+        for attempt in range(attempts):
+            try:
+                core.print_debug("PDC query %s %s" % (self.server, query))
+                response = httpclient.request("GET", self.server, params=query, timeout=REQUEST_TIMEOUT)
+                response.raise_for_status()
+                return response.json()
+            except (requests.RequestException, ValueError) as e:
+                core.print_debug("PDC query failed", e)
+                if attempt + 1 < attempts:
+                    time.sleep(common.conf["generic"]["retrytimeout"])
+        raise mtfexceptions.PDCExc("Could not query PDC server")
+
+    def query(self, query):
+        """
+        Return answer of PDC query, from snapshot, memory, disk cache or PDC server
+
+        :param query: dict
+        :return: dict with keys count and results
+        """
+        if self.snapshot:
+            return self.snapshot.query(query)
+        key = cache_key(self.server, query)
+        if key not in self.memory:
+            data = self._load(query) if self.ttl else None
+            if data is None:
+                data = self.fetch(query)
+                if self.ttl:
+                    self._store(query, data)
+            self.memory[key] = data
+        return self.memory[key]
+
+
+def get_cache():
+    """
+    Return PDC cache shared by process
+
+    :return: PDCCache
+    """
+    key = (common.conf["pdc"]["pdc_server"], get_snapshot_file())
+    with _lock:
+        if key not in _caches:
+            _caches[key] = PDCCache()
+        return _caches[key]
+
+
+def _fake_server(records, requested):
+    """
+    Internal function, start fake PDC modules endpoint serving records, parameters name and stream
+    can be repeated (list query), page_size=-1 returns plain list like PDC
+
+    :param records: list of module records
+    :param requested: list, parameters of every request are appended to it
+    :return: HTTPServer
+    """
+    import BaseHTTPServer
+    import SocketServer
+    import urlparse
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            requested.append(query)
+            results = [x for x in records if x["name"] in query["name"] and
+                       ("stream" not in query or x["stream"] in query["stream"])]
+            self.send_response(200)
+            self.end_headers()
+            if query.get("page_size") == ["-1"]:
+                self.wfile.write(json.dumps(results))
+            else:
+                self.wfile.write(json.dumps({"count": len(results), "results": results}))
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test_cache():
+    import shutil
+
+    records = [{"name": "mod", "stream": "f26", "version": "20170101", "active": True, "modulemd": "data: {}"},
+               {"name": "mod", "stream": "f26", "version": "20171231", "active": True, "modulemd": "data: {}"}]
+    requested = []
+    server = _fake_server(records, requested)
+    cachedir = tempfile.mkdtemp()
+    try:
+        url = "http://127.0.0.1:%d/rest_api/v1/modules/" % server.server_address[1]
+        query = {"name": "mod", "stream": "f26", "active": True}
+        assert PDCCache(url, cachedir, 60).query(query)["count"] == 2
+        assert PDCCache(url, cachedir, 60).query(query)["count"] == 2
+        # second instance used disk cache
+        assert len(requested) == 1
+        assert PDCCache(url, cachedir, 0).query(query)["count"] == 2
+        assert len(requested) == 2
+        snapshotfile = os.path.join(cachedir, "snapshot.json")
+        snapshot = Snapshot()
+        for record in records:
+            snapshot.add(record)
+        snapshot.save(snapshotfile)
+        offline = PDCCache("http://127.0.0.1:1/", cachedir, 60, snapshot=snapshotfile)
+        assert offline.query(query)["results"][-1]["version"] == "20171231"
+        assert offline.query({"name": "mod", "version": 20170101})["count"] == 1
+        assert offline.query({"name": ["other", "mod"], "stream": ["f26"]})["count"] == 2
+        assert offline.query({"name": "other", "active": True})["count"] == 0
+        assert len(requested) == 2
+    finally:
+        shutil.rmtree(cachedir)
+        server.shutdown()
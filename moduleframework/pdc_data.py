@@ -32,8 +32,7 @@ import yaml
 import os
 import sys
 from avocado.utils import process
-from pdc_client import PDCClient
-import core, common, mtfexceptions, timeoutlib
+import core, common, mtfexceptions, timeoutlib, image_gc, koji_download, rpmstore, pdc_cache, dep_resolver, odcs_compose
 
 
 def get_module_nsv(name=None, stream=None, version=None):
@@ -85,13 +84,8 @@ class PDCParserGeneral():
                 pdc_query['stream'] = stream
             if version:
                 pdc_query['version'] = version
-            @timeoutlib.Retry(attempts=common.conf["generic"]["retrycount"], timeout=common.conf["generic"]["retrytimeout"], error=mtfexceptions.PDCExc("Could not query PDC server"))
-            def retry_tmpfunc():
-                # Using develop=True to not authenticate to the server
-                pdc_session = PDCClient(common.conf["pdc"]["pdc_server"], ssl_verify=True, develop=True)
-                core.print_debug(pdc_session, pdc_query)
-                return pdc_session(**pdc_query)
-            mod_info = retry_tmpfunc()
+            # answers are cached on disk (pdc.cache in MTF config) or read from offline snapshot
+            mod_info = pdc_cache.get_cache().query(pdc_query)
             if not mod_info or "results" not in mod_info.keys() or not mod_info["results"]:
                 raise mtfexceptions.PDCExc("QUERY: %s is not available on PDC" % pdc_query)
             self.pdcdata = mod_info["results"][-1]
@@ -153,20 +147,29 @@ class PDCParserGeneral():
         return self.getmoduleMD().get("data", {}).get("dependencies", {}).get("requires", {})
 
     def generateDepModules(self):
-        if  self.moduledeps is None:
-            rootdepdict = {}
-            self.__generateDepModules_solver(parentdict=rootdepdict)
-            self.moduledeps = rootdepdict
+        """
+        Return all dependencies of module (name -> stream), resolved concurrently level by level
+
+        :return: dict
+        """
+        if self.moduledeps is None:
+            resolution = dep_resolver.DependencyResolver().resolve(
+                self.name, self.stream, requires=self.__get_module_requires())
+            self.moduledeps = resolution["modules"]
         return self.moduledeps
 
-    def __generateDepModules_solver(self, parentdict):
-        deps = self.__get_module_requires()
-        core.print_debug("tree traverse from %s: %s"% (self.name, deps))
-        for dep in deps:
-            if dep not in parentdict:
-                parentdict[dep] = deps[dep]
-                a = PDCParser(dep, deps[dep])
-                a.__generateDepModules_solver(parentdict=parentdict)
+    def create_snapshot(self, path):
+        """
+        Store PDC records of module and all its dependencies to offline snapshot file (see pdc_cache)
+
+        :param path: str snapshot file
+        :return: None
+        """
+        snapshot = pdc_cache.Snapshot()
+        snapshot.add(self.get_pdc_info())
+        for dep, stream in self.generateDepModules().items():
+            snapshot.add(PDCParserGeneral(dep, stream).get_pdc_info())
+        snapshot.save(path)
 
     def get_module_identifier(self):
         if self.version:
@@ -178,16 +181,36 @@ class PDCParserGeneral():
 
 
 class PDCParserKoji(PDCParserGeneral):
-    def download_tagged(self,dirname):
+    def download_tagged(self, dirname, tags=None):
         """
         Downloads packages to directory, based on koji tags
-        It downloads just ARCH and noarch packages
+        It downloads just ARCH and noarch packages, in parallel and resumable when python koji library is available
 
         :param dirname: string
+        :param tags: list of koji tags, default is tag of this module
         :return: None
         """
+        tags = tags or [self.get_pdc_info()["koji_tag"]]
         core.print_info("DOWNLOADING ALL packages for %s_%s_%s" % (self.name, self.stream, self.version))
-        for foo in process.run("koji list-tagged --quiet %s" % self.get_pdc_info()["koji_tag"], verbose=core.is_debug()).stdout.split("\n"):
+        try:
+            downloader = koji_download.KojiDownloader(dirname)
+        except ImportError as e:
+            core.print_debug("Python koji library is not available, using koji client", e)
+            for tag in tags:
+                self._download_tagged_cli(dirname, tag)
+            core.print_info("DOWNLOADING finished")
+        else:
+            downloader.download(tags)
+
+    def _download_tagged_cli(self, dirname, tag):
+        """
+        Downloads packages of koji tag to directory, build by build via koji client
+
+        :param dirname: string
+        :param tag: koji tag
+        :return: None
+        """
+        for foo in process.run("koji list-tagged --quiet %s" % tag, verbose=core.is_debug()).stdout.split("\n"):
             pkgbouid = foo.strip().split(" ")[0]
             if len(pkgbouid) > 4:
                 core.print_debug("DOWNLOADING: %s" % foo)
@@ -209,18 +232,17 @@ class PDCParserKoji(PDCParserGeneral):
                                 'UNABLE TO DOWNLOAD package (KOJI issue, BAD):', a.command)
 
                 tmpfunc()
-        core.print_info("DOWNLOADING finished")
 
     def get_repo(self):
         """
         Return string of generated repository located LOCALLY
-        It downloads all tagged packages and creates repo via createrepo
+        It downloads all tagged packages (just RPMs missing in RPM store) and creates repo via createrepo_c,
+        metadata of previous version of module are updated
 
         :return: str
         """
         dir_prefix = common.conf["nspawn"]["basedir"]
-        process.run("{HOSTPACKAGER} install createrepo koji".format(
-            **common.trans_dict), ignore_status=True)
+        rpmstore.ensure_tools()
         if common.is_recursive_download():
             dirname = os.path.join(dir_prefix,"localrepo_recursive")
         else:
@@ -232,47 +254,37 @@ class PDCParserKoji(PDCParserGeneral):
         else:
             if not os.path.exists(absdir):
                 os.mkdir(absdir)
-            self.download_tagged(absdir)
+            tags = [self.get_pdc_info()["koji_tag"]]
             if common.is_recursive_download():
                 allmodules = self.generateDepModules()
                 for mo in allmodules:
-                    localrepo = PDCParserKoji(mo, allmodules[mo])
-                    localrepo.download_tagged(dirname)
+                    tags.append(PDCParserKoji(mo, allmodules[mo]).get_pdc_info()["koji_tag"])
+            # packages of all modules are downloaded by one pool of workers
+            self.download_tagged(absdir, tags=tags)
 
-            process.run(
-                "cd %s; createrepo -v %s" %
-                (absdir, absdir), shell=True, verbose=core.is_debug())
+            rpmstore.createrepo(absdir)
+        image_gc.touch([absdir])
         return "file://%s" % absdir
 
 
 class PDCParserODCS(PDCParserGeneral):
     compose_type = common.conf["odcs"]["compose_type"]
-    odcsauth = common.conf["odcs"]["auth"]
 
     def get_repo(self):
-        # import moved here, to avoid messages when you don't need to use ODCS
-        from odcs.client.odcs import ODCS, AuthMech
-
-        if self.odcsauth.get("auth_mech") == AuthMech.OpenIDC:
-            if not self.odcsauth.get("openidc_token"):
-                self.odcsauth["openidc_token"] = common.get_openidc_auth()
-        odcs = ODCS(common.conf["odcs"]["url"], **self.odcsauth)
-        core.print_debug("ODCS Starting module composing: %s" % odcs,
-                    "%s compose for: %s" % (self.compose_type, self.get_module_identifier()))
-        compose_builder = odcs.new_compose(self.get_module_identifier(),
-                                           self.compose_type,
-                                           **common.conf["odcs"]["new_compose_dict"])
-        timeout_time=common.conf["odcs"]["timeout"]
-        core.print_debug("ODCS Module compose started, timeout set to %ss" % timeout_time)
-        compose_state = odcs.wait_for_compose(compose_builder["id"], timeout=timeout_time)
-        core.print_debug("ODCS compose debug info for: %s" % self.get_module_identifier(), compose_state)
-        if compose_state["state_name"] == "done":
-            compose = "{compose}/{arch}/os".format(compose=compose_state["result_repo"], arch=common.conf["generic"]["arch"])
-            core.print_info("ODCS Compose done, URL with repo file", compose)
-            return compose
-        else:
-            raise mtfexceptions.PDCExc("ODCS: Failed to generate compose for module: %s" %
-                                       self.get_module_identifier())
+        """
+        Return repository composed by ODCS, in recursive mode (MTF_RECURSIVE_DOWNLOAD)
+        composes of all dependencies are requested together and semicolon separated repositories are returned
+
+        :return: str
+        """
+        sources = [self.get_module_identifier()]
+        if common.is_recursive_download():
+            sources += ["%s:%s" % (dep, stream) for dep, stream in sorted(self.generateDepModules().items())]
+        timeout_time = common.conf["odcs"]["timeout"]
+        core.print_debug("ODCS Module composes started, timeout set to %ss" % timeout_time)
+        repos = odcs_compose.ComposeOrchestrator(compose_type=self.compose_type, timeout=timeout_time).compose(sources)
+        core.print_info("ODCS Compose done, URL with repo file", repos[sources[0]])
+        return ";".join(repos[source] for source in sources)
 
 
 def get_repo_url(wmodule="base-runtime", wstream=None):
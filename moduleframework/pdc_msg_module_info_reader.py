@@ -49,6 +49,11 @@ def cli():
         dest="commit",
         action="store_true",
         help="print git commit hash of exact version of module")
+    parser.add_argument(
+        "--create-snapshot",
+        dest="snapshot",
+        help="store PDC data of module and its dependencies to offline snapshot file (used by MTF_PDC_SNAPSHOT)",
+        default=None)
     return parser.parse_args()
 
 
@@ -80,7 +85,9 @@ def main():
     elif options.latest:
         name = options.latest
     pdc_solver = pdc_data.PDCParser(name, stream, version)
-    if options.commit:
+    if options.snapshot:
+        pdc_solver.create_snapshot(options.snapshot)
+    elif options.commit:
         print(pdc_solver.generateGitHash())
     else:
         print(" ".join(pdc_solver.generateParams()))
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Shared host cache of repository metadata and RPM packages.
+All dnf/yum calls done by MTF (image builds, host and guest installs) use same cache directory,
+so that metadata and packages are downloaded just once per repository URL.
+"""
+
+from __future__ import print_function
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from argparse import ArgumentParser
+
+import core
+import common
+
+DEFAULT_CACHEDIR = "/var/cache/mtf/pkgcache"
+DEFAULT_MAX_SIZE = 4096
+DEFAULT_METADATA_EXPIRE = "6h"
+# packagers what understand --setopt (cachedir, keepcache, repo.metadata_expire)
+SETOPT_PACKAGERS = ["dnf", "yum"]
+
+
+def get_cache_conf():
+    """
+    Return pkgcache section of MTF config
+
+    :return: dict
+    """
+    return common.conf.get("pkgcache") or {}
+
+
+def is_enabled():
+    """
+    Return the opposite of the **MTF_DISABLE_PKGCACHE** envvar.
+
+    :return: bool
+    """
+    return not bool(os.environ.get("MTF_DISABLE_PKGCACHE"))
+
+
+def get_cachedir():
+    """
+    Return directory of shared package cache, it can be overridden by **MTF_PKGCACHE_DIR** envvar.
+
+    :return: str
+    """
+    return os.environ.get("MTF_PKGCACHE_DIR") or get_cache_conf().get("dir") or DEFAULT_CACHEDIR
+
+
+def get_max_size():
+    """
+    Return maximal size of cache in MB
+
+    :return: int
+    """
+    return int(get_cache_conf().get("max_size", DEFAULT_MAX_SIZE))
+
+
+def repo_id(url):
+    """
+    Return stable repository id for repository URL.
+    Same URL leads to same id in every image, host and guest, so dnf reuses its cached metadata.
+
+    :param url: str repository baseurl
+    :return: str
+    """
+    return "mtf-%s" % hashlib.md5(url).hexdigest()[:12]
+
+
+def local_repo_paths(repos):
+    """
+    Return list of host directories of local (file://) repositories
+
+    :param repos: list of repository URLs
+    :return: list
+    """
+    return [repo[7:] for repo in repos if repo.startswith("file:///")]
+
+
+def metadata_expire(url):
+    """
+    Return metadata expiration for repository URL, local repositories are always refreshed,
+    because they are recreated in place.
+
+    :param url: str
+    :return: str
+    """
+    if url.startswith("file://"):
+        return "0"
+    return str(get_cache_conf().get("metadata_expire", DEFAULT_METADATA_EXPIRE))
+
+
+def packager_options(packager, repos=None):
+    """
+    Return packager command line options to use shared cache.
+    Empty string is returned for packagers without --setopt support (microdnf, apt-get)
+
+    :param packager: str packager command like "dnf -y"
+    :param repos: list of repository URLs used by packager (with ids generated by repo_id)
+    :return: str
+    """
+    if not is_enabled() or not packager:
+        return ""
+    if os.path.basename(packager.split()[0]) not in SETOPT_PACKAGERS:
+        return ""
+    options = ["--setopt=cachedir=%s" % get_cachedir(), "--setopt=keepcache=True"]
+    for repo in repos or []:
+        options.append("--setopt=%s.metadata_expire=%s" % (repo_id(repo), metadata_expire(repo)))
+    return " ".join(options)
+
+
+def repo_file_content(repos):
+    """
+    Return content of yum/dnf .repo file for list of repositories
+
+    :param repos: list of repository URLs
+    :return: str
+    """
+    content = ""
+    for repo in repos:
+        content += """[%s]
+name=%s
+baseurl=%s
+enabled=1
+gpgcheck=0
+metadata_expire=%s
+
+""" % (repo_id(repo), repo_id(repo), repo, metadata_expire(repo))
+    return content
+
+
+def prepare():
+    """
+    Create cache directory if it does not exist
+
+    :return: str cache directory
+    """
+    cachedir = get_cachedir()
+    if is_enabled() and not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    return cachedir
+
+
+def touch(repos):
+    """
+    Mark cached data of repositories as recently used (LRU eviction uses mtime)
+
+    :param repos: list of repository URLs
+    :return: None
+    """
+    cachedir = get_cachedir()
+    if not os.path.isdir(cachedir):
+        return
+    ids = [repo_id(repo) for repo in repos]
+    for item in os.listdir(cachedir):
+        if [x for x in ids if item.startswith(x)]:
+            os.utime(os.path.join(cachedir, item), None)
+
+
+def path_size(path):
+    """
+    Return size of file or directory tree in bytes
+
+    :param path: str
+    :return: int
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for item in files:
+            try:
+                size += os.lstat(os.path.join(root, item)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def evict(max_size=None, cachedir=None):
+    """
+    Remove least recently used items from cache, until cache fits to max_size
+
+    :param max_size: int size in MB, default value is from config, 0 means remove everything
+    :param cachedir: str directory of cache, default is get_cachedir()
+    :return: list of removed paths
+    """
+    cachedir = cachedir or get_cachedir()
+    max_size = get_max_size() if max_size is None else max_size
+    removed = []
+    if not os.path.isdir(cachedir):
+        return removed
+    entries = []
+    for item in os.listdir(cachedir):
+        path = os.path.join(cachedir, item)
+        entries.append((os.lstat(path).st_mtime, path, path_size(path)))
+    total = sum([x[2] for x in entries])
+    for mtime, path, size in sorted(entries):
+        if total <= max_size * 1024 * 1024:
+            break
+        core.print_debug("pkgcache evict: %s (%d bytes, last used %s)" % (path, size, time.ctime(mtime)))
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        total -= size
+        removed.append(path)
+    return removed
+
+
+def enforce_limit():
+    """
+    Keep cache in configured size limit, called after every install
+
+    :return: list of removed paths
+    """
+    if not is_enabled():
+        return []
+    return evict()
+
+
+def main():
+    parser = ArgumentParser(description="Evict MTF shared cache of repository metadata and packages")
+    parser.add_argument("--max-size", dest="max_size", type=int, default=None,
+                        help="evict least recently used repositories above this size in MB (default from config)")
+    parser.add_argument("--all", dest="all", action="store_true", default=False,
+                        help="remove whole cache")
+    args = parser.parse_args()
+    max_size = 0 if args.all else args.max_size
+    for path in evict(max_size=max_size):
+        print("removed: %s" % path)
+    print("cache %s size: %d MB" % (get_cachedir(), path_size(get_cachedir()) / 1024 / 1024
+                                    if os.path.exists(get_cachedir()) else 0))
+
+
+def test_repo_id():
+    url = "http://example.com/repo/"
+    assert repo_id(url) == repo_id(url)
+    assert repo_id(url) != repo_id(url + "x")
+    assert repo_id(url).startswith("mtf-")
+    assert "%s.metadata_expire" % repo_id(url) in packager_options("dnf -y", [url])
+    assert not packager_options("microdnf", [url])
+    assert local_repo_paths(["file:///opt/localrepo", url]) == ["/opt/localrepo"]
+
+
+def test_evict():
+    cachedir = tempfile.mkdtemp()
+    for counter, item in enumerate(["old", "new"]):
+        os.makedirs(os.path.join(cachedir, item))
+        with open(os.path.join(cachedir, item, "data"), "w") as datafile:
+            datafile.write("x" * 1024 * 1024)
+        os.utime(os.path.join(cachedir, item), (counter, counter))
+    assert evict(max_size=1, cachedir=cachedir) == [os.path.join(cachedir, "old")]
+    assert os.listdir(cachedir) == ["new"]
+    evict(max_size=0, cachedir=cachedir)
+    assert not os.listdir(cachedir)
+    shutil.rmtree(cachedir)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Pool of pre-created OpenShift projects.
+
+Creation and finalization of project are slow, so that tests lease project from the pool,
+objects created by test (label mtf_testing=true) are wiped after test and project is returned to the pool.
+Lease is exclusive flock of <lockdir>/<project>.lock, so that parallel tests on one host never share project,
+pools of different hosts have different project names.
+"""
+
+import os
+import uuid
+import fcntl
+import socket
+import hashlib
+
+import core
+import common
+
+DEFAULT_PREFIX = "mtf-pool"
+DEFAULT_LOCKDIR = "/var/tmp/mtf_project_pool"
+QUOTA_NAME = "mtf-pool"
+# label of all objects created by oc new-app in OpenShiftHelper
+WIPE_LABEL = "mtf_testing=true"
+
+
+def get_pool_conf():
+    """
+    Return openshift.project_pool section of MTF config
+
+    :return: dict
+    """
+    return common.conf.get("openshift", {}).get("project_pool") or {}
+
+
+def get_size():
+    """
+    Return number of projects in pool, 0 means pool is disabled
+
+    :return: int
+    """
+    return int(get_pool_conf().get("size") or 0)
+
+
+def unique_suffix():
+    """
+    Return suffix of project name, which is unique also for tests started in parallel on many hosts
+
+    :return: str
+    """
+    return uuid.uuid4().hex[:10]
+
+
+def _host_id():
+    return hashlib.sha1(socket.gethostname()).hexdigest()[:6]
+
+
+class ProjectPool(object):
+    """
+    Pool of projects leased by tests
+    """
+
+    def __init__(self, oc, admin_oc=None, size=None, prefix=None, quota=None, lockdir=None):
+        """
+
+        :param oc: function running oc command as user (OpenShiftHelper._oc), projects are owned by this user
+        :param admin_oc: function running oc command as cluster admin, used for quotas (default oc)
+        :param size: int number of projects, default from MTF config
+        :param prefix: str prefix of project names, default from MTF config
+        :param quota: str hard limits of quota of every project like pods=10,requests.memory=4Gi
+        :param lockdir: str directory of lease locks
+        """
+        conf = get_pool_conf()
+        self.oc = oc
+        self.admin_oc = admin_oc or oc
+        self.size = get_size() if size is None else size
+        self.prefix = prefix or conf.get("prefix") or DEFAULT_PREFIX
+        self.quota = conf.get("quota") if quota is None else quota
+        self.lockdir = lockdir or conf.get("lockdir") or DEFAULT_LOCKDIR
+
+    def names(self):
+        """
+        Return names of projects in pool
+
+        :return: list
+        """
+        return ["%s-%s-%d" % (self.prefix, _host_id(), x) for x in range(self.size)]
+
+    def existing(self):
+        """
+        Return names of existing projects (visible to user)
+
+        :return: set
+        """
+        out = self.oc("get projects -o name", ignore_status=True, verbose=core.is_debug())
+        return set(line.strip().split("/")[-1] for line in out.stdout.splitlines() if line.strip())
+
+    def _statefile(self):
+        return os.path.join(self.lockdir, "projects")
+
+    def ensure(self):
+        """
+        Create missing projects of pool together with their quotas,
+        it runs under host lock, so that parallel tests do not create same projects.
+        Created projects are stored in state file, cluster is not checked again while it matches.
+
+        :return: None
+        """
+        if not os.path.isdir(self.lockdir):
+            os.makedirs(self.lockdir)
+        with open(os.path.join(self.lockdir, "ensure.lock"), "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if os.path.exists(self._statefile()) and open(self._statefile()).read().split() == self.names():
+                return
+            existing = self.existing()
+            missing = False
+            for name in self.names():
+                if name in existing:
+                    continue
+                core.print_info("Creating project %s of project pool" % name)
+                out = self.oc("new-project %s --skip-config-write" % name, ignore_status=True,
+                              verbose=core.is_debug())
+                if out.exit_status != 0:
+                    core.print_info("Unable to create project %s: %s" % (name, out.stderr))
+                    missing = True
+                    continue
+                if self.quota:
+                    out = self.admin_oc("create quota %s --hard=%s -n %s" % (QUOTA_NAME, self.quota, name),
+                                        ignore_status=True, verbose=core.is_debug())
+                    if out.exit_status != 0:
+                        core.print_info("Unable to set quota of project %s: %s" % (name, out.stderr))
+            if not missing:
+                with open(self._statefile(), "w") as statefile:
+                    statefile.write("\n".join(self.names()))
+
+    def invalidate(self):
+        """
+        Forget state of pool, projects are checked by next ensure() (e.g. project was deleted by someone else)
+
+        :return: None
+        """
+        if os.path.exists(self._statefile()):
+            os.remove(self._statefile())
+
+    def _lockfile(self, name):
+        return os.path.join(self.lockdir, "%s.lock" % name)
+
+    def lease(self):
+        """
+        Lease free project of pool. Lock file contains name of project while it is leased,
+        project is wiped first in case previous test did not return it (crash)
+
+        :return: tuple (project name, lock file) or None when all projects are leased
+        """
+        self.ensure()
+        for name in self.names():
+            handle = open(self._lockfile(name), "a+")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                handle.close()
+                continue
+            handle.seek(0)
+            if handle.read().strip():
+                self.wipe(name)
+            handle.truncate(0)
+            handle.write(name)
+            handle.flush()
+            core.print_debug("Leased project %s" % name)
+            return name, handle
+        core.print_info("All %d projects of project pool are leased" % self.size)
+        return None
+
+    def wipe(self, name):
+        """
+        Remove objects created by test from project
+
+        :param name: str project name
+        :return: None
+        """
+        self.oc("delete all -l %s -n %s" % (WIPE_LABEL, name), ignore_status=True, verbose=core.is_debug())
+        # templates are created from files by oc create, they have no label
+        self.oc("delete template --all -n %s" % name, ignore_status=True, verbose=core.is_debug())
+
+    def release(self, lease):
+        """
+        Wipe project and return it to pool
+
+        :param lease: tuple returned by lease()
+        :return: None
+        """
+        name, handle = lease
+        self.wipe(name)
+        handle.truncate(0)
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+        core.print_debug("Released project %s" % name)
+
+    def destroy(self):
+        """
+        Delete all projects of pool
+
+        :return: None
+        """
+        self.invalidate()
+        existing = self.existing()
+        for name in self.names():
+            if name in existing:
+                self.oc("delete project %s" % name, ignore_status=True, verbose=core.is_debug())
+
+
+def test_lease():
+    import shutil
+    import tempfile
+    from avocado.utils import process
+
+    commands = []
+
+    def fake_oc(args, **kwargs):
+        commands.append(args)
+        stdout = ""
+        if args.startswith("get projects"):
+            stdout = "project.project.openshift.io/%s-%s-0\n" % (DEFAULT_PREFIX, _host_id())
+        return process.CmdResult(command=args, stdout=stdout, exit_status=0)
+
+    lockdir = tempfile.mkdtemp()
+    try:
+        pool = ProjectPool(fake_oc, size=2, prefix=DEFAULT_PREFIX, quota="pods=4", lockdir=lockdir)
+        first = pool.lease()
+        second = pool.lease()
+        assert first[0] != second[0]
+        # only missing project is created, with its quota
+        assert len([x for x in commands if x.startswith("new-project")]) == 1
+        assert len([x for x in commands if x.startswith("create quota")]) == 1
+        assert pool.lease() is None
+        # state of pool is checked just once
+        assert len([x for x in commands if x.startswith("get projects")]) == 1
+        pool.release(first)
+        assert "delete all -l %s -n %s" % (WIPE_LABEL, first[0]) in commands
+        assert pool.lease()[0] == first[0]
+        assert unique_suffix() != unique_suffix()
+    finally:
+        shutil.rmtree(lockdir)
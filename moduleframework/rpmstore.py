@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# Meta test family (MTF) is a tool to test components of a modular Fedora:
+# https://docs.pagure.org/modularity/
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Content addressed store of RPMs downloaded from koji.
+
+RPMs are stored once as <nspawn basedir>/rpmstore/<payload hash>/<file name>, local repositories
+(localrepo_*) are views of hardlinks to the store. Metadata of new repository are created
+from metadata of previous version of the same module by createrepo_c --update, so that only
+changed RPMs are read.
+"""
+
+import os
+import re
+import glob
+import fcntl
+import shutil
+import errno
+from distutils.spawn import find_executable
+from avocado.utils import process
+
+import core
+import common
+import pkgcache
+
+STORE_DIR = "rpmstore"
+REPO_TOOLS = {"createrepo_c": "createrepo_c", "koji": "koji"}
+_tools_checked = []
+
+
+def get_store_dir(basedir=None):
+    """
+    Return directory of RPM store
+
+    :param basedir: nspawn base directory, default from MTF config
+    :return: str
+    """
+    return os.path.join(basedir or common.conf["nspawn"]["basedir"], STORE_DIR)
+
+
+def store_path(payloadhash, filename, basedir=None):
+    """
+    Return path of RPM in store
+
+    :param payloadhash: str payload hash (SIGMD5) of RPM
+    :param filename: str RPM file name
+    :param basedir: nspawn base directory
+    :return: str
+    """
+    return os.path.join(get_store_dir(basedir), payloadhash, filename)
+
+
+def ensure_tools():
+    """
+    Install tools for local repositories (createrepo_c, koji) when they are missing,
+    they are checked just once per process and installed just once per host
+
+    :return: None
+    """
+    if _tools_checked:
+        return
+    missing = [package for binary, package in sorted(REPO_TOOLS.items()) if not find_executable(binary)]
+    if missing:
+        process.run("{HOSTPACKAGER} {CACHEOPTS} install {PACKAGES}".format(
+            CACHEOPTS=pkgcache.packager_options(common.hostpackager), PACKAGES=" ".join(missing),
+            **common.trans_dict), ignore_status=True, verbose=core.is_debug())
+    _tools_checked.append(True)
+
+
+def link(source, dest):
+    """
+    Hardlink file, existing different file is replaced, it is copied when hardlink is not possible
+
+    :param source: str
+    :param dest: str
+    :return: None
+    """
+    if os.path.exists(dest):
+        if os.path.samefile(source, dest):
+            return
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+        shutil.copy2(source, dest)
+
+
+def adopt(path, payloadhash, basedir=None):
+    """
+    Move verified RPM to store, it is replaced by hardlink to store
+
+    :param path: str RPM file
+    :param payloadhash: str payload hash (SIGMD5) of RPM
+    :param basedir: nspawn base directory
+    :return: str path in store
+    """
+    stored = store_path(payloadhash, os.path.basename(path), basedir)
+    if not os.path.exists(stored):
+        if not os.path.isdir(os.path.dirname(stored)):
+            os.makedirs(os.path.dirname(stored))
+        link(path, stored)
+    return stored
+
+
+def previous_view(view):
+    """
+    Return newest repository of other version of the same module (localrepo_<name>_<stream>_<version>)
+
+    :param view: str repository directory
+    :return: str or None
+    """
+    match = re.match(r"(.*_)[^_]+$", view.rstrip("/"))
+    if not match:
+        return None
+    candidates = [x for x in glob.glob(match.group(1) + "*")
+                  if x != view.rstrip("/") and os.path.exists(os.path.join(x, "repodata", "repomd.xml"))]
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+def createrepo(view):
+    """
+    Create repository metadata, metadata of previous version of module are reused
+
+    :param view: str repository directory
+    :return: None
+    """
+    ensure_tools()
+    workers = common.conf["generic"].get("download_workers") or 4
+    repodata = os.path.join(view, "repodata")
+    previous = previous_view(view)
+    if not os.path.exists(repodata) and previous:
+        core.print_debug("Metadata of %s are reused for %s" % (previous, view))
+        shutil.copytree(os.path.join(previous, "repodata"), repodata)
+    if find_executable("createrepo_c"):
+        cmd = "createrepo_c --update --workers %d %s" % (workers, view)
+    else:
+        cmd = "createrepo -v --update --workers %d %s" % (workers, view)
+    process.run(cmd, shell=True, verbose=core.is_debug())
+
+
+def prune(basedir=None, dry_run=False):
+    """
+    Remove RPMs from store which are not linked to any repository. Store directory of RPM is locked
+    (same lock as download and linking in koji_download), directories locked by somebody else are skipped.
+
+    :param basedir: nspawn base directory
+    :param dry_run: bool, just return what would be removed
+    :return: list of removed files
+    """
+    removed = []
+    for directory in glob.glob(os.path.join(get_store_dir(basedir), "*")):
+        try:
+            lockfile = open(os.path.join(directory, ".lock"), "a")
+        except IOError:
+            continue
+        with lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                core.print_debug("RPM store directory %s is in use, skipped" % directory)
+                continue
+            for path in glob.glob(os.path.join(directory, "*.rpm")):
+                if os.stat(path).st_nlink == 1:
+                    if not dry_run:
+                        os.remove(path)
+                    removed.append(path)
+            if not dry_run and not glob.glob(os.path.join(directory, "*.rpm")):
+                shutil.rmtree(directory, ignore_errors=True)
+    return removed
+
+
+def test_store():
+    import tempfile
+    basedir = tempfile.mkdtemp()
+    try:
+        view1 = os.path.join(basedir, "localrepo_mod_1_1")
+        view2 = os.path.join(basedir, "localrepo_mod_1_2")
+        for directory in [view1, os.path.join(view1, "repodata"), view2]:
+            os.makedirs(directory)
+        open(os.path.join(view1, "repodata", "repomd.xml"), "w").close()
+        with open(os.path.join(view1, "a.rpm"), "w") as rpmfile:
+            rpmfile.write("rpm")
+        stored = adopt(os.path.join(view1, "a.rpm"), "abc", basedir)
+        open(os.path.join(os.path.dirname(stored), ".lock"), "w").close()
+        link(stored, os.path.join(view2, "a.rpm"))
+        assert os.stat(stored).st_nlink == 3
+        assert previous_view(view2) == view1
+        assert not prune(basedir)
+        shutil.rmtree(view1)
+        shutil.rmtree(view2)
+        # directory locked by download in progress is skipped
+        with open(os.path.join(os.path.dirname(stored), ".lock"), "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            assert not prune(basedir)
+        assert prune(basedir) == [stored]
+        assert not os.path.exists(os.path.dirname(stored))
+    finally:
+        shutil.rmtree(basedir)
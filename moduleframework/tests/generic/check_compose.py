@@ -41,17 +41,18 @@ class ComposeTest(module_framework.NspawnAvocadoTest):
         try to install and remove components for each profile
         """
         self.log.info("Checking availability of component and installation and remove them")
-        allprofiles = self.getModulemdYamlconfig()["data"].get("profiles") if self.getModulemdYamlconfig()["data"].get("profiles") else []
-        for profile in allprofiles:
-            actualpackagelist = set(self.getModulemdYamlconfig()["data"]["profiles"][profile]["rpms"]) - set(self.backend.bootstrappackages)
+        mdindex = self.getModulemdIndex()
+        bootstrappackages = set(self.backend.bootstrappackages)
+        for profile in sorted(mdindex.profiles):
+            actualpackagelist = mdindex.profile(profile) - bootstrappackages
             packager = common.trans_dict["GUESTPACKAGER"]
             if actualpackagelist:
-                checkpackage = self.run("rpm -q --qf='%{{name}}\\n' " + " ".join(actualpackagelist), ignore_status=True).stdout.split()
+                checkpackage = self.rpm_query("-q --qf='%{{name}}\\n' " + " ".join(actualpackagelist), ignore_status=True).stdout.split()
                 installed = [x for x in checkpackage if "not installed" not in x]
                 self.log.info("Already installed packages:", installed)
 
                 actualpackages = " ".join(list(set(actualpackagelist)-set(installed)))
                 if len(actualpackages)>2:
                     self.run("%s install %s" % (packager, actualpackages))
-                    self.run("rpm -q %s" % actualpackagelist)
+                    self.rpm_query("-q %s" % " ".join(actualpackagelist))
                     self.run("%s remove %s" % (packager, actualpackages))
@@ -34,8 +34,7 @@ class DockerfileLinterInContainer(container_avocado_test.ContainerAvocadoTest):
     def _file_to_check(self, doc_file_list):
         test_failed = False
         for doc in doc_file_list:
-            exit_status = self.run("test -e %s" % doc, ignore_status=True).exit_status
-            if int(exit_status) == 0:
+            if doc and self.file_exists(doc):
                 self.log.debug("%s doc file exists in container" % doc)
                 test_failed = True
         return test_failed
@@ -117,7 +116,7 @@ class DockerfileLinterInContainer(container_avocado_test.ContainerAvocadoTest):
         """
         self.start()
         # Detect distro in image
-        distro = self.run("cat /etc/os-release").stdout
+        distro = self.read_file("/etc/os-release")
         if 'Fedora' in distro:
             self.assertFalse(self._dnf_clean_all(), msg="`dnf clean all` is not present in Dockerfile.")
         else:
@@ -42,8 +42,8 @@ class ModuleLintSigning(module_framework.AvocadoTest):
         FEDKEY = "73bde98381b46521"
         KEY = FEDKEY
         self.start()
-        allpackages = self.run(
-            r'rpm -qa --qf="%{{name}}-%{{version}}-%{{release}} %{{SIGPGP:pgpsig}}\n"').stdout
+        allpackages = self.rpm_query(
+            r'-qa --qf="%{{name}}-%{{version}}-%{{release}} %{{SIGPGP:pgpsig}}\n"').stdout
         for package in [x.strip() for x in allpackages.split('\n')]:
             pinfo = package.split(', ')
             if len(pinfo) == 3:
@@ -60,8 +60,8 @@ class ModuleLintPackagesCheck(module_framework.AvocadoTest):
 
     def test(self):
         self.start()
-        allpackages = [
+        allpackages = set(
             x.strip()
-            for x in self.run(r'rpm -qa --qf="%{{name}}\n"').stdout.split('\n')]
+            for x in self.rpm_query(r'-qa --qf="%{{name}}\n"').stdout.split('\n'))
         for pkg in self.backend.getPackageList():
             self.assertIn(pkg, allpackages)
@@ -95,11 +95,11 @@ class rpmvalidation(module_framework.AvocadoTest):
 
     def testPaths(self):
         self.start()
-        allpackages = filter(bool, self.run("rpm -qa").stdout.split("\n"))
+        allpackages = filter(bool, self.rpm_query("-qa").stdout.split("\n"))
         core.print_debug(allpackages)
         for package in allpackages:
             if 'filesystem' in package:
                 continue
-            for package_file in filter(bool, self.run("rpm -ql %s" % package).stdout.split("\n")):
+            for package_file in filter(bool, self.rpm_query("-ql %s" % package).stdout.split("\n")):
                 if not self._compare_fhs(package_file):
                     self.fail("(%s): File [%s] violates the FHS." % (package, package_file))
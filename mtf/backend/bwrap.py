@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#
+# This Modularity Testing Framework helps you to write tests for modules
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# he Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Jan Scotka <jscotka@redhat.com>
+#
+
+"""
+Low level library running commands in bubblewrap sandbox on top of nspawn images.
+There is no boot of systemd, every command is executed in own sandbox with image root filesystem
+bound read only (or as temporary overlay), so that it starts fast and it does not need root privileges.
+"""
+
+import os
+import pipes
+import shutil
+import logging
+import tempfile
+from avocado import Test
+from avocado.utils import process
+
+from moduleframework import core, common, mtfexceptions, pkgcache
+from mtf.backend import nspawn
+
+DEFAULT_WRITABLE_DIRS = ["/tmp", "/var/tmp", "/run"]
+# guest paths where bwrap mounts own filesystems
+SPECIAL_DIRS = ["/proc", "/dev"]
+
+is_debug_low = core.is_debug
+if is_debug_low():
+    logging.basicConfig(level=logging.DEBUG)
+
+
+class Sandbox(object):
+    """
+    It represents bubblewrap sandbox, it has same interface as nspawn.Container,
+    so that it can replace it in helpers.
+    Writable directories are bound from scratch directory on host, so that they are shared
+    by all commands of one sandbox and they are visible from host.
+    """
+    logger = logging.getLogger("Sandbox")
+
+    def __init__(self, image, name=None, writable_dirs=None, overlay=False, additional_options=None):
+        """
+
+        :param image: nspawn.Image object
+        :param name: optional, hostname of sandbox, generated in case not given
+        :param writable_dirs: list of guest directories what are writable (bound from host scratch directory)
+        :param overlay: bool, use temporary overlay on top of read only root (bwrap >= 0.10 is needed),
+                        all files are writable but changes are not visible from host and they are lost after command
+        :param additional_options: list of additional bwrap options
+        """
+        self.image = image
+        self.name = name or common.generate_unique_name()
+        self.location = self.image.get_location()
+        self.writable_dirs = DEFAULT_WRITABLE_DIRS if writable_dirs is None else writable_dirs
+        self.overlay = overlay
+        self.additional_options = additional_options or []
+        self.scratchdir = None
+        self.background = []
+
+    def boot_machine(self):
+        """
+        prepare scratch directories of sandbox, there is nothing to boot
+
+        :return: None
+        """
+        if not os.path.isdir(os.path.join(self.location, "usr")):
+            raise mtfexceptions.BwrapExc("Image %s does not contain root filesystem" % self.location)
+        self.scratchdir = tempfile.mkdtemp(prefix="mtf_bwrap_%s_" % self.name)
+        for directory in self.writable_dirs:
+            os.makedirs(self._scratch_path(directory))
+
+    def _scratch_path(self, directory):
+        """
+        Internal method, return host directory bound to writable guest directory
+
+        :return: str
+        """
+        return os.path.join(self.scratchdir, directory.strip("/").replace("/", "_"))
+
+    def get_bwrap_command(self, command):
+        """
+        return bwrap command line what runs command inside sandbox
+
+        :param command: str shell command
+        :return: list
+        """
+        if self.overlay:
+            options = ["--overlay-src", self.location, "--tmp-overlay", "/"]
+        else:
+            options = ["--ro-bind", self.location, "/"]
+        options += ["--dev", "/dev", "--proc", "/proc"]
+        for directory in self.writable_dirs:
+            options += ["--bind", self._scratch_path(directory), directory]
+        for path in pkgcache.local_repo_paths(self.image.repos):
+            options += ["--ro-bind", path, path]
+        options += ["--unshare-all", "--share-net", "--die-with-parent", "--hostname", self.name, "--chdir", "/"]
+        if os.geteuid() != 0:
+            # commands see themselves as root inside user namespace (rpm, file ownership)
+            options += ["--unshare-user", "--uid", "0", "--gid", "0"]
+        return ["bwrap"] + options + self.additional_options + ["/bin/bash", "-c", command]
+
+    def execute(self, command, internal_background=False, **kwargs):
+        """
+        execute command inside sandbox
+
+        :param command: str
+        :param internal_background: bool, keep command running in background (until stop)
+        :param kwargs: pass thru to avocado.process.run command
+        :return: process object
+        """
+        cmdline = " ".join([pipes.quote(x) for x in self.get_bwrap_command(command)])
+        if internal_background:
+            self.logger.debug("Background command: %s" % cmdline)
+            subproc = process.SubProcess(cmdline)
+            subproc.start()
+            self.background.append(subproc)
+            return process.CmdResult(command=command, exit_status=0)
+        kwargs.pop("shell", None)
+        kwargs.pop("ignore_bg_processes", None)
+        comout = process.run(cmdline, **kwargs)
+        comout.command = command
+        return comout
+
+    def host_path(self, path):
+        """
+        return host path of file inside sandbox. Files in writable directories are in scratch directory,
+        other files are in image directory (except overlay mode, where changes are not visible)
+
+        :param path: absolute path inside sandbox
+        :return: str or None when file has to be accessed inside sandbox
+        """
+        guestpath = nspawn.resolve_in_root(self.location, path)
+        if guestpath is None:
+            return None
+        for directory in self.writable_dirs:
+            if guestpath == directory or guestpath.startswith(directory.rstrip("/") + "/"):
+                return self._scratch_path(directory) + guestpath[len(directory.rstrip("/")):]
+        for directory in SPECIAL_DIRS:
+            if guestpath == directory or guestpath.startswith(directory + "/"):
+                return None
+        if self.overlay:
+            return None
+        return self.location + guestpath
+
+    def copy_to(self, src, dest):
+        """
+        Copy file to sandbox from host, destination has to be in writable directory
+
+        :param src: source file on host
+        :param dest: destination file on sandbox
+        :return: None
+        """
+        self.logger.debug("copy files (inside) from: %s to: %s" % (src, dest))
+        hostdest = self.host_path(dest)
+        if not hostdest or not hostdest.startswith(self.scratchdir):
+            raise mtfexceptions.BwrapExc("Destination %s is not writable, use one of: %s" %
+                                         (dest, self.writable_dirs))
+        process.run("cp -rf %s %s" % (src, hostdest), verbose=is_debug_low())
+
+    def copy_from(self, src, dest):
+        """
+        Copy file from sandbox to host
+
+        :param src: source file on sandbox
+        :param dest: destination file on host
+        :return: None
+        """
+        self.logger.debug("copy files (outside) from: %s to: %s" % (src, dest))
+        hostsrc = self.host_path(src)
+        if hostsrc:
+            process.run("cp -rf %s %s" % (hostsrc, dest), verbose=is_debug_low())
+        else:
+            with open(dest, "w") as openfile:
+                openfile.write(self.execute("cat %s" % src, verbose=is_debug_low()).stdout)
+
+    def stop(self):
+        """
+        Terminate background commands and remove scratch directories
+
+        :return: None
+        """
+        self.logger.debug("Stop")
+        for subproc in self.background:
+            subproc.terminate()
+            subproc.wait()
+        self.background = []
+        if self.scratchdir:
+            shutil.rmtree(self.scratchdir, ignore_errors=True)
+            self.scratchdir = None
+
+    def rm(self):
+        """
+        Sandbox has no own image, nothing to remove
+
+        :return: None
+        """
+        pass
+
+
+# ====================== Self Tests ======================
+
+class testSandbox(Test):
+    """
+    Test Sandbox class, image from nspawn self tests is reused
+    """
+    loc1 = "/tmp/dddd1"
+
+    def setUp(self):
+        self.i1 = nspawn.Image(repos=["http://ftp.fi.muni.cz/pub/linux/fedora/linux/releases/26/Everything/x86_64/os/"],
+                               packageset=["bash"],
+                               location=self.loc1, ignore_installed=True)
+        self.s1 = Sandbox(image=self.i1)
+        self.s1.boot_machine()
+
+    def test_basic(self):
+        assert "sbin" in self.s1.execute(command="ls /").stdout
+        self.s1.execute("echo inside > /var/tmp/file")
+        assert "inside" in open(self.s1.host_path("/var/tmp/file")).read()
+        assert self.s1.execute("touch /usr/file", ignore_status=True).exit_status != 0
+
+    def test_background(self):
+        self.s1.execute("sleep 1000", internal_background=True)
+        assert self.s1.background[0].poll() is None
+        self.s1.stop()
+        assert not self.s1.background
+
+    def tearDown(self):
+        self.s1.stop()
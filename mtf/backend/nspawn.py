@@ -27,13 +27,17 @@ Low level library handling Systemd nspawn containers and images
 import os
 import logging
 import shutil
+import fcntl
+import contextlib
 import glob
 import time
 import re
+import json
+import tempfile
 from avocado import Test
 from avocado.utils import process
 
-from moduleframework import core, common, mtfexceptions
+from moduleframework import core, common, mtfexceptions, pkgcache, mirrors
 
 
 DEFAULT_RETRYTIMEOUT = 30
@@ -44,6 +48,54 @@ is_debug_low = core.is_debug
 if is_debug_low():
     logging.basicConfig(level=logging.DEBUG)
 
+def read_metadata(location):
+    """
+    return metadata of image stored in local image cache (<location>.json)
+
+    :param location: image directory
+    :return: dict or None when image is not registered
+    """
+    metafile = "%s.json" % location.rstrip("/")
+    if not os.path.exists(metafile):
+        return None
+    with open(metafile) as openfile:
+        return json.load(openfile)
+
+
+def resolve_in_root(root, path, maxlinks=40):
+    """
+    return canonical guest path, symlinks are resolved relatively to root directory
+    (absolute link targets point inside root, not to host)
+
+    :param root: host directory with root filesystem
+    :param path: absolute path inside root
+    :param maxlinks: maximal number of followed symlinks
+    :return: str guest path or None in case of symlink loop
+    """
+    parts = [x for x in path.split("/") if x]
+    resolved = ""
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == ".":
+            continue
+        if part == "..":
+            resolved = os.path.dirname(resolved).rstrip("/")
+            continue
+        candidate = "%s/%s" % (resolved, part)
+        if os.path.islink(root + candidate):
+            links += 1
+            if links > maxlinks:
+                return None
+            target = os.readlink(root + candidate)
+            if target.startswith("/"):
+                resolved = ""
+            parts = [x for x in target.split("/") if x] + parts
+        else:
+            resolved = candidate
+    return resolved or "/"
+
+
 class Image(object):
     """
     It represents image object for Nspawn virtualization
@@ -66,13 +118,42 @@ class Image(object):
             pass
         else:
             try:
-                self.__install()
+                with self._build_lock():
+                    self.__install()
             except mtfexceptions.NspawnExc as e:
                 if ignore_installed:
                     pass
                 else:
                     raise e
 
+    @contextlib.contextmanager
+    def _build_lock(self):
+        """
+        Internal method, serialize building of same image by parallel test processes
+
+        :return: context manager
+        """
+        if not os.path.exists(os.path.dirname(self.location)):
+            os.makedirs(os.path.dirname(self.location))
+        lockname = "%s.lock" % self.location
+        while True:
+            try:
+                lockfile = open(lockname, "a")
+            except IOError:
+                # unprivileged user is able just to use images built by somebody else, nothing to serialize
+                yield
+                return
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            # garbage collector removes lock file together with image, lock of removed file serializes nothing
+            if os.path.exists(lockname) and os.fstat(lockfile.fileno()).st_ino == os.stat(lockname).st_ino:
+                break
+            lockfile.close()
+        with lockfile:
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
     def create_snapshot(self, destination):
         """
         returns Image object with copyied files from base image
@@ -99,50 +180,63 @@ class Image(object):
         if not os.path.exists(os.path.join(self.location, "usr")):
             if not os.path.exists(self.location):
                 os.makedirs(self.location)
-            repos_to_use = ""
-            counter = 0
-            for repo in self.repos:
-                counter = counter + 1
-                repos_to_use += " --repofrompath %s%d,%s" % (
-                    self.name, counter, repo)
-            self.logger.debug("Install packages: %s" % self.packageset)
-            self.logger.debug("Repositories: %s" % self.repos)
-            process.run("%s install --nogpgcheck --setopt=install_weak_deps=False "
-                 "--installroot %s --allowerasing --disablerepo=* --enablerepo=%s* %s %s" %
-                                    (self.packager, self.location, self.name,
-                                     repos_to_use, " ".join(self.packageset)),
-                        verbose=is_debug_low())
-            insiderepopath = os.path.join(self.location, self.yumrepo[1:])
-            if not os.path.exists(os.path.dirname(insiderepopath)):
-                os.makedirs(os.path.dirname(insiderepopath))
-            counter = 0
-            with open(insiderepopath, 'w') as f:
-                for repo in self.repos:
-                    counter = counter + 1
-                    add = """
-[%s%d]
-name=%s%d
-baseurl=%s
-enabled=1
-gpgcheck=0    
-            """ % (self.name, counter, self.name, counter, repo)
-                    f.write(add)
-            for repo in self.repos:
-                if "file:///" in repo:
-                    src = repo[7:]
-                    srcto = os.path.join(self.location, src[1:])
-                    if not os.path.exists(os.path.dirname(srcto)):
-                        os.makedirs(os.path.dirname(srcto))
-                    shutil.copytree(src, srcto)
-            pkipath = "/etc/pki/rpm-gpg"
-            pkipath_ch = os.path.join(self.location, pkipath[1:])
-            if not os.path.exists(pkipath_ch):
-                os.makedirs(pkipath_ch)
-            for filename in glob.glob(os.path.join(pkipath, '*')):
-                shutil.copy(filename, pkipath_ch)
+            self._install_packages(self.packageset)
+            self.save_metadata()
         else:
             raise mtfexceptions.NspawnExc("Directory %s already in use" % self.location)
 
+    def _install_packages(self, packageset):
+        """
+        Internal method, install packages to root directory of image and set repositories inside.
+        Packages are installed from the best mirrors of repositories, next mirrors are used
+        when installation fails (see mirrors.failover)
+
+        :param packageset: list of packages to install
+        :return: None
+        """
+        self.logger.debug("Install packages: %s" % packageset)
+        self.logger.debug("Repositories: %s" % self.repos)
+        pkgcache.prepare()
+        repos = mirrors.failover(self.repos, lambda x: self._install_from(x, packageset),
+                                 errors=(process.CmdError,))
+        pkgcache.touch(repos)
+        pkgcache.enforce_limit()
+        insiderepopath = os.path.join(self.get_location(), self.yumrepo[1:])
+        if not os.path.exists(os.path.dirname(insiderepopath)):
+            os.makedirs(os.path.dirname(insiderepopath))
+        with open(insiderepopath, 'w') as f:
+            f.write(pkgcache.repo_file_content(repos))
+        # local repositories are not copied, just mount points are created, see get_bind_options
+        for src in pkgcache.local_repo_paths(self.repos):
+            srcto = os.path.join(self.get_location(), src[1:])
+            if not os.path.exists(srcto):
+                os.makedirs(srcto)
+        pkipath = "/etc/pki/rpm-gpg"
+        pkipath_ch = os.path.join(self.get_location(), pkipath[1:])
+        if not os.path.exists(pkipath_ch):
+            os.makedirs(pkipath_ch)
+        for filename in glob.glob(os.path.join(pkipath, '*')):
+            shutil.copy(filename, pkipath_ch)
+
+    def _install_from(self, repos, packageset):
+        """
+        Internal method, install packages to root directory of image from repositories
+
+        :param repos: list of repository URLs (mirrors of self.repos)
+        :param packageset: list of packages to install
+        :return: list repos
+        """
+        repos_to_use = ""
+        for repo in repos:
+            repos_to_use += " --repofrompath %s,%s" % (pkgcache.repo_id(repo), repo)
+        process.run("%s install --nogpgcheck --setopt=install_weak_deps=False %s "
+             "--installroot %s --allowerasing --disablerepo=* --enablerepo=%s %s %s" %
+                                (self.packager, pkgcache.packager_options(self.packager, repos),
+                                 self.get_location(), ",".join([pkgcache.repo_id(x) for x in repos]),
+                                 repos_to_use, " ".join(packageset)),
+                    verbose=is_debug_low())
+        return repos
+
     def get_location(self):
         """
         return directory location
@@ -151,9 +245,175 @@ gpgcheck=0
         """
         return self.location
 
+    def get_metadata(self):
+        """
+        return metadata describing how image was created
+
+        :return: dict
+        """
+        return {"name": os.path.basename(self.location),
+                "layout": "flat",
+                "repos": self.repos,
+                "packageset": sorted(self.packageset),
+                "created": time.time()}
+
+    def save_metadata(self):
+        """
+        store image metadata next to image directory (<location>.json), it registers image in local
+        image cache, see read_metadata
+
+        :return: None
+        """
+        with open("%s.json" % self.location, "w") as metafile:
+            json.dump(self.get_metadata(), metafile, indent=2)
+
+    def get_bind_options(self):
+        """
+        return systemd-nspawn options to bind local repositories (read only) and shared package cache
+        from host, instead of copying them to image
+
+        :return: list
+        """
+        options = ["--bind-ro=%s" % path for path in pkgcache.local_repo_paths(self.repos)]
+        if pkgcache.is_enabled():
+            options.append("--bind=%s" % pkgcache.prepare())
+        return options
+
     def rmi(self):
         shutil.rmtree(self.location)
 
+
+class LayeredImage(Image):
+    """
+    Image stacked on top of another (base) image via overlayfs.
+    Just packages missing in base image are installed, and they are stored in own layer,
+    so that more images share one base directory on disk and in page cache.
+
+    Layer directory contains:
+      upper - files installed/changed by this layer
+      work - overlayfs work directory
+      rootfs - mount point of merged filesystem
+    """
+    logger = logging.getLogger("LayeredImage")
+
+    def __init__(self, base, repos, packageset, location, installed=False, packager="dnf -y",
+                 name="unique", ignore_installed=False):
+        """
+
+        :param base: Image or LayeredImage object used as lower (read only) layer
+        :param location: layer directory
+        """
+        self.base = base
+        self.layerdir = location
+        self.upperdir = os.path.join(location, "upper")
+        self.workdir = os.path.join(location, "work")
+        self.rootfs = os.path.join(location, "rootfs")
+        if isinstance(base, LayeredImage):
+            self.lowerdirs = [base.upperdir] + base.lowerdirs
+            self.lower_images = [os.path.basename(base.layerdir)] + base.lower_images
+        else:
+            self.lowerdirs = [base.get_location()]
+            self.lower_images = [os.path.basename(base.location)]
+        super(LayeredImage, self).__init__(repos=repos, packageset=packageset, location=location,
+                                           installed=True, packager=packager, name=name)
+        if installed:
+            pass
+        else:
+            with self._build_lock():
+                if os.path.exists(self.upperdir):
+                    if not ignore_installed:
+                        raise mtfexceptions.NspawnExc("Directory %s already in use" % self.layerdir)
+                else:
+                    self.__install()
+                self.mount()
+
+    def __install(self):
+        """
+        Internal method, install just packages what are not part of base image to upper layer
+
+        :return: None
+        """
+        delta = list(set(self.packageset) - set(self.base.packageset))
+        self.logger.debug("Install layer to direcory: %s (on top of %s)" % (self.layerdir, self.lowerdirs))
+        for directory in [self.upperdir, self.workdir, self.rootfs]:
+            os.makedirs(directory)
+        if delta:
+            self.mount(readonly=False)
+            try:
+                self._install_packages(delta)
+            finally:
+                self.umount()
+        self.save_metadata()
+
+    def get_metadata(self):
+        """
+        return metadata describing how image was created, layers contain also names of lower images
+
+        :return: dict
+        """
+        metadata = super(LayeredImage, self).get_metadata()
+        metadata["layout"] = "layer"
+        metadata["lowers"] = self.lower_images
+        return metadata
+
+    def mount(self, readonly=True):
+        """
+        mount merged filesystem of layers to rootfs directory.
+        Read only mount (without upper and work directory) is used for images, what serve just as
+        lower layer for snapshots or for ephemeral containers
+
+        :param readonly: bool
+        :return: None
+        """
+        if os.path.ismount(self.rootfs):
+            return
+        if readonly:
+            options = "lowerdir=%s" % ":".join([self.upperdir] + self.lowerdirs)
+        else:
+            options = "lowerdir=%s,upperdir=%s,workdir=%s" % (":".join(self.lowerdirs), self.upperdir, self.workdir)
+        try:
+            process.run("mount -t overlay overlay -o %s %s" % (options, self.rootfs), verbose=is_debug_low())
+        except process.CmdError as e:
+            raise mtfexceptions.NspawnExc("Unable to mount overlay filesystem to %s" % self.rootfs, e)
+
+    def umount(self):
+        """
+        umount merged filesystem
+
+        :return: None
+        """
+        if os.path.ismount(self.rootfs):
+            process.run("umount %s" % self.rootfs, verbose=is_debug_low())
+
+    def get_location(self):
+        """
+        return directory with merged root filesystem
+
+        :return: str
+        """
+        return self.rootfs
+
+    def create_snapshot(self, destination):
+        """
+        returns writable LayeredImage on top of this image, files are not copied
+
+        :param destination: layer directory of snapshot
+        :return: LayeredImage
+        """
+        self.logger.debug("Create Snapshot (overlay): %s -> %s" % (self.layerdir, destination))
+        snapshot = self.__class__(base=self, repos=self.repos, packageset=self.packageset,
+                                  location=destination, installed=True,
+                                  packager=self.packager, name=self.name)
+        for directory in [snapshot.upperdir, snapshot.workdir, snapshot.rootfs]:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        snapshot.mount(readonly=False)
+        return snapshot
+
+    def rmi(self):
+        self.umount()
+        shutil.rmtree(self.layerdir)
+
 class Container(object):
     """
     It represents nspawn container virtualization with 
@@ -165,15 +425,26 @@ class Container(object):
     __default_command_sleep = 2
     __alternative_boot = False
     
-    def __init__(self, image, name=None):
+    def __init__(self, image, name=None, ephemeral=False, ephemeral_option="--volatile=overlay"):
         """
         
         :param image: Image object 
         :param name: optional, use unique name for generating containers in case not given, some name is generated
+        :param ephemeral: bool, boot image directly, changes are stored just in memory (tmpfs) and image stays untouched
+        :param ephemeral_option: nspawn option used for ephemeral boot (--volatile=overlay or --ephemeral)
         """
         self.image = image
         self.name = name or common.generate_unique_name()
         self.location = self.image.get_location()
+        self.ephemeral = ephemeral
+        self.ephemeral_option = ephemeral_option
+        # directory for stdout/stderr of executed commands, visible from host and inside container
+        # filesystem of ephemeral container is not visible from host, so there is bind mounted directory
+        self.io_guestdir = "/var/tmp"
+        self.io_hostdir = os.path.join(self.location, self.io_guestdir[1:])
+        if self.ephemeral:
+            self.io_guestdir = "/var/tmp/mtf_io"
+            self.io_hostdir = None
         self.__systemd_wait_support = self._run_systemdrun_decide()
 
     def __machined_restart(self):
@@ -224,8 +495,16 @@ class Container(object):
                         ignore_status=True, verbose=is_debug_low())
         else:
             bootmachine = "-b"
+        nspawn_options = self.image.get_bind_options() + list(nspawn_add_option_list)
+        if self.ephemeral:
+            if not self.io_hostdir:
+                self.io_hostdir = tempfile.mkdtemp(prefix="mtf_nspawn_io_%s_" % self.name)
+            nspawn_options.append("--bind=%s:%s" % (self.io_hostdir, self.io_guestdir))
+            # option could be already part of additional_boot_options
+            if not [x for x in nspawn_options if x.startswith("--volatile") or x in ["--ephemeral", "-x"]]:
+                nspawn_options.append(self.ephemeral_option)
         command = "systemd-nspawn --machine=%s %s %s -D %s %s" % \
-                  (self.name, " ".join(nspawn_add_option_list), bootmachine, self.location, bootmachine_cmd)
+                  (self.name, " ".join(nspawn_options), bootmachine, self.location, bootmachine_cmd)
         self.logger.debug("Start command: %s" % command)
         nspawncont = process.SubProcess(command)
         self.logger.info("machine: %s starting" % self.name)
@@ -247,6 +526,54 @@ class Container(object):
         """
         return self.run_systemdrun(command, **kwargs)
 
+    def get_leader(self):
+        """
+        return PID of init process of running machine (as seen from host)
+
+        :return: int or None when machine is not running
+        """
+        out = process.run("machinectl show -p Leader %s" % self.name, ignore_status=True, verbose=is_debug_low())
+        leader = out.stdout.strip().split("=")[-1]
+        if out.exit_status == 0 and leader.isdigit() and int(leader) > 0:
+            return int(leader)
+        return None
+
+    def guest_mountpoints(self):
+        """
+        return mount points of machine (except root), their content differs from image directory on host
+
+        :return: list or None when machine is not running
+        """
+        leader = self.get_leader()
+        if not leader:
+            return None
+        try:
+            with open("/proc/%d/mounts" % leader) as mounts:
+                return [x.split()[1] for x in mounts if x.split()[1] != "/"]
+        except IOError:
+            return None
+
+    def host_path(self, path):
+        """
+        return host path of file inside running machine, it allows to inspect files directly
+        without executing commands inside machine.
+        Ephemeral machines and paths under mount points of machine (private mount namespace)
+        are not visible from host
+
+        :param path: absolute path inside machine
+        :return: str or None when file has to be accessed inside machine
+        """
+        if self.ephemeral:
+            return None
+        guestpath = resolve_in_root(self.location, path)
+        mountpoints = self.guest_mountpoints()
+        if guestpath is None or mountpoints is None:
+            return None
+        for mountpoint in mountpoints:
+            if guestpath == mountpoint or guestpath.startswith(mountpoint.rstrip("/") + "/"):
+                return None
+        return self.location + guestpath
+
     def _run_systemdrun_decide(self):
         """
         Internal method
@@ -277,6 +604,17 @@ class Container(object):
         process.run("systemctl -M {} stop {}".format(machine, unit), ignore_status=True, verbose=is_debug_low())
         return retcode
 
+    def _check_io_hostdir(self, command):
+        """
+        Internal method, raise exception when directory for command output is not available,
+        directory of ephemeral container is created by boot (start)
+
+        :param command: str command to execute
+        :return: None
+        """
+        if self.io_hostdir is None:
+            raise mtfexceptions.NspawnExc("Container %s is not started, unable to execute: %s" % (self.name, command))
+
     def run_systemdrun(self, command, internal_background=False, **kwargs):
         """
         execute command via systemd-run inside container
@@ -288,10 +626,12 @@ class Container(object):
         """
         if not kwargs:
             kwargs = {}
+        self._check_io_hostdir(command)
         self.__machined_restart()
         add_sleep_infinite = ""
         unit_name = common.generate_unique_name()
-        lpath = "/var/tmp/{}".format(unit_name)
+        lpath = os.path.join(self.io_guestdir, unit_name)
+        hpath = os.path.join(self.io_hostdir, unit_name)
         if self.__systemd_wait_support:
             add_wait_var = "--wait"
         else:
@@ -311,13 +651,13 @@ class Container(object):
             if not internal_background:
                 if not self.__systemd_wait_support:
                     comout.exit_status = self.__systemctl_wait_until_finish(self.name,unit_name)
-                with open("{chroot}{pin}.stdout".format(chroot=self.location, pin=lpath), 'r') as content_file:
+                with open("{pin}.stdout".format(pin=hpath), 'r') as content_file:
                     comout.stdout = content_file.read()
-                with open("{chroot}{pin}.stderr".format(chroot=self.location, pin=lpath), 'r') as content_file:
+                with open("{pin}.stderr".format(pin=hpath), 'r') as content_file:
                     comout.stderr = content_file.read()
                 comout.command = command
-                os.remove("{chroot}{pin}.stdout".format(chroot=self.location, pin=lpath))
-                os.remove("{chroot}{pin}.stderr".format(chroot=self.location, pin=lpath))
+                os.remove("{pin}.stdout".format(pin=hpath))
+                os.remove("{pin}.stderr".format(pin=hpath))
                 self.logger.debug(comout)
                 if not self.__systemd_wait_support and not kwargs.get("ignore_status") and comout.exit_status != 0:
                     raise process.CmdError(comout.command, comout)
@@ -333,8 +673,9 @@ class Container(object):
         :param kwargs:
         :return:
         """
+        self._check_io_hostdir(command)
         self.__machined_restart()
-        lpath = "/var/tmp"
+        lpath = self.io_guestdir
         if not kwargs:
             kwargs = {}
         should_ignore = kwargs.get("ignore_status")
@@ -347,9 +688,8 @@ class Container(object):
         try:
             kwargs["verbose"] = False
             b = process.run(
-                'bash -c "cat {chroot}{pin}/stdout; cat {chroot}{pin}/stderr > /dev/stderr; exit `cat {chroot}{pin}/retcode`"'.format(
-                    chroot=self.location,
-                    pin=lpath),
+                'bash -c "cat {pin}/stdout; cat {pin}/stderr > /dev/stderr; exit `cat {pin}/retcode`"'.format(
+                    pin=self.io_hostdir),
                 **kwargs)
         finally:
             comout.stdout = b.stdout
@@ -431,15 +771,19 @@ class Container(object):
                 time.sleep(DEFAULT_RETRYTIMEOUT)
                 pass
             pass
+        if self.ephemeral and self.io_hostdir:
+            shutil.rmtree(self.io_hostdir, ignore_errors=True)
+            self.io_hostdir = None
 
     def rm(self):
         """
-        Remove container image via image method
+        Remove container image via image method, ephemeral containers does not have own image
 
         :return:
         """
         self.logger.debug("Remove")
-        self.image.rmi()
+        if not self.ephemeral:
+            self.image.rmi()
 
 
 # ====================== Self Tests ======================
@@ -467,6 +811,20 @@ class testImage(Test):
         assert os.path.exists(os.path.join(self.i2.get_location(), "usr"))
         self.i2.rmi()
 
+    def test_layered(self):
+        loc3 = "/tmp/dddd3"
+        process.run("rm -rf %s %s" % (loc3, self.loc2), ignore_status=True)
+        self.i3 = LayeredImage(base=self.i1, repos=self.i1.repos, packageset=["bash", "which"], location=loc3)
+        assert os.path.ismount(self.i3.get_location())
+        assert os.path.exists(os.path.join(self.i3.get_location(), "usr", "bin", "which"))
+        assert not os.path.exists(os.path.join(self.i1.get_location(), "usr", "bin", "which"))
+        assert not os.path.exists(os.path.join(self.i3.upperdir, "usr", "bin", "bash"))
+        self.i2 = self.i3.create_snapshot(self.loc2)
+        open(os.path.join(self.i2.get_location(), "snapshotfile"), "w").close()
+        assert not os.path.exists(os.path.join(self.i3.get_location(), "snapshotfile"))
+        self.i2.rmi()
+        self.i3.rmi()
+
     def tearDown(self):
         try:
             self.i1.rmi()
@@ -566,6 +924,15 @@ class testContainer(Test):
             assert False
 
 
+    def test_ephemeral(self):
+        self.c1 = Container(image=self.i1, name=self.cname, ephemeral=True)
+        self.c1.boot_machine()
+        self.c1.execute("echo inside > /ephemeralfile")
+        assert "inside" in self.c1.execute("cat /ephemeralfile").stdout
+        assert not os.path.exists(os.path.join(self.i1.get_location(), "ephemeralfile"))
+        self.c1.rm()
+        assert os.path.exists(os.path.join(self.i1.get_location(), "usr"))
+
     def test_container_additional_options(self):
         self.c1 = Container(image=self.i1, name=self.cname)
         self.c1.boot_machine(nspawn_add_option_list=["--private-network"])
@@ -578,3 +945,17 @@ class testContainer(Test):
 
     def tearDown(self):
         self.c1.stop()
+
+
+def test_resolve_in_root():
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, "usr", "lib"))
+    os.symlink("/usr/lib", os.path.join(root, "lib"))
+    os.symlink("../lib/x", os.path.join(root, "usr", "link"))
+    os.symlink("loop", os.path.join(root, "loop"))
+    assert resolve_in_root(root, "/lib/file") == "/usr/lib/file"
+    assert resolve_in_root(root, "/usr/link") == "/usr/lib/x"
+    assert resolve_in_root(root, "/../../etc/passwd") == "/etc/passwd"
+    assert resolve_in_root(root, "/") == "/"
+    assert resolve_in_root(root, "/loop") is None
+    shutil.rmtree(root)
@@ -140,12 +140,20 @@ class MetadataLoader(object):
 
     def _url_download_files(self,testdict):
         print_debug("Downloading resources via URL")
+        try:
+            # shared HTTP client with response cache, when MTF is installed
+            from moduleframework.httpclient import download as urlretrieve_cached
+        except ImportError:
+            urlretrieve_cached = None
         for test in testdict:
             if os.path.exists(test):
                 print_debug("File %s already exist locally" % test)
             else:
                 print_debug("Storing %s as file %s" % (testdict[test], test))
-                urlretrieve(testdict[test],filename=test)
+                if urlretrieve_cached:
+                    urlretrieve_cached(testdict[test], test)
+                else:
+                    urlretrieve(testdict[test],filename=test)
 
     def _import_tests(self, testglob, pathlenght=0):
         """
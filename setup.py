@@ -90,6 +90,7 @@ setup(
             'mtf-init = moduleframework.mtf_init:main',
             'mtf = moduleframework.mtf_scheduler:main',
             'mtf-pdc-module-info-reader = moduleframework.pdc_msg_module_info_reader:main',
+            'mtf-cache-clean = moduleframework.pkgcache:main',
         ]
     },
     setup_requires=[],